@@ -1,11 +1,18 @@
 import base64
+import typing
 
 import ninja
 import orjson
+from asgiref import sync
 from django import http, shortcuts
-from ninja import Schema, parser, renderers
+from django.core import exceptions
+from django.http import multipartparser
+from ninja import Schema, errors, parser, renderers
 
-from django_qcapp_ratings import models
+from django_qcapp_ratings import archive, models, selectors, services
+
+BULK_BATCH_SIZE = 500
+BULK_CHUNK_BYTES = 64 * 1024
 
 
 class ORJSONParser(parser.Parser):
@@ -38,6 +45,17 @@ class ImageSchema(ninja.ModelSchema):
         fields_optional = ["created", "slice", "file2", "display", "step"]
 
 
+class BulkImageSchema(ninja.ModelSchema):
+    """An item of a bulk upload, without its img; unknown keys are refused."""
+
+    model_config = {"extra": "forbid"}
+
+    class Meta:
+        model = models.Image
+        fields = ["slice", "file1", "file2", "display", "step"]
+        fields_optional = ["slice", "file2"]
+
+
 class ImageResponseSchema(ninja.ModelSchema):
     img: str
 
@@ -51,6 +69,68 @@ class DeleteResponseSchema(Schema):
     message: str
 
 
+class BulkItemStatus(Schema):
+    index: int
+    ok: bool
+    id: int | None = None
+    error: str | None = None
+
+
+class RollupSchema(Schema):
+    n_ratings: int
+    n_pass: int
+    n_unsure: int
+    n_fail: int
+    n_source_data_issue: int
+    n_clicks: int
+    n_images: int
+    n_pairs: int
+    n_agreeing_pairs: int
+    agreement: float | None
+
+
+class StepRollupSchema(RollupSchema):
+    step: models.Step
+
+
+class FileRollupSchema(StepRollupSchema):
+    file1: str
+
+
+class SessionRollupSchema(StepRollupSchema):
+    session_id: int
+    session_user: str | None = ninja.Field(None, alias="session.user")
+
+
+class VolumeSchema(ninja.ModelSchema):
+    class Meta:
+        model = models.Volume
+        fields = [
+            "id",
+            "file1",
+            "file2",
+            "step",
+            "affine",
+            "shape",
+            "bbox",
+            "cuts",
+            "quantiles",
+            "created",
+        ]
+
+
+class WorldPointsSchema(Schema):
+    """Clicked points in RAS (mm), one list entry per point."""
+
+    click_id: list[int]
+    image_id: list[int]
+    # format of the image clicked on; see selectors.get_clicked_world_points
+    format: list[models.ImageFormat]
+    x: list[float]
+    y: list[float]
+    z: list[float]
+
+
 class StepFilter(ninja.FilterSchema):
     name: models.Step | None = None
 
@@ -72,6 +152,113 @@ def create_image(request: http.HttpRequest, payload: ImageSchema):
     return {"id": image.pk, "created": image.created}
 
 
+# items are framed by these iterators but parsed by the _parse functions, so
+# that a malformed item is reported on its own instead of ending the stream
+RawItem = typing.Any
+ParsedItem = tuple[dict[str, typing.Any], bytes]
+
+
+def _iter_ndjson(request: http.HttpRequest) -> typing.Iterator[bytes]:
+    for line in request:
+        if line.strip():
+            yield line
+
+
+def _parse_ndjson(line: bytes) -> ParsedItem:
+    meta = orjson.loads(line)
+    if not isinstance(meta, dict) or "img" not in meta:
+        raise ValueError("item is not an object with an img field")
+    return meta, base64.b64decode(meta.pop("img"))
+
+
+def _iter_multipart(
+    request: http.HttpRequest, boundary: str
+) -> typing.Iterator[tuple[bytes | None, bytes]]:
+    """Pairs of a "meta" JSON field followed by an "img" part of raw bytes."""
+    stream = multipartparser.LazyStream(
+        multipartparser.ChunkIter(request, BULK_CHUNK_BYTES)  # type: ignore
+    )
+    meta = None
+    for _, headers, part in multipartparser.Parser(stream, boundary.encode()):
+        name = headers["content-disposition"][1].get("name")
+        if name == "meta":
+            meta = part.read()
+        elif name == "img":
+            yield meta, part.read()
+            meta = None
+
+
+def _parse_multipart(item: tuple[bytes | None, bytes]) -> ParsedItem:
+    raw_meta, img = item
+    if raw_meta is None:
+        raise ValueError("img part without a preceding meta part")
+    meta = orjson.loads(raw_meta)
+    if not isinstance(meta, dict):
+        raise ValueError("meta part is not an object")
+    return meta, img
+
+
+def _to_image(meta: dict[str, typing.Any], img: bytes) -> models.Image:
+    """An unsaved image from validated item fields, or a ValidationError."""
+    fields = BulkImageSchema.model_validate(meta).dict()
+    image = models.Image(img=img, **fields)
+    # choices and lengths of the fields given; the nullable ones are not
+    # blank=True, so clean_fields would refuse their None
+    image.clean_fields(
+        exclude=[
+            field.name
+            for field in models.Image._meta.fields
+            if field.name not in fields or fields[field.name] is None
+        ]
+    )
+    return image
+
+
+def _upsert(batch: list[tuple[int, models.Image]]) -> list[dict[str, typing.Any]]:
+    try:
+        sync.async_to_sync(services.amerge_images)([img for _, img in batch])
+    except Exception as e:
+        return [{"index": i, "ok": False, "error": str(e)} for i, _ in batch]
+    return [{"index": i, "ok": True, "id": img.pk} for i, img in batch]
+
+
+@api.post("/images/bulk/", response=list[BulkItemStatus])
+def bulk_create_images(request: http.HttpRequest):
+    """Create or replace many images from a stream.
+
+    The body is either application/x-ndjson, one BulkImageSchema object with
+    a base64 img per line, or multipart/form-data with a "meta" JSON field
+    (BulkImageSchema) before each "img" part holding the raw image bytes. Items are parsed as
+    they arrive and upserted in batches on the image_meta key.
+    """
+    items: typing.Iterator[RawItem]
+    parse: typing.Callable[[RawItem], ParsedItem]
+    if request.content_type == "multipart/form-data":
+        # Django strips the parameters from content_type
+        boundary = request.content_params.get("boundary")
+        if not boundary:
+            raise errors.HttpError(400, "multipart request without a boundary")
+        items, parse = _iter_multipart(request, boundary), _parse_multipart
+    else:
+        items, parse = _iter_ndjson(request), _parse_ndjson
+
+    statuses: list[dict[str, typing.Any]] = []
+    batch: list[tuple[int, models.Image]] = []
+    for index, item in enumerate(items):
+        try:
+            image = _to_image(*parse(item))
+        except (exceptions.ValidationError, ValueError, TypeError) as e:
+            statuses.append({"index": index, "ok": False, "error": str(e)})
+            continue
+        batch.append((index, image))
+        if len(batch) == BULK_BATCH_SIZE:
+            statuses.extend(_upsert(batch))
+            batch = []
+    if len(batch):
+        statuses.extend(_upsert(batch))
+    return statuses
+
+
 @api.delete("/image/{int:image_id}/", response=DeleteResponseSchema)
 def delete_image(request: http.HttpRequest, image_id: int):
     """Delete a single image by ID"""
@@ -87,7 +274,8 @@ def list_images(
     limit: int = 100,
 ):
     """List images with optional filtering by step"""
-    images = filters.filter(models.Image.objects.all())[:limit]
+    images = list(filters.filter(models.Image.objects.all())[:limit])
+    archive.fill(images)
 
     return [
         {
@@ -108,6 +296,7 @@ def list_images(
 def get_image(request: http.HttpRequest, image_id: int):
     """Get a single image by ID"""
     image = shortcuts.get_object_or_404(models.Image, id=image_id)
+    archive.fill([image])
     return {
         "id": image.pk,
         "slice": image.slice,
@@ -120,6 +309,36 @@ def get_image(request: http.HttpRequest, image_id: int):
     }
 
 
+@api.get("/volumes/", response=list[VolumeSchema])
+def list_volumes(
+    request: http.HttpRequest,
+    filters: StepFilter = ninja.Query(...),  # type: ignore
+    file1: str | None = None,
+    limit: int = 100,
+):
+    """List source volumes with optional filtering by step and file1"""
+    volumes = models.Volume.objects.all()
+    if filters.name is not None:
+        volumes = volumes.filter(step=filters.name)
+    if file1 is not None:
+        volumes = volumes.filter(file1=file1)
+    return volumes.order_by("id")[:limit]
+
+
+@api.get("/clicks/world/", response=WorldPointsSchema)
+def export_world_points(request: http.HttpRequest, step: models.Step):
+    """Export the clicked points of a step in world coordinates"""
+    ids, image_ids, formats, xyz = selectors.get_clicked_world_points(step)
+    return {
+        "click_id": ids.tolist(),
+        "image_id": image_ids.tolist(),
+        "format": formats.tolist(),
+        "x": xyz[:, 0].tolist(),
+        "y": xyz[:, 1].tolist(),
+        "z": xyz[:, 2].tolist(),
+    }
+
+
 @api.get("/ratings/", response=list[RatingSchema])
 def list_ratings(request: http.HttpRequest):
     """List all ratings"""
@@ -136,3 +355,36 @@ def list_ratings(request: http.HttpRequest):
             "created_at",
         )
     )
+
+
+@api.get("/rollups/steps/", response=list[StepRollupSchema])
+def list_step_rollups(request: http.HttpRequest):
+    """Rating counts and pairwise agreement per step"""
+    return models.FileRollup.objects.filter(file1="").order_by("step")
+
+
+@api.get("/rollups/files/", response=list[FileRollupSchema])
+def list_file_rollups(
+    request: http.HttpRequest,
+    filters: StepFilter = ninja.Query(...),  # type: ignore
+    file1: str | None = None,
+):
+    """Rating counts and pairwise agreement per step and file1"""
+    rollups = models.FileRollup.objects.exclude(file1="")
+    if filters.name is not None:
+        rollups = rollups.filter(step=filters.name)
+    if file1 is not None:
+        rollups = rollups.filter(file1=file1)
+    return rollups.order_by("step", "file1")
+
+
+@api.get("/rollups/sessions/", response=list[SessionRollupSchema])
+def list_session_rollups(
+    request: http.HttpRequest,
+    filters: StepFilter = ninja.Query(...),  # type: ignore
+):
+    """Rating counts per session, with agreement against earlier raters"""
+    rollups = models.SessionRollup.objects.select_related("session")
+    if filters.name is not None:
+        rollups = rollups.filter(step=filters.name)
+    return rollups.order_by("session_id")
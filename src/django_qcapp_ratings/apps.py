@@ -5,3 +5,7 @@ class RatingsConfig(AppConfig):
     default_auto_field = "django.db.models.BigAutoField"
     name = "django_qcapp_ratings"
     label = "ratings"
+
+    def ready(self) -> None:
+        # connects the SQLite profile to new connections
+        from django_qcapp_ratings import sqlite  # noqa: F401
@@ -0,0 +1,250 @@
+"""Cold-tier archive for the blobs of images that have enough ratings.
+
+archive() moves blobs out of the Image table and appends them to pack files
+in settings.QCAPP_ARCHIVE_DIR. It only takes images whose rollups count at
+least the target number of ratings. Each blob is compressed on its own, with
+zstandard when it is installed and zlib otherwise. An ArchivedBlob row
+records the pack, offset and length of each blob. Packs are mapped into
+memory for reading, so an archived blob costs a slice of a mapping and not an
+open() per request. restore() moves blobs back into the Image table.
+
+Packs are only ever appended to. The blobs of images that were restored, or
+re-ingested after archiving, stay in them unused. Images that are re-ingested
+get a new blob in the Image table, and reads prefer it over the archive.
+PostgreSQL only returns the emptied space after a VACUUM.
+"""
+
+import fcntl
+import functools
+import mmap
+import os
+import threading
+import typing
+import zlib
+from pathlib import Path
+
+from asgiref import sync
+from django.conf import settings
+from django.core import exceptions
+from django.db import transaction
+from django.db.models import F
+
+from django_qcapp_ratings import models
+
+DEFAULT_BATCH_SIZE = 500
+# a new pack is started once the last one is this large
+DEFAULT_PACK_BYTES = 2**30
+ZSTD_LEVEL = 10
+ZLIB_LEVEL = 9
+PACK_GLOB = "pack-*.qcp"
+
+_maps: dict[Path, mmap.mmap] = {}
+_maps_lock = threading.Lock()
+
+
+def get_archive_dir() -> Path:
+    path = getattr(settings, "QCAPP_ARCHIVE_DIR", None)
+    if path is None:
+        raise exceptions.ImproperlyConfigured("QCAPP_ARCHIVE_DIR is not set")
+    return Path(path)
+
+
+def _compressor() -> tuple[str, typing.Callable[[bytes], bytes]]:
+    try:
+        import zstandard
+    except ImportError:
+        return models.ArchiveCodec.ZLIB, functools.partial(
+            zlib.compress, level=ZLIB_LEVEL
+        )
+    return models.ArchiveCodec.ZSTD, zstandard.ZstdCompressor(ZSTD_LEVEL).compress
+
+
+def _decompress(codec: str, data: bytes) -> bytes:
+    if codec == models.ArchiveCodec.ZSTD:
+        import zstandard
+
+        return zstandard.ZstdDecompressor().decompress(data)
+    return zlib.decompress(data)
+
+
+def _pack_path(directory: Path) -> Path:
+    """The pack to append to: the last one, unless it is full."""
+    packs = sorted(directory.glob(PACK_GLOB))
+    limit = getattr(settings, "QCAPP_ARCHIVE_PACK_BYTES", DEFAULT_PACK_BYTES)
+    if len(packs) and packs[-1].stat().st_size < limit:
+        return packs[-1]
+    n = int(packs[-1].stem.removeprefix("pack-")) + 1 if len(packs) else 0
+    return directory / f"pack-{n:06d}.qcp"
+
+
+def _append(
+    directory: Path, codec: str, blobs: list[tuple[int, bytes]]
+) -> list[models.ArchivedBlob]:
+    """Append compressed blobs to a pack and sync it, returning their index."""
+    path = _pack_path(directory)
+    entries = []
+    with open(path, "ab") as f:
+        # another archiver may be appending to the same pack
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            offset = f.seek(0, os.SEEK_END)
+            for image_id, data in blobs:
+                f.write(data)
+                entries.append(
+                    models.ArchivedBlob(
+                        image_id=image_id,
+                        pack=path.name,
+                        offset=offset,
+                        length=len(data),
+                        codec=codec,
+                    )
+                )
+                offset += len(data)
+            f.flush()
+            os.fsync(f.fileno())
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+    return entries
+
+
+def _mapped(path: Path, end: int) -> mmap.mmap:
+    """A read-only mapping of a pack that extends at least to end."""
+    with _maps_lock:
+        m = _maps.get(path)
+        # the pack may have grown since it was mapped
+        if m is None or len(m) < end:
+            with open(path, "rb") as f:
+                m = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            # a replaced mapping is closed once no reader holds it
+            _maps[path] = m
+        return m
+
+
+def read(blob: models.ArchivedBlob) -> bytes:
+    m = _mapped(get_archive_dir() / blob.pack, blob.offset + blob.length)
+    return _decompress(blob.codec, m[blob.offset : blob.offset + blob.length])
+
+
+def _is_emptied(image: models.Image) -> bool:
+    # the blobs of mosaic tiles are empty too, but they are not archived
+    return not len(image.img) and image.mosaic_id is None
+
+
+def fill(images: typing.Sequence[models.Image]) -> None:
+    """Read the blobs of archived images back into them, in place."""
+    emptied = [image for image in images if _is_emptied(image)]
+    if not len(emptied):
+        return
+    blobs = models.ArchivedBlob.objects.in_bulk([image.pk for image in emptied])
+    for image in emptied:
+        if (blob := blobs.get(image.pk)) is not None:
+            image.img = read(blob)
+
+
+async def afill(image: models.Image) -> models.Image:
+    if not _is_emptied(image):
+        return image
+    blob = await models.ArchivedBlob.objects.filter(image_id=image.pk).afirst()
+    if blob is not None:
+        # page-ins and decompression need not wait for the event loop's thread
+        image.img = await sync.sync_to_async(read, thread_sensitive=False)(blob)
+    return image
+
+
+def archivable(target: int):
+    """Images with at least target ratings whose blob is still in the table."""
+    return (
+        models.Image.objects.filter(mosaic__isnull=True, imagerollup__isnull=False)
+        .exclude(img=b"")
+        .alias(
+            n_ratings=F("imagerollup__n_pass")
+            + F("imagerollup__n_unsure")
+            + F("imagerollup__n_fail")
+            + F("imagerollup__n_clicks")
+        )
+        .filter(n_ratings__gte=target)
+    )
+
+
+def archive(target: int, batch_size: int = DEFAULT_BATCH_SIZE) -> int:
+    """Move the blobs of images with at least target ratings into the packs.
+
+    Counts come from the rollups, so refresh them first. Returns the number of
+    images archived.
+    """
+    codec, compress = _compressor()
+    directory = get_archive_dir()
+    directory.mkdir(parents=True, exist_ok=True)
+    n = 0
+    while True:
+        # the pack is synced before the index commits, so that no index row
+        # points at bytes that were lost
+        with transaction.atomic():
+            batch = list(
+                archivable(target)
+                .select_for_update(of=("self",))
+                .order_by("pk")
+                .values_list("pk", "img")[:batch_size]
+            )
+            if not len(batch):
+                break
+            entries = _append(
+                directory, codec, [(pk, compress(bytes(img))) for pk, img in batch]
+            )
+            models.ArchivedBlob.objects.bulk_create(
+                entries,
+                update_conflicts=True,
+                update_fields=["pack", "offset", "length", "codec", "created"],
+                unique_fields=["image"],
+            )
+            # select_for_update locks nothing on SQLite: a blob re-ingested since
+            # it was read is kept, and its stale entry dropped, so that the next
+            # batch archives the new one
+            replaced = [
+                pk
+                for pk, img in batch
+                if not models.Image.objects.filter(pk=pk, img=bytes(img)).update(
+                    img=b""
+                )
+            ]
+            models.ArchivedBlob.objects.filter(image_id__in=replaced).delete()
+        n += len(batch) - len(replaced)
+    return n
+
+
+def restore(
+    image_ids: typing.Sequence[int] | None = None,
+    batch_size: int = DEFAULT_BATCH_SIZE,
+) -> int:
+    """Move archived blobs (all, or those of image_ids) back into the table.
+
+    Returns the number of index rows removed.
+    """
+    archived = models.ArchivedBlob.objects.all()
+    if image_ids is not None:
+        archived = archived.filter(image_id__in=image_ids)
+    n = 0
+    while True:
+        with transaction.atomic():
+            blobs = list(archived.select_for_update().order_by("pk")[:batch_size])
+            if not len(blobs):
+                break
+            # images re-ingested since they were archived keep their new blob
+            emptied = set(
+                models.Image.objects.filter(
+                    pk__in=[blob.pk for blob in blobs], img=b""
+                ).values_list("pk", flat=True)
+            )
+            models.Image.objects.bulk_update(
+                [
+                    models.Image(pk=blob.pk, img=read(blob))
+                    for blob in blobs
+                    if blob.pk in emptied
+                ],
+                ["img"],
+            )
+            models.ArchivedBlob.objects.filter(
+                pk__in=[blob.pk for blob in blobs]
+            ).delete()
+        n += len(blobs)
+    return n
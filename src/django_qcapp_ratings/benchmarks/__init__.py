@@ -0,0 +1,4 @@
+"""Synthetic data and timing helpers for benchmarking the app.
+
+Nothing here is used when serving requests.
+"""
@@ -0,0 +1,126 @@
+import asyncio
+import logging
+import os
+import threading
+import time
+import typing
+
+from django import db
+
+from django_qcapp_ratings import models, services, sqlite
+from django_qcapp_ratings.benchmarks import load, seed, stats
+from django_qcapp_ratings.management.commands import _ingest
+
+# about the size of a rendered PNG
+IMAGE_BYTES = 100 * 2**10
+# for the background runs that requests started (e.g., refresh_rollups)
+BACKGROUND_TIMEOUT_SEC = 60
+
+
+class ErrorLog(logging.Handler):
+    """Collects errors that are only logged, such as failed background runs."""
+
+    def __init__(self) -> None:
+        super().__init__(logging.ERROR)
+        self.errors: list[str] = []
+
+    def emit(self, record: logging.LogRecord) -> None:
+        message = f"{record.name}: {record.getMessage()}"
+        if record.exc_info is not None and record.exc_info[1] is not None:
+            message += f" ({record.exc_info[1]!r})"
+        self.errors.append(message)
+
+
+def _volume(step: models.Step, i: int, image_bytes: int) -> list[models.Image]:
+    """The figures of one synthetic source file, as ingestion upserts them."""
+    return [
+        models.Image(
+            img=os.urandom(image_bytes),
+            slice=cut,
+            display=display,
+            step=step,
+            file1=f"{seed.SYNTHETIC_PREFIX}ingest-{i:07d}",
+        )
+        for display in models.DisplayMode.values
+        for cut in range(seed.N_CUTS)
+    ]
+
+
+def ingest(
+    step: models.Step, stop: threading.Event, image_bytes: int = IMAGE_BYTES
+) -> dict[str, typing.Any]:
+    """Upsert volumes through the ingestion writer until stop is set."""
+    samples: list[float] = []
+
+    async def timed_merge(images: list[models.Image]) -> None:
+        start = time.perf_counter()
+        await services.amerge_images(images)
+        samples.append(time.perf_counter() - start)
+
+    i = 0
+    with _ingest.Writer() as writer:
+        while not stop.is_set():
+            writer.submit(timed_merge, _volume(step, i, image_bytes))
+            i += 1
+    return {
+        "volumes": i,
+        "images_per_volume": len(models.DisplayMode.values) * seed.N_CUTS,
+        "batch_write": stats.summarize(samples),
+    }
+
+
+def run(
+    steps: typing.Sequence[models.Step],
+    n_raters: int,
+    cycles: int,
+    image_bytes: int = IMAGE_BYTES,
+) -> dict[str, typing.Any]:
+    """Drive simulated raters while an ingestion writes to the same database."""
+    stop = threading.Event()
+    ingested: dict[str, typing.Any] = {}
+
+    def ingest_until_stopped() -> None:
+        try:
+            ingested.update(ingest(steps[0], stop, image_bytes=image_bytes))
+        except Exception as e:
+            ingested["error"] = repr(e)
+        finally:
+            db.connections.close_all()
+
+    error_log = ErrorLog()
+    logging.getLogger().addHandler(error_log)
+    thread = threading.Thread(target=ingest_until_stopped)
+    thread.start()
+    try:
+        raters = asyncio.run(load.run(steps, n_raters=n_raters, cycles=cycles))
+    finally:
+        stop.set()
+        thread.join()
+        background_done = services.join_background(BACKGROUND_TIMEOUT_SEC)
+        logging.getLogger().removeHandler(error_log)
+    return {
+        "vendor": db.connection.vendor,
+        "sqlite_profile": sqlite.enabled(),
+        "raters": raters,
+        "ingest": ingested,
+        "background_done": background_done,
+        "logged_errors": error_log.errors,
+    }
+
+
+def violations(report: dict[str, typing.Any], max_p99_ms: float) -> list[str]:
+    """Rater endpoints that failed requests or were slower than max_p99_ms, and
+    errors that were only logged (e.g., "database is locked" in a background
+    refresh)."""
+    found = []
+    if "error" in report["ingest"]:
+        found.append(f"ingestion failed: {report['ingest']['error']}")
+    if not report["background_done"]:
+        found.append(f"background runs still going after {BACKGROUND_TIMEOUT_SEC} s")
+    found += [f"logged: {error}" for error in report["logged_errors"]]
+    for name, summary in report["raters"]["endpoints"].items():
+        if summary["errors"]:
+            found.append(f"{name}: {summary['errors']} failed requests")
+        if summary["p99_ms"] > max_p99_ms:
+            found.append(f"{name}: p99 {summary['p99_ms']:.0f} ms > {max_p99_ms} ms")
+    return found
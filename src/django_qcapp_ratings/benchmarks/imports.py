@@ -0,0 +1,73 @@
+import pkgutil
+import re
+import subprocess
+import sys
+import typing
+
+from django_qcapp_ratings.benchmarks import stats
+from django_qcapp_ratings.management import commands
+
+# "import time: self [us] | cumulative | imported package", one line per module
+IMPORTTIME = re.compile(r"^import time:\s+(\d+) \|\s+(\d+) \|\s*(\S+)$")
+ENTRY_POINTS = [
+    "django_qcapp_ratings.urls",
+    "django_qcapp_ratings.views",
+    "django_qcapp_ratings.api",
+]
+
+
+def default_modules() -> list[str]:
+    """The management commands, as loaded by manage.py, and the web entry points."""
+    return [
+        f"{commands.__name__}.{info.name}"
+        for info in pkgutil.iter_modules(commands.__path__)
+        if not info.name.startswith("_")
+    ] + ENTRY_POINTS
+
+
+def import_times(module: str) -> dict[str, tuple[int, int]]:
+    """Self and cumulative import time (µs) of every module that importing
+    module loads, in a fresh interpreter with Django already set up."""
+    # django.setup() runs first, so what it loads is not counted for module
+    code = f"import django; django.setup(); import {module}"
+    proc = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", code],
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    times = {}
+    for line in proc.stderr.splitlines():
+        if match := IMPORTTIME.match(line):
+            self_us, cumulative_us, name = match.groups()
+            times[name] = (int(self_us), int(cumulative_us))
+    return times
+
+
+def benchmark(module: str, runs: int = 5, top: int = 10) -> dict[str, typing.Any]:
+    """Median cold import time of a module and of its heaviest dependencies."""
+    samples = [import_times(module) for _ in range(runs)]
+    cumulative = [times.get(module, (0, 0))[1] / 1e6 for times in samples]
+    self_us: dict[str, list[int]] = {}
+    for times in samples:
+        for name, (us, _) in times.items():
+            self_us.setdefault(name, []).append(us)
+    heaviest = sorted(
+        ((name, stats.percentile(us, 50)) for name, us in self_us.items()),
+        key=lambda item: item[1],
+        reverse=True,
+    )[:top]
+    return {
+        "seconds": stats.summarize(cumulative),
+        "modules_loaded": max(len(times) for times in samples),
+        "heaviest_self_ms": {name: us / 1000 for name, us in heaviest},
+    }
+
+
+def run(
+    modules: typing.Sequence[str] | None = None, runs: int = 5, top: int = 10
+) -> dict[str, typing.Any]:
+    return {
+        module: benchmark(module, runs=runs, top=top)
+        for module in (modules or default_modules())
+    }
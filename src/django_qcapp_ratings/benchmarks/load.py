@@ -0,0 +1,136 @@
+import asyncio
+import collections
+import contextlib
+import contextvars
+import json
+import random
+import time
+import typing
+
+from asgiref import sync
+from django import http, test, urls
+
+from django_qcapp_ratings import models, selectors, views
+from django_qcapp_ratings.benchmarks import stats
+
+_thread_hops: contextvars.ContextVar[list[int] | None] = contextvars.ContextVar(
+    "thread_hops", default=None
+)
+
+
+@contextlib.contextmanager
+def count_thread_hops() -> typing.Iterator[None]:
+    """Count sync_to_async calls (hops to a worker thread) per request.
+
+    Django's async ORM still hops for each query, so only the hops made by
+    sync views, sync middleware and blocking calls are avoidable.
+    """
+    original = sync.SyncToAsync.__call__
+
+    async def counting(self, *args, **kwargs):
+        hops = _thread_hops.get()
+        if hops is not None:
+            hops[0] += 1
+        return await original(self, *args, **kwargs)
+
+    sync.SyncToAsync.__call__ = counting  # type: ignore
+    try:
+        yield
+    finally:
+        sync.SyncToAsync.__call__ = original  # type: ignore
+
+
+class Recorder:
+    def __init__(self) -> None:
+        self.samples: dict[str, list[float]] = collections.defaultdict(list)
+        self.hops: dict[str, list[int]] = collections.defaultdict(list)
+        self.errors: collections.Counter[str] = collections.Counter()
+
+    async def timed(
+        self, name: str, request: typing.Awaitable[http.HttpResponse]
+    ) -> http.HttpResponse:
+        hops = [0]
+        token = _thread_hops.set(hops)
+        start = time.perf_counter()
+        try:
+            response = await request
+        finally:
+            _thread_hops.reset(token)
+        self.samples[name].append(time.perf_counter() - start)
+        self.hops[name].append(hops[0])
+        failed = response.status_code >= 400
+        # a partial that found no image still answers 200
+        failed |= views.ISSUE_MESSAGE.encode() in getattr(response, "content", b"")
+        if failed:
+            self.errors[name] += 1
+        return response
+
+    def report(self, wall_sec: float) -> dict[str, typing.Any]:
+        return {
+            name: {
+                **stats.summarize(samples),
+                "errors": self.errors[name],
+                "throughput_per_sec": len(samples) / wall_sec,
+                "thread_hops_mean": sum(self.hops[name]) / len(self.hops[name]),
+            }
+            for name, samples in self.samples.items()
+        }
+
+
+def _submission(step: models.Step, rng: random.Random) -> dict[str, str]:
+    if selectors.get_related_from_step(step) == "rating":
+        return {"rating": str(rng.choice(models.Ratings.values)), "comments": ""}
+    points = [
+        {"x": rng.uniform(0, 640), "y": rng.uniform(0, 480)}
+        for _ in range(rng.randint(0, 3))
+    ]
+    return {"points": json.dumps(points), "comments": ""}
+
+
+async def rater(
+    step: models.Step, cycles: int, recorder: Recorder, rng: random.Random
+) -> None:
+    """One simulated rater: pick a step, then rate cycles images."""
+    client = test.AsyncClient()
+    response = await recorder.timed(
+        "POST index", client.post(urls.reverse("index"), {"step": step.value})
+    )
+    view = response["Location"]
+    if selectors.get_related_from_step(step) == "rating":
+        partial = urls.reverse(views.RATE_PARTIAL)
+    else:
+        partial = urls.reverse(views.CLICK_PARTIAL)
+
+    await recorder.timed(f"GET {view}", client.get(view))
+    await recorder.timed(f"GET {partial}", client.get(partial))
+    for _ in range(cycles):
+        await recorder.timed(f"POST {view}", client.post(view, _submission(step, rng)))
+        await recorder.timed(f"GET {partial}", client.get(partial))
+
+
+async def run(
+    steps: typing.Sequence[models.Step],
+    n_raters: int,
+    cycles: int,
+    seed: int = 0,
+) -> dict[str, typing.Any]:
+    """Drive n_raters concurrent raters per step and summarize latencies."""
+    recorder = Recorder()
+    rng = random.Random(seed)
+    with count_thread_hops():
+        start = time.perf_counter()
+        await asyncio.gather(
+            *(
+                rater(step, cycles, recorder, random.Random(rng.random()))
+                for step in steps
+                for _ in range(n_raters)
+            )
+        )
+        wall_sec = time.perf_counter() - start
+    return {
+        "steps": [step.name for step in steps],
+        "raters_per_step": n_raters,
+        "cycles": cycles,
+        "wall_sec": wall_sec,
+        "endpoints": recorder.report(wall_sec),
+    }
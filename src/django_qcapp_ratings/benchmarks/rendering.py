@@ -0,0 +1,191 @@
+import time
+import tracemalloc
+import typing
+
+import nibabel as nb
+import numpy as np
+
+from django_qcapp_ratings import models
+from django_qcapp_ratings.benchmarks import stats
+from django_qcapp_ratings.management.commands import _private, _slices
+from django_qcapp_ratings.management.commands._dtifit import get_dtifit
+from django_qcapp_ratings.management.commands._fmap_coregistration import (
+    get_fmap_coregistration,
+)
+from django_qcapp_ratings.management.commands._mask import get_mask
+from django_qcapp_ratings.management.commands._spatial_normalization import (
+    get_spatial_normalization,
+)
+from django_qcapp_ratings.management.commands._surface_localization import (
+    get_surface_localization,
+)
+
+T1_SHAPE = (193, 229, 193)  # 1 mm MNI152NLin2009cAsym
+BOLD_SHAPE = (97, 115, 97)  # 2 mm
+DWI_SHAPE = (96, 114, 96)  # 2 mm
+
+
+def _affine(shape: tuple[int, ...], zoom: float) -> np.ndarray:
+    affine = np.diag([zoom, zoom, zoom, 1.0])
+    affine[:3, 3] = -np.array(shape[:3]) * zoom / 2
+    return affine
+
+
+def _ellipsoid(shape: tuple[int, ...], scale: float = 0.8) -> np.ndarray:
+    """Distance from the centre, normalized so that 1 is the ellipsoid's surface."""
+    grid = np.ogrid[tuple(slice(0, n) for n in shape[:3])]
+    return np.sqrt(
+        sum(((g - n / 2) / (scale * n / 2)) ** 2 for g, n in zip(grid, shape))
+    )
+
+
+def synthetic_volumes(seed: int = 0) -> dict[str, nb.nifti1.Nifti1Image]:
+    """Volumes with the sizes and value ranges of real inputs, but no anatomy."""
+    rng = np.random.default_rng(seed)
+    t1_r = _ellipsoid(T1_SHAPE)
+    t1 = np.where(t1_r < 1, 1 - 0.5 * t1_r, 0) * 1000 + rng.normal(0, 20, T1_SHAPE)
+    bold_r = _ellipsoid(BOLD_SHAPE)
+    bold = np.where(bold_r < 1, 800, 50) + rng.normal(0, 40, BOLD_SHAPE)
+    # FreeSurfer labels: 2 / 41 white matter, 3 / 42 cortex
+    ribbon = np.select([t1_r < 0.7, t1_r < 0.8], [2, 3], 0)
+    dwi_r = _ellipsoid(DWI_SHAPE)
+    fa = np.clip(np.where(dwi_r < 1, rng.uniform(0, 1, DWI_SHAPE), 0), 0, 1)
+    v1 = rng.normal(size=(*DWI_SHAPE, 3))
+    v1 /= np.linalg.norm(v1, axis=-1, keepdims=True)
+
+    t1_affine = _affine(T1_SHAPE, 1.0)
+    bold_affine = _affine(BOLD_SHAPE, 2.0)
+    dwi_affine = _affine(DWI_SHAPE, 2.0)
+    return {
+        "t1": nb.nifti1.Nifti1Image(t1.astype(np.float32), t1_affine),
+        "t1_mask": nb.nifti1.Nifti1Image((t1_r < 1).astype(np.uint8), t1_affine),
+        "ribbon": nb.nifti1.Nifti1Image(ribbon.astype(np.int16), t1_affine),
+        "bold": nb.nifti1.Nifti1Image(bold.astype(np.float32), bold_affine),
+        "bold_mask": nb.nifti1.Nifti1Image((bold_r < 1).astype(np.uint8), bold_affine),
+        "fa": nb.nifti1.Nifti1Image(fa.astype(np.float32), dwi_affine),
+        "v1": nb.nifti1.Nifti1Image(v1.astype(np.float32), dwi_affine),
+    }
+
+
+def renderers(
+    volumes: dict[str, nb.nifti1.Nifti1Image],
+) -> dict[str, typing.Callable[[], typing.Any]]:
+    """One representative figure per rendering function, as it returns it."""
+    axial = models.DisplayMode(models.DisplayMode.Z)
+    return {
+        "get_mask": lambda: get_mask(
+            cut=3,
+            file_nii=volumes["t1"],
+            mask_nii=volumes["t1_mask"],
+            display_mode=axial,
+        ),
+        "get_surface_localization": lambda: get_surface_localization(
+            cut=3,
+            brain_nii=volumes["t1"],
+            ribbon_nii=volumes["ribbon"],
+            display_mode=axial,
+        ),
+        "get_spatial_normalization": lambda: get_spatial_normalization(
+            cut=1, file_nii=volumes["t1"], display_mode=axial
+        ),
+        "get_fmap_coregistration": lambda: get_fmap_coregistration(
+            cut=3,
+            mask_nii=volumes["bold_mask"],
+            file_nii=volumes["bold"],
+            file2_nii=volumes["bold"],
+            display_mode=axial,
+        ),
+        "get_dtifit": lambda: get_dtifit(nii=volumes["fa"], v1=volumes["v1"]),
+        "get_mask_slices": lambda: next(
+            _slices.get_mask_slices(
+                volumes["t1"], volumes["t1_mask"], [(3, axial.value)]
+            )
+        )[1:],
+        "get_surface_localization_slices": lambda: next(
+            _slices.get_surface_localization_slices(
+                volumes["t1"], volumes["ribbon"], [(3, axial.value)]
+            )
+        )[1:],
+    }
+
+
+def _split(result: typing.Any) -> tuple[bytes, list[list[float]] | None]:
+    """The image of a renderer's result, and its pixel affine if it has one."""
+    return (result, None) if isinstance(result, bytes) else result
+
+
+def check(render: typing.Callable[[], typing.Any]) -> str | None:
+    """Render once and return what is wrong with the result, if anything."""
+    try:
+        img, affine = _split(render())
+    except Exception as e:
+        return repr(e)
+    if not len(img):
+        return "empty image"
+    if affine is not None:
+        matrix = np.asarray(affine, dtype=np.float64)
+        if matrix.shape != (4, 4) or not np.isfinite(matrix).all():
+            return f"invalid pixel affine {affine}"
+        if not np.allclose(matrix[3], [0, 0, 0, 1]):
+            return f"pixel affine is not affine: {affine}"
+    return None
+
+
+def benchmark(
+    render: typing.Callable[[], typing.Any], repeats: int = 5
+) -> dict[str, typing.Any]:
+    """Time a renderer, then measure its peak memory in one traced call.
+
+    Tracing slows allocation-heavy code, so it is kept out of the timed calls.
+    """
+    render()  # warm up caches and lazy imports
+    samples = []
+    stages: dict[str, list[float]] = {}
+    for _ in range(repeats):
+        with _private.record_stages() as times:
+            start = time.perf_counter()
+            img, _ = _split(render())
+            samples.append(time.perf_counter() - start)
+        for name, sec in times.items():
+            stages.setdefault(name, []).append(sec)
+
+    tracemalloc.start()
+    try:
+        render()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    return {
+        "seconds": stats.summarize(samples),
+        "stages_mean_ms": {
+            name: 1000 * sum(secs) / repeats for name, secs in stages.items()
+        },
+        "peak_mib": peak / 2**20,
+        "output_bytes": len(img),
+    }
+
+
+def _selected(
+    functions: typing.Sequence[str] | None,
+) -> dict[str, typing.Callable[[], typing.Any]]:
+    available = renderers(synthetic_volumes())
+    return {
+        name: render
+        for name, render in available.items()
+        if not functions or name in functions
+    }
+
+
+def run(
+    functions: typing.Sequence[str] | None = None, repeats: int = 5
+) -> dict[str, typing.Any]:
+    return {
+        name: benchmark(render, repeats=repeats)
+        for name, render in _selected(functions).items()
+    }
+
+
+def smoke(functions: typing.Sequence[str] | None = None) -> dict[str, str | None]:
+    """Render one figure with each function: the problem found, or None."""
+    return {name: check(render) for name, render in _selected(functions).items()}
@@ -0,0 +1,109 @@
+import base64
+import itertools
+import random
+import typing
+
+from django_qcapp_ratings import models, selectors, services
+
+BATCH_SIZE = 5_000
+N_CUTS = 7
+SYNTHETIC_PREFIX = "synthetic-"
+# 1x1 pixel, so that views have something to decode and render
+PLACEHOLDER_PNG = base64.b64decode(
+    "iVBORw0KGgoAAAANSUhEUgAAAAEAAAABCAQAAAC1HAwCAAAAC0lEQVR42mNkYAAAAAYAAjCB0C8AAAAASUVORK5CYII="
+)
+
+
+def _batched(objs: typing.Iterable, n: int = BATCH_SIZE) -> typing.Iterator[list]:
+    it = iter(objs)
+    while batch := list(itertools.islice(it, n)):
+        yield batch
+
+
+def seed_images(step: models.Step, n: int, img: bytes = PLACEHOLDER_PNG) -> list[int]:
+    """Create n placeholder images for a step, 21 per synthetic source file."""
+    n_displays = len(models.DisplayMode.values)
+    objs = (
+        models.Image(
+            img=img,
+            slice=i % N_CUTS,
+            display=(i // N_CUTS) % n_displays,
+            step=step,
+            file1=f"{SYNTHETIC_PREFIX}{i // (N_CUTS * n_displays):07d}",
+        )
+        for i in range(n)
+    )
+    for batch in _batched(objs):
+        models.Image.objects.bulk_create(batch)
+    return list(
+        models.Image.objects.filter(
+            step=step, file1__startswith=SYNTHETIC_PREFIX
+        ).values_list("id", flat=True)
+    )
+
+
+def seed_ratings(
+    step: models.Step,
+    image_ids: typing.Sequence[int],
+    ratings_per_image: float,
+    n_sessions: int = 10,
+    seed: int = 0,
+) -> int:
+    """Spread about ratings_per_image ratings (or clicks) over each image."""
+    rng = random.Random(seed)
+    sessions = models.Session.objects.bulk_create(
+        [
+            models.Session(step=step, user=f"{SYNTHETIC_PREFIX}{i}")
+            for i in range(n_sessions)
+        ]
+    )
+    n = round(len(image_ids) * ratings_per_image)
+    if selectors.get_related_from_step(step) == "rating":
+        objs = (
+            models.Rating(
+                image_id=rng.choice(image_ids),
+                session=rng.choice(sessions),
+                rating=rng.choice(models.Ratings.values),
+                source_data_issue=rng.random() < 0.05,
+            )
+            for _ in range(n)
+        )
+        model = models.Rating
+    else:
+        objs = (
+            models.ClickedCoordinate(
+                image_id=rng.choice(image_ids),
+                session=rng.choice(sessions),
+                points=models.pack_points(
+                    [
+                        {"x": rng.uniform(0, 640), "y": rng.uniform(0, 480)}
+                        for _ in range(rng.randint(0, 3))
+                    ]
+                ),
+                source_data_issue=rng.random() < 0.05,
+            )
+            for _ in range(n)
+        )
+        model = models.ClickedCoordinate
+    for batch in _batched(objs):
+        model.objects.bulk_create(batch)
+    return n
+
+
+def prepare_serving(steps: typing.Iterable[models.Step]) -> None:
+    """Count the seeded rows and build the image queues, as in production.
+
+    Without them, requests are served by the fallback count query.
+    """
+    # nothing else writes while seeding, so no gap in the ids is pending
+    services.rebuild_rollups(gap_seconds=0)
+    for step in steps:
+        services.refresh_image_order(step)
+
+
+def delete_synthetic() -> None:
+    """Remove everything created by this module, and recount the rollups."""
+    models.Image.objects.filter(file1__startswith=SYNTHETIC_PREFIX).delete()
+    models.Session.objects.filter(user__startswith=SYNTHETIC_PREFIX).delete()
+    # file and step totals would still count the synthetic rows
+    services.rebuild_rollups(gap_seconds=0)
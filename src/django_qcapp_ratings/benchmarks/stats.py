@@ -0,0 +1,24 @@
+import math
+import typing
+
+
+def percentile(samples: typing.Sequence[float], q: float) -> float:
+    """Nearest-rank percentile, q in [0, 100]."""
+    ordered = sorted(samples)
+    rank = max(math.ceil(q / 100 * len(ordered)) - 1, 0)
+    return ordered[rank]
+
+
+def summarize(samples_sec: typing.Sequence[float]) -> dict[str, float]:
+    """Latency summary in milliseconds."""
+    if not len(samples_sec):
+        return {"n": 0}
+    ms = [s * 1000 for s in samples_sec]
+    return {
+        "n": len(ms),
+        "mean_ms": sum(ms) / len(ms),
+        "p50_ms": percentile(ms, 50),
+        "p95_ms": percentile(ms, 95),
+        "p99_ms": percentile(ms, 99),
+        "max_ms": max(ms),
+    }
@@ -0,0 +1,161 @@
+"""In-process timing of the hot path.
+
+Spans are aggregated into histograms served in the Prometheus text format by
+the metrics view, and the spans of each request are reported back in its
+Server-Timing header when the middleware is enabled:
+
+    MIDDLEWARE = [
+        "django_qcapp_ratings.instrumentation.server_timing_middleware",
+        ...
+    ]
+
+Histograms live in the memory of each process, so every web (or Celery)
+worker reports its own. The metrics view is only served to staff users and
+to requests carrying "Authorization: Bearer <settings.QCAPP_METRICS_TOKEN>".
+"""
+
+import contextlib
+import contextvars
+import functools
+import inspect
+import threading
+import time
+import typing
+
+from django import http
+from django.utils import decorators
+
+BUCKETS_SEC = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+METRIC = "qcapp_span_seconds"
+PACKAGE = "django_qcapp_ratings."
+
+
+class Histogram:
+    def __init__(self) -> None:
+        self.bucket_counts = [0] * len(BUCKETS_SEC)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, seconds: float) -> None:
+        for i, bound in enumerate(BUCKETS_SEC):
+            if seconds <= bound:
+                self.bucket_counts[i] += 1
+        self.count += 1
+        self.sum += seconds
+
+
+_lock = threading.Lock()
+_histograms: dict[str, Histogram] = {}
+_request_spans: contextvars.ContextVar[list[tuple[str, float]] | None] = (
+    contextvars.ContextVar("request_spans", default=None)
+)
+
+
+def observe(name: str, seconds: float) -> None:
+    with _lock:
+        _histograms.setdefault(name, Histogram()).observe(seconds)
+    spans = _request_spans.get()
+    if spans is not None:
+        spans.append((name, seconds))
+
+
+@contextlib.contextmanager
+def span(name: str) -> typing.Iterator[None]:
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe(name, time.perf_counter() - start)
+
+
+def traced(name: str | None = None):
+    """Time every call of a (sync or async) function as a span."""
+
+    def decorator(func):
+        module = func.__module__.removeprefix(PACKAGE)
+        span_name = name or f"{module}.{func.__qualname__}"
+
+        if inspect.iscoroutinefunction(func):
+
+            @functools.wraps(func)
+            async def async_wrapper(*args, **kwargs):
+                with span(span_name):
+                    return await func(*args, **kwargs)
+
+            return async_wrapper
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with span(span_name):
+                return func(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+def render_prometheus() -> str:
+    lines = [
+        f"# HELP {METRIC} Time spent in instrumented code.",
+        f"# TYPE {METRIC} histogram",
+    ]
+    with _lock:
+        for name, hist in sorted(_histograms.items()):
+            for bound, count in zip(BUCKETS_SEC, hist.bucket_counts):
+                lines.append(f'{METRIC}_bucket{{span="{name}",le="{bound}"}} {count}')
+            lines.append(f'{METRIC}_bucket{{span="{name}",le="+Inf"}} {hist.count}')
+            lines.append(f'{METRIC}_sum{{span="{name}"}} {hist.sum}')
+            lines.append(f'{METRIC}_count{{span="{name}"}} {hist.count}')
+    return "\n".join(lines) + "\n"
+
+
+def _server_timing(spans: list[tuple[str, float]]) -> str:
+    totals: dict[str, float] = {}
+    for name, seconds in spans:
+        totals[name] = totals.get(name, 0.0) + seconds
+    return ", ".join(f"{name};dur={1000 * sec:.1f}" for name, sec in totals.items())
+
+
+def _finish(
+    request: http.HttpRequest,
+    response: http.HttpResponse,
+    spans: list[tuple[str, float]],
+    start: float,
+) -> None:
+    match = request.resolver_match
+    name = f"request.{match.url_name if match else 'unresolved'}"
+    duration = time.perf_counter() - start
+    observe(name, duration)
+    spans.append((name, duration))
+    response.headers["Server-Timing"] = _server_timing(spans)
+
+
+@decorators.sync_and_async_middleware
+def server_timing_middleware(get_response):
+    if inspect.iscoroutinefunction(get_response):
+
+        async def async_middleware(request: http.HttpRequest):
+            spans: list[tuple[str, float]] = []
+            token = _request_spans.set(spans)
+            start = time.perf_counter()
+            try:
+                response = await get_response(request)
+            finally:
+                _request_spans.reset(token)
+            _finish(request, response, spans, start)
+            return response
+
+        return async_middleware
+
+    def middleware(request: http.HttpRequest):
+        spans: list[tuple[str, float]] = []
+        token = _request_spans.set(spans)
+        start = time.perf_counter()
+        try:
+            response = get_response(request)
+        finally:
+            _request_spans.reset(token)
+        _finish(request, response, spans, start)
+        return response
+
+    return middleware
@@ -0,0 +1,86 @@
+import json
+import logging
+import typing as t
+from concurrent import futures
+from pathlib import Path
+
+import typer
+
+Entry = dict[str, str]
+
+Threads = t.Annotated[
+    int, typer.Option(help="Number of subject directories to search concurrently")
+]
+Manifest = t.Annotated[
+    Path | None,
+    typer.Option(
+        dir_okay=False, help="Cache discovered files here and reuse them on reruns"
+    ),
+]
+RefreshManifest = t.Annotated[
+    bool, typer.Option(help="Ignore an existing --manifest and search again")
+]
+
+
+def _walk(
+    subject_dirs: t.Iterable[Path],
+    find: t.Callable[[Path], list[Entry]],
+    threads: int,
+) -> t.Iterator[Entry]:
+    with futures.ThreadPoolExecutor(max_workers=threads) as pool:
+        pending = [pool.submit(find, d) for d in subject_dirs]
+        for future in futures.as_completed(pending):
+            yield from future.result()
+
+
+def _read_key(manifest: Path) -> object:
+    with manifest.open() as f:
+        header = json.loads(f.readline() or "null")
+    return header.get("key") if isinstance(header, dict) else None
+
+
+def discover(
+    subject_dirs: t.Iterable[Path],
+    find: t.Callable[[Path], list[Entry]],
+    threads: int = 8,
+    manifest: Path | None = None,
+    refresh: bool = False,
+    key: dict[str, t.Any] | None = None,
+) -> t.Iterator[Entry]:
+    """Run find over each subject directory concurrently.
+
+    Entries are yielded as soon as their subject directory has been searched, so
+    consumers can start rendering while discovery continues. When a manifest is
+    given, entries are read from it if it exists and written to it otherwise.
+    The manifest only appears once discovery has finished, so an interrupted
+    run is never mistaken for a complete one.
+
+    key should hold every argument that decides which files are found (the
+    subjects directory, include/exclude filters and so on). It is stored in the
+    manifest's first line, and a manifest written with a different key is
+    ignored and replaced rather than reused.
+    """
+    key = json.loads(json.dumps(key or {}))
+    if manifest is not None and manifest.exists() and not refresh:
+        if _read_key(manifest) == key:
+            logging.info(f"Using existing manifest {manifest}")
+            with manifest.open() as f:
+                next(f)
+                for line in f:
+                    yield json.loads(line)
+            return
+        logging.info(f"Manifest {manifest} was written for other arguments, ignoring")
+
+    entries = _walk(subject_dirs, find=find, threads=threads)
+    if manifest is None:
+        yield from entries
+        return
+
+    partial = manifest.with_name(f"{manifest.name}.partial")
+    with partial.open("w") as f:
+        f.write(json.dumps({"key": key}) + "\n")
+        for entry in entries:
+            f.write(json.dumps(entry) + "\n")
+            yield entry
+    partial.replace(manifest)
+    logging.info(f"Wrote manifest {manifest}")
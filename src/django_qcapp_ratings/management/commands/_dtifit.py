@@ -0,0 +1,84 @@
+import tempfile
+from pathlib import Path
+
+import imageio.v3 as iio
+import nibabel as nb
+import numpy as np
+import numpy.typing as npt
+import pygifsicle
+
+from . import _figures, _private
+
+N_CUTS = 20
+
+
+def color_fa(
+    fa: npt.NDArray[np.float32], evec: npt.NDArray[np.float32]
+) -> npt.NDArray[np.float32]:
+    """Color FA of a slab of axial slices, from FA and V1 (..., 3) alone.
+
+    As dipy's dti.color_fa, which only uses the principal eigenvector (V1).
+    """
+    return np.abs(evec) * np.clip(fa, 0, 1)[..., None]
+
+
+def load_fa(nii: nb.nifti1.Nifti1Image) -> npt.NDArray[np.float32]:
+    return np.asanyarray(nii.dataobj, dtype=np.float32)
+
+
+def get_dtifit(
+    nii: nb.nifti1.Nifti1Image,
+    v1: nb.nifti1.Nifti1Image,
+    figsize: tuple[float, float] = (6.4, 4.8),
+    fa: npt.NDArray[np.float32] | None = None,
+) -> bytes:
+    """Animated color FA through the axial cuts of the brain.
+
+    fa is the data of nii, if it was already loaded (see load_fa).
+    """
+    with _private.stage("cuts"):
+        if fa is None:
+            fa = load_fa(nii)
+        mask_nii = nb.nifti1.Nifti1Image((fa > 0.0001).astype(np.uint8), nii.affine)
+        ks = (
+            _private.cuts_from_bbox_ijk(mask_nii, cuts=N_CUTS)[2]
+            .round()
+            .astype(np.uint16)
+        )
+
+    with _private.stage("color_fa"):
+        # V1 is read once for the slab that holds every cut, as each read of a
+        # compressed volume inflates it from the start
+        k0, k1 = int(ks.min()), int(ks.max()) + 1
+        evec = np.asarray(v1.dataobj[:, :, k0:k1, :], dtype=np.float32)
+        rgb = color_fa(fa[:, :, k0:k1], evec)
+        del evec
+
+    with tempfile.TemporaryDirectory() as _tmpd:
+        tmpd = Path(_tmpd)
+        images: list[Path] = []
+        for cut, k in enumerate(ks):
+            with _private.stage("plot"):
+                f = _figures.new_figure(figsize)
+                ax = f.add_subplot()
+                ax.imshow(np.clip(np.rot90(rgb[:, :, int(k) - k0]), 0, 1))
+                img = tmpd / f"{cut}.png"
+                ax.axis("off")
+            with _private.stage("encode"):
+                f.savefig(
+                    img,
+                    backend="Agg",
+                    pil_kwargs={"compress_level": 9},
+                    bbox_inches="tight",
+                )
+            images.append(img)
+
+        with _private.stage("gif"):
+            frames = np.stack(
+                [iio.imread(img) for img in images + images[-2:1:-1]], axis=0
+            )
+
+    with _private.stage("gif"), tempfile.NamedTemporaryFile(suffix=".gif") as tf:
+        iio.imwrite(tf.name, frames, loop=0, duration=200)
+        pygifsicle.optimize(tf.name)
+        return tf.read()
@@ -0,0 +1,63 @@
+"""Helpers shared by the matplotlib (nilearn) figure renderers."""
+
+import io
+import time
+import typing
+from datetime import datetime
+from wsgiref import handlers
+
+import numpy as np
+from matplotlib import figure
+from matplotlib.backends import backend_agg
+
+from django_qcapp_ratings import models
+
+from . import _private
+
+if typing.TYPE_CHECKING:
+    from nilearn.plotting import displays
+
+
+def new_figure(figsize: tuple[float, float]) -> figure.Figure:
+    """A figure drawn by its own Agg canvas, outside of pyplot's global state.
+
+    Unlike plt.figure, this can be called from several threads at once, and
+    the figure is freed once unreferenced, without plt.close.
+    """
+    f = figure.Figure(figsize=figsize, layout="none")
+    backend_agg.FigureCanvasAgg(f)
+    return f
+
+
+def pixel_affine(
+    p: "displays.OrthoSlicer", display_mode: models.DisplayMode, cut_coord: float
+) -> list[list[float]]:
+    """Affine from saved figure pixels (x, y from the top left, 0, 1) to RAS.
+
+    Only valid once the figure has been drawn (e.g., saved).
+    """
+    # a single-cut slicer has one axes, keyed by its cut coordinate
+    ax = next(iter(p.axes.values())).ax
+    height = ax.figure.get_size_inches()[1] * ax.figure.dpi
+    # matplotlib's display coordinates start at the bottom left
+    from_pixels = np.array([[1.0, 0.0, 0.0], [0.0, -1.0, height], [0.0, 0.0, 1.0]])
+    to_data = ax.transData.inverted().get_affine().get_matrix() @ from_pixels
+
+    affine = np.zeros((4, 4))
+    u, v = _private.in_plane_axes(display_mode)
+    affine[u, [0, 1, 3]] = to_data[0]
+    affine[v, [0, 1, 3]] = to_data[1]
+    affine[display_mode, 3] = cut_coord
+    affine[3, 3] = 1.0
+    return affine.tolist()
+
+
+def savefig(p: "displays.OrthoSlicer", dst: io.BytesIO) -> None:
+    now = datetime.now()
+    stamp = time.mktime(now.timetuple())
+    p.savefig(
+        dst,
+        metadata={"Creation Time": handlers.format_date_time(stamp)},
+        backend="Agg",
+        pil_kwargs={"compress_level": 9},
+    )
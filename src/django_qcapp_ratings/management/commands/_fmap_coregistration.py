@@ -0,0 +1,102 @@
+import io
+import tempfile
+
+import imageio.v3 as iio
+import numpy as np
+import pygifsicle
+from nibabel import spatialimages
+from nilearn import plotting
+from nilearn.plotting import displays
+
+from django_qcapp_ratings import models
+
+from . import _figures, _private
+
+
+def rotate_to_fmap(
+    file_nii: spatialimages.SpatialImage,
+    mask_nii: spatialimages.SpatialImage,
+    file2_nii: spatialimages.SpatialImage,
+) -> tuple[spatialimages.SpatialImage, ...]:
+    """Rotate the images so that the fmap (file2) is aligned with the axes."""
+    canonical_r = _private.rotation2canonical(file2_nii)
+    return (
+        _private.rotate_affine(file_nii, rot=canonical_r),
+        _private.rotate_affine(mask_nii, rot=canonical_r),
+        _private.rotate_affine(file2_nii),
+    )
+
+
+def get_fmap_coregistration(
+    cut: int,
+    mask_nii: spatialimages.SpatialImage,
+    file_nii: spatialimages.SpatialImage,
+    file2_nii: spatialimages.SpatialImage,
+    display_mode: models.DisplayMode = models.DisplayMode(models.DisplayMode.X),
+    figsize: tuple[float, float] = (6.4, 4.8),
+    volume: models.Volume | None = None,
+) -> bytes:
+    """The volume, if given, describes the rotated file_nii (see
+    rotate_to_fmap)."""
+    file_nii, mask_nii, file2_nii = rotate_to_fmap(file_nii, mask_nii, file2_nii)
+
+    cuts = _private.get_cuts(display_mode, mask_nii=mask_nii, volume=volume)
+    file_vmin, file_vmax = _private.get_quantiles(
+        file_nii, [0.15, 0.998], volume=volume
+    )
+    file2_vmin, file2_vmax = _private.get_quantiles(file2_nii, [0.15, 0.998])
+    f0 = _figures.new_figure(figsize)
+    f1 = _figures.new_figure(figsize)
+
+    with io.BytesIO() as frame0:
+        with io.BytesIO() as frame1:
+            # https://github.com/nipreps/nireports/blob/e7beccc14670e820c646306eb1d7dd3d56591450/nireports/reportlets/utils.py#L62-L70
+            with _private.stage("plot"):
+                p: displays.OrthoSlicer = plotting.plot_anat(
+                    file_nii,
+                    cut_coords=[cuts[cut]],
+                    display_mode=display_mode.name.lower(),
+                    figure=f0,
+                    vmax=file_vmax,
+                    vmin=file_vmin,
+                    colorbar=False,
+                    title="func/boldref",
+                )  # type: ignore
+                try:
+                    p.add_contours(mask_nii, levels=[0.5], colors="g", transparency=0.5)
+                except ValueError:
+                    pass
+            with _private.stage("encode"):
+                _figures.savefig(p, frame0)
+
+            # https://github.com/nipreps/nireports/blob/e7beccc14670e820c646306eb1d7dd3d56591450/nireports/reportlets/utils.py#L62-L70
+            with _private.stage("plot"):
+                p: displays.OrthoSlicer = plotting.plot_anat(
+                    file2_nii,
+                    cut_coords=[cuts[cut]],
+                    display_mode=display_mode.name.lower(),
+                    figure=f1,
+                    vmax=file2_vmax,
+                    vmin=file2_vmin,
+                    colorbar=False,
+                    title="fmap/epi",
+                )  # type: ignore
+                try:
+                    p.add_contours(mask_nii, levels=[0.5], colors="g", transparency=0.5)
+                except ValueError:
+                    pass
+            with _private.stage("encode"):
+                _figures.savefig(p, frame1)
+
+            with _private.stage("gif"):
+                frames = np.stack(
+                    [
+                        iio.imread(x, index=None)
+                        for x in [frame0.getvalue(), frame1.getvalue()]
+                    ],
+                    axis=0,
+                )
+        with _private.stage("gif"), tempfile.NamedTemporaryFile(suffix=".gif") as tf:
+            iio.imwrite(tf.name, frames, loop=0, duration=300, optimize=True)
+            pygifsicle.optimize(tf.name)
+            return tf.read()
@@ -0,0 +1,557 @@
+import asyncio
+import collections
+import concurrent.futures
+import dataclasses
+import io
+import itertools
+import logging
+import multiprocessing
+import queue
+import threading
+import time
+import typing as t
+from pathlib import Path
+
+import nibabel as nb
+import typer
+from celery import result
+
+from django_qcapp_ratings import models, services, tasks
+
+from . import _private, _progress
+
+POLL_INTERVAL_SEC = 5
+# volumes rendered ahead of the writer per process; their figures wait in memory
+PROCESS_LOOKAHEAD = 2
+# rendered batches waiting for the writer; rendering stalls beyond this
+WRITER_QUEUE_SIZE = 4
+
+Distributed = t.Annotated[
+    bool,
+    typer.Option(help="Enqueue rendering as Celery tasks instead of rendering here"),
+]
+PerFigure = t.Annotated[
+    bool,
+    typer.Option(help="With --distributed, enqueue one task per figure (not volume)"),
+]
+Wait = t.Annotated[
+    bool,
+    typer.Option(help="With --distributed, track the tasks until they finish"),
+]
+Mosaic = t.Annotated[
+    bool,
+    typer.Option(help="Store the cuts of each display mode as tiles of one mosaic"),
+]
+Slices = t.Annotated[
+    bool,
+    typer.Option(help="Store quantized slices for the browser to draw, not figures"),
+]
+RenderProcesses = t.Annotated[
+    int,
+    typer.Option(min=1, help="Volumes to render at once, in separate processes"),
+]
+
+Figure = tuple[int | None, int]
+# each figure with its pixel to RAS affine, if it has one
+Drawn = tuple[bytes, list[list[float]] | None]
+Rendered = tuple[models.Volume, t.Iterator[tuple[Figure, *Drawn]]]
+
+
+def _by_display(figure: Figure) -> int:
+    return figure[1]
+
+
+@dataclasses.dataclass
+class RenderJob:
+    """Everything needed to render the figures of one source volume."""
+
+    step: models.Step
+    file1: str
+    file2: str | None
+    paths: dict[str, str]
+    figures: list[Figure]
+    mosaic: bool = False
+    slices: bool = False
+
+    def to_dict(self) -> dict[str, t.Any]:
+        return {
+            "step": int(self.step),
+            "file1": self.file1,
+            "file2": self.file2,
+            "paths": self.paths,
+            "figures": [list(figure) for figure in self.figures],
+            "mosaic": self.mosaic,
+            "slices": self.slices,
+        }
+
+    @classmethod
+    def from_dict(cls, d: dict[str, t.Any]) -> "RenderJob":
+        return cls(
+            step=models.Step(d["step"]),
+            file1=d["file1"],
+            file2=d.get("file2"),
+            paths=d["paths"],
+            figures=[(cut, display) for cut, display in d["figures"]],
+            mosaic=d.get("mosaic", False),
+            slices=d.get("slices", False),
+        )
+
+    def split(self) -> list["RenderJob"]:
+        if self.mosaic:
+            # a mosaic holds every cut of a display mode
+            return [
+                dataclasses.replace(self, figures=list(figures))
+                for _, figures in itertools.groupby(
+                    sorted(self.figures, key=_by_display), key=_by_display
+                )
+            ]
+        return [dataclasses.replace(self, figures=[figure]) for figure in self.figures]
+
+
+def all_figures(step: models.Step) -> list[Figure]:
+    match step:
+        case models.Step.DTIFIT:
+            return [(None, models.DisplayMode.Z)]
+        case models.Step.SPATIAL_NORMALIZATION:
+            n_cuts = len(_private.SPATIAL_NORMALIZATION_CUTS["x"])
+        case _:
+            n_cuts = _private.N_CUTS
+    return [
+        (cut, display) for display in models.DisplayMode.values for cut in range(n_cuts)
+    ]
+
+
+def missing_figures(
+    step: models.Step, file1: str, update: bool = False
+) -> list[Figure]:
+    """Figures of file1 that need rendering, or all of them when updating."""
+    figures = all_figures(step)
+    if update:
+        return figures
+    existing = set(
+        models.Image.objects.filter(step=step, file1=file1).values_list(
+            "slice", "display"
+        )
+    )
+    missing = [figure for figure in figures if figure not in existing]
+    if len(missing) < len(figures):
+        logging.info(f"Found {len(figures) - len(missing)} objects. Skipping")
+    return missing
+
+
+def _draw_all(
+    draw: t.Callable[[Figure], Drawn], figures: list[Figure]
+) -> t.Iterator[tuple[Figure, *Drawn]]:
+    yield from ((figure, *draw(figure)) for figure in figures)
+
+
+def _render_mask(job: RenderJob) -> Rendered:
+    from . import _mask, _slices
+
+    with _private.stage("load"):
+        mask_nii = nb.nifti1.Nifti1Image.load(job.paths["mask"])
+        file_nii = nb.nifti1.Nifti1Image.load(job.paths["anat"])
+    volume = _private.describe_volume(file_nii, mask_nii=mask_nii)
+    if job.slices:
+        return volume, _slices.get_mask_slices(
+            file_nii=file_nii, mask_nii=mask_nii, figures=job.figures
+        )
+
+    def draw(figure: Figure) -> Drawn:
+        cut, display = figure
+        return _mask.get_mask(
+            cut=cut,  # type: ignore
+            display_mode=models.DisplayMode(display),
+            mask_nii=mask_nii,
+            file_nii=file_nii,
+            volume=volume,
+        )
+
+    return volume, _draw_all(draw, job.figures)
+
+
+def _render_spatial_normalization(job: RenderJob) -> Rendered:
+    from . import _spatial_normalization
+
+    with _private.stage("load"):
+        file_nii = nb.nifti1.Nifti1Image.load(job.paths["anat"])
+    volume = _private.describe_volume(
+        file_nii,
+        cuts={
+            display: list(
+                _private.SPATIAL_NORMALIZATION_CUTS[display.name.lower()].values()
+            )
+            for display in models.DisplayMode
+        },
+    )
+
+    def draw(figure: Figure) -> Drawn:
+        cut, display = figure
+        return _spatial_normalization.get_spatial_normalization(
+            cut=cut,  # type: ignore
+            display_mode=models.DisplayMode(display),
+            file_nii=file_nii,
+        )
+
+    return volume, _draw_all(draw, job.figures)
+
+
+def _render_surface_localization(job: RenderJob) -> Rendered:
+    from . import _slices, _surface_localization
+
+    with _private.stage("load"):
+        brain_nii = _private.mgz_to_nifti(job.paths["brain"])
+        ribbon_nii = _private.mgz_to_nifti(job.paths["ribbon"])
+    volume = _private.describe_volume(brain_nii, mask_nii=ribbon_nii)
+    if job.slices:
+        return volume, _slices.get_surface_localization_slices(
+            brain_nii=brain_nii, ribbon_nii=ribbon_nii, figures=job.figures
+        )
+
+    def draw(figure: Figure) -> Drawn:
+        cut, display = figure
+        return _surface_localization.get_surface_localization(
+            cut=cut,  # type: ignore
+            display_mode=models.DisplayMode(display),
+            brain_nii=brain_nii,
+            ribbon_nii=ribbon_nii,
+            volume=volume,
+        )
+
+    return volume, _draw_all(draw, job.figures)
+
+
+def _render_fmap_coregistration(job: RenderJob) -> Rendered:
+    import nitransforms as nt
+
+    from . import _fmap_coregistration
+
+    with _private.stage("load"):
+        file2_nii = nb.nifti1.Nifti1Image.load(job.paths["file2"])
+        transform = nt.linear.load(job.paths["transform"], reference=file2_nii)
+        mask_nii = nt.resampling.apply(
+            transform, spatialimage=Path(job.paths["mask"]), order=0
+        )
+        # sometimes, the boldref is stored as a 4d image (even though
+        # the fourth dimension has only length 1)
+        boldref_nii = nb.funcs.squeeze_image(
+            nb.nifti1.Nifti1Image.load(job.paths["boldref"])
+        )
+        file_nii = nt.resampling.apply(transform, spatialimage=boldref_nii)
+    rotated_nii, rotated_mask_nii, _ = _fmap_coregistration.rotate_to_fmap(
+        file_nii,  # type: ignore
+        mask_nii,  # type: ignore
+        file2_nii,
+    )
+    volume = _private.describe_volume(rotated_nii, mask_nii=rotated_mask_nii)
+
+    def draw(figure: Figure) -> Drawn:
+        cut, display = figure
+        img = _fmap_coregistration.get_fmap_coregistration(
+            cut=cut,  # type: ignore
+            display_mode=models.DisplayMode(display),
+            mask_nii=mask_nii,  # type: ignore
+            file_nii=file_nii,  # type: ignore
+            file2_nii=file2_nii,
+            volume=volume,
+        )
+        return img, None
+
+    return volume, _draw_all(draw, job.figures)
+
+
+def _render_dtifit(job: RenderJob) -> Rendered:
+    from . import _dtifit
+
+    fa = Path(job.paths["fa"])
+    with _private.stage("load"):
+        nii = nb.nifti1.Nifti1Image.load(fa)
+        v1 = nb.nifti1.Nifti1Image.load(fa.with_name(fa.name.replace("FA", "V1")))
+        # in float32 and uncached, once for the quantiles and the figure
+        data = _dtifit.load_fa(nii)
+    volume = _private.describe_volume(nii, data=data)
+    img = _dtifit.get_dtifit(nii=nii, v1=v1, fa=data)
+    return volume, ((figure, img, None) for figure in job.figures)
+
+
+def render(job: RenderJob) -> t.Iterator[models.Image]:
+    """Render the figures of a job as unsaved images of an unsaved volume."""
+    match job.step:
+        case models.Step.MASK:
+            volume, figures = _render_mask(job)
+        case models.Step.SPATIAL_NORMALIZATION:
+            volume, figures = _render_spatial_normalization(job)
+        case models.Step.SURFACE_LOCALIZATION:
+            volume, figures = _render_surface_localization(job)
+        case models.Step.FMAP_COREGISTRATION:
+            volume, figures = _render_fmap_coregistration(job)
+        case models.Step.DTIFIT:
+            volume, figures = _render_dtifit(job)
+        case _:
+            raise AssertionError("Unknown step")
+    volume.step, volume.file1, volume.file2 = job.step, job.file1, job.file2
+
+    for (cut, display), img, affine in figures:
+        logging.debug(f"rendered {job.file1} {cut=} {display=}")
+        yield models.Image(
+            img=img,
+            slice=cut,
+            display=display,
+            step=job.step,
+            file1=job.file1,
+            file2=job.file2,
+            format=models.ImageFormat.SLICE
+            if job.slices
+            else models.ImageFormat.FIGURE,
+            volume=volume,
+            pixel_affine=affine,
+        )
+
+
+def stitch(imgs: list[bytes]) -> tuple[models.Mosaic, list[dict[str, int]]]:
+    """Place PNGs side by side in one mosaic, returning it and their tiles."""
+    from PIL import Image as PILImage
+
+    tiles = [PILImage.open(io.BytesIO(img)) for img in imgs]
+    widths = [tile.width for tile in tiles]
+    canvas = PILImage.new("RGBA", (sum(widths), max(tile.height for tile in tiles)))
+    rects = []
+    for x, tile in zip(itertools.accumulate([0] + widths), tiles):
+        canvas.paste(tile, (x, 0))
+        rects.append(
+            {
+                "tile_x": x,
+                "tile_y": 0,
+                "tile_width": tile.width,
+                "tile_height": tile.height,
+            }
+        )
+    with io.BytesIO() as dst:
+        canvas.save(dst, format="PNG", optimize=True)
+        mosaic = models.Mosaic(
+            img=dst.getvalue(), width=canvas.width, height=canvas.height
+        )
+    return mosaic, rects
+
+
+class Writer:
+    """Writes rendered batches to the database in order, from one thread.
+
+    Rendering goes on while a batch is written, and the batches of this
+    process go through a single connection, one transaction at a time. Other
+    processes (web workers, other ingestions) still write concurrently, so
+    with SQLite (see sqlite.py) a rater's write may wait for a batch of each.
+    The first failed write is raised by the next submit, or on exit.
+    """
+
+    def __init__(self, maxsize: int = WRITER_QUEUE_SIZE) -> None:
+        self._queue: queue.Queue[tuple[t.Callable, tuple] | None] = queue.Queue(maxsize)
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self.error: BaseException | None = None
+        self.stages: collections.Counter[str] = collections.Counter()
+
+    def _run(self) -> None:
+        with _private.record_stages() as stages:
+            while (item := self._queue.get()) is not None:
+                write, args = item
+                if self.error is not None:
+                    continue
+                try:
+                    with _private.stage("db_write"):
+                        asyncio.run(write(*args))
+                except BaseException as e:
+                    self.error = e
+            self.stages.update(stages)
+
+    def submit(self, write: t.Callable[..., t.Awaitable], *args) -> None:
+        if self.error is not None:
+            raise self.error
+        self._queue.put((write, args))
+
+    def __enter__(self) -> "Writer":
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self._queue.put(None)
+        self._thread.join()
+        if self.error is not None and exc[0] is None:
+            raise self.error
+
+
+def _write(writer: Writer | None, write: t.Callable[..., t.Awaitable], *args) -> None:
+    if writer is not None:
+        writer.submit(write, *args)
+        return
+    with _private.stage("db_write"):
+        asyncio.run(write(*args))
+
+
+def _with_all_cuts(job: RenderJob) -> RenderJob:
+    """The job with every cut of its display modes, as a mosaic holds them all."""
+    displays = {display for _, display in job.figures}
+    return dataclasses.replace(
+        job, figures=[f for f in all_figures(job.step) if f[1] in displays]
+    )
+
+
+def save_mosaics(
+    job: RenderJob,
+    images: t.Iterable[models.Image],
+    reporter: _progress.Reporter | None = None,
+    writer: Writer | None = None,
+) -> int:
+    """Stitch the rendered cuts of each display mode into one mosaic and save."""
+    n = 0
+    for display, by_display in itertools.groupby(images, key=lambda i: i.display):
+        by_display = list(by_display)
+        mosaic, rects = stitch([image.img for image in by_display])
+        mosaic.file1, mosaic.display, mosaic.step = job.file1, display, job.step
+        for image, rect in zip(by_display, rects):
+            for field, value in rect.items():
+                setattr(image, field, value)
+            if reporter is not None:
+                reporter.add(image, n_bytes=len(mosaic.img) // len(by_display))
+        _write(writer, services.amerge_mosaic, mosaic, by_display)
+        n += len(by_display)
+    return n
+
+
+def save(
+    job: RenderJob,
+    images: t.Iterable[models.Image],
+    reporter: _progress.Reporter | None = None,
+    writer: Writer | None = None,
+) -> int:
+    """Save the rendered images of a job, as mosaics if it asks for them."""
+    if job.mosaic:
+        return save_mosaics(job, images, reporter=reporter, writer=writer)
+    saved = []
+    for image in images:
+        saved.append(image)
+        if reporter is not None:
+            reporter.add(image)
+    _write(writer, services.amerge_images, saved)
+    return len(saved)
+
+
+def render_and_save(
+    job: RenderJob,
+    reporter: _progress.Reporter | None = None,
+    writer: Writer | None = None,
+) -> int:
+    if job.mosaic:
+        job = _with_all_cuts(job)
+    return save(job, render(job), reporter=reporter, writer=writer)
+
+
+def _render_in_process(
+    job: dict[str, t.Any],
+) -> tuple[list[models.Image], collections.Counter[str]]:
+    """Render a serialized job in a pool process, with the time of its stages."""
+    with _private.record_stages() as stages:
+        images = list(render(RenderJob.from_dict(job)))
+    return images, stages
+
+
+def render_in_processes(
+    jobs: t.Iterable[RenderJob], processes: int
+) -> t.Iterator[tuple[RenderJob, list[models.Image]]]:
+    """Render jobs in a pool of processes, yielding them in order.
+
+    Drawing figures holds the GIL for most of its time, so volumes are spread
+    over processes, each loading its own. At most PROCESS_LOOKAHEAD volumes
+    per process are rendered ahead of the caller.
+    """
+    import django
+
+    # forking would copy the writer's thread and connection; spawned processes
+    # only import the app, and never open a connection
+    context = multiprocessing.get_context("spawn")
+    pending: collections.deque = collections.deque()
+    with concurrent.futures.ProcessPoolExecutor(
+        processes, mp_context=context, initializer=django.setup
+    ) as pool:
+        for job in jobs:
+            if job.mosaic:
+                job = _with_all_cuts(job)
+            pending.append((job, pool.submit(_render_in_process, job.to_dict())))
+            if len(pending) >= processes * PROCESS_LOOKAHEAD:
+                yield _collect(*pending.popleft())
+        while len(pending):
+            yield _collect(*pending.popleft())
+
+
+def _collect(
+    job: RenderJob, future: concurrent.futures.Future
+) -> tuple[RenderJob, list[models.Image]]:
+    images, stages = future.result()
+    _private.add_stages(stages)
+    return job, images
+
+
+def track(group: result.GroupResult) -> None:
+    """Log progress of a group of render tasks until all have finished."""
+    total = len(group.results)
+    while not group.ready():
+        logging.info(f"{group.id}: {group.completed_count()}/{total} tasks succeeded")
+        time.sleep(POLL_INTERVAL_SEC)
+    n_failed = sum(res.failed() for res in group.results)
+    logging.info(
+        f"{group.id}: finished with {total - n_failed} succeeded, {n_failed} failed"
+    )
+
+
+def run(
+    jobs: t.Iterable[RenderJob],
+    distributed: bool = False,
+    per_figure: bool = False,
+    wait: bool = True,
+    show_progress: bool = False,
+    summary: Path | None = None,
+    mosaic: bool = False,
+    slices: bool = False,
+    processes: int = 1,
+) -> None:
+    """Render jobs in-process, or fan them out to the Celery workers."""
+    if mosaic and slices:
+        raise typer.BadParameter("--mosaic and --slices are exclusive")
+    if distributed and processes > 1:
+        raise typer.BadParameter("--render-processes only applies to rendering here")
+    if slices:
+        from . import _slices
+
+    with _progress.Reporter(show=show_progress, summary=summary) as reporter:
+
+        def pending() -> t.Iterator[RenderJob]:
+            for job in jobs:
+                if slices and not _slices.is_supported(job.step):
+                    raise typer.BadParameter(f"--slices does not support {job.step}")
+                job.mosaic, job.slices = mosaic, slices
+                reporter.skip(job.step, len(all_figures(job.step)) - len(job.figures))
+                if len(job.figures):
+                    yield job
+
+        if not distributed:
+            with _private.record_stages() as stages, Writer() as writer:
+                if processes > 1:
+                    for job, images in render_in_processes(pending(), processes):
+                        save(job, images, reporter=reporter, writer=writer)
+                        reporter.stages.update(stages)
+                        stages.clear()
+                else:
+                    for job in pending():
+                        render_and_save(job, reporter=reporter, writer=writer)
+                        reporter.stages.update(stages)
+                        stages.clear()
+            reporter.stages.update(writer.stages)
+            return
+
+        to_enqueue = []
+        for job in pending():
+            reporter.enqueue(job.step, len(job.figures))
+            to_enqueue.extend(job.split() if per_figure else [job])
+        group = tasks.enqueue_render_jobs([job.to_dict() for job in to_enqueue])
+    logging.info(f"Enqueued {len(group.results)} tasks as {group.id}")
+    if wait:
+        track(group)
@@ -0,0 +1,40 @@
+import io
+
+import nibabel as nb
+from nilearn import plotting
+from nilearn.plotting import displays
+
+from django_qcapp_ratings import models
+
+from . import _figures, _private
+
+
+def get_mask(
+    cut: int,
+    file_nii: nb.nifti1.Nifti1Image,
+    mask_nii: nb.nifti1.Nifti1Image,
+    display_mode: models.DisplayMode = models.DisplayMode(models.DisplayMode.X),
+    figsize: tuple[float, float] = (6.4, 4.8),
+    volume: models.Volume | None = None,
+) -> tuple[bytes, list[list[float]]]:
+    cuts = _private.get_cuts(display_mode, mask_nii=mask_nii, volume=volume)
+    (vmax,) = _private.get_quantiles(file_nii, [0.95], volume=volume)
+    f = _figures.new_figure(figsize)
+    with io.BytesIO() as img:
+        with _private.stage("plot"):
+            p: displays.OrthoSlicer = plotting.plot_anat(
+                file_nii,
+                cut_coords=[cuts[cut]],
+                display_mode=display_mode.name.lower(),
+                figure=f,
+                vmax=vmax,
+                colorbar=False,
+            )  # type: ignore
+            if mask_nii:
+                p.add_contours(
+                    mask_nii, levels=[0.5], colors="g", filled=True, transparency=0.5
+                )
+        with _private.stage("encode"):
+            _figures.savefig(p, img)
+        affine = _figures.pixel_affine(p, display_mode, cuts[cut])
+        return img.getvalue(), affine
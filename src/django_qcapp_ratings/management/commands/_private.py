@@ -1,26 +1,21 @@
-import io
+import collections
+import contextlib
+import contextvars
 import logging
-import tempfile
 import time
 import typing
-from datetime import datetime
 from pathlib import Path
-from wsgiref import handlers
 
-import imageio.v3 as iio
 import nibabel as nb
 import numpy as np
 import numpy.typing as npt
-import polars as pl
-import pygifsicle
-from dipy.reconst import dti
-from matplotlib import pyplot as plt
 from nibabel import spatialimages
-from nilearn import image, plotting
-from nilearn.plotting import displays
-from scipy import ndimage
 
-from django_qcapp_ratings import datasets, models
+from django_qcapp_ratings import models
+
+if typing.TYPE_CHECKING:
+    import polars as pl
+
 
 N_CUTS = 7
 SPATIAL_NORMALIZATION_CUTS = {
@@ -28,12 +23,50 @@ SPATIAL_NORMALIZATION_CUTS = {
     "y": {0: -65, 1: 20, 2: 54},
     "z": {0: -6, 1: 13, 2: 58},
 }
-
-
-def cuts_from_bbox_ijk(
+# stored per volume, so that re-renders can reuse the display ranges
+VOLUME_QUANTILES = (0.15, 0.5, 0.95, 0.99, 0.998)
+
+_stage_times: contextvars.ContextVar[collections.Counter[str] | None] = (
+    contextvars.ContextVar("stage_times", default=None)
+)
+
+
+@contextlib.contextmanager
+def stage(name: str) -> typing.Iterator[None]:
+    """Add the time spent in this block to the active record_stages, if any."""
+    times = _stage_times.get()
+    if times is None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        times[name] += time.perf_counter() - start
+
+
+@contextlib.contextmanager
+def record_stages() -> typing.Iterator[collections.Counter[str]]:
+    """Collect seconds per rendering stage (cuts, quantiles, plot, encode)."""
+    times: collections.Counter[str] = collections.Counter()
+    token = _stage_times.set(times)
+    try:
+        yield times
+    finally:
+        _stage_times.reset(token)
+
+
+def add_stages(times: collections.Counter[str]) -> None:
+    """Add stages recorded elsewhere (e.g., another thread) to the active record."""
+    active = _stage_times.get()
+    if active is not None:
+        active.update(times)
+
+
+def bbox_ijk(
     mask_nii: spatialimages.SpatialImage, cuts: int = 7
-) -> npt.NDArray[np.float32]:
-    """Find equi-spaced cuts for presenting images."""
+) -> npt.NDArray[np.int64]:
+    """First and last voxel of the masked planes along each axis, as (3, 2)."""
     if mask_nii.affine is None:
         raise ValueError("nifti must have affine")
     mask_data = np.asanyarray(mask_nii.dataobj) > 0.0
@@ -62,8 +95,7 @@ def cuts_from_bbox_ijk(
         ]
     ).astype(int)
 
-    vox_coords = np.zeros((4, cuts), dtype=np.float32)
-    vox_coords[-1, :] = 1.0
+    bbox = np.zeros((3, 2), dtype=np.int64)
     for ax, (c, th) in enumerate(zip(ijk_counts, ijk_th)):
         # Start with full plane if mask is seemingly empty
         smin, smax = (0, mask_data.shape[ax] - 1)
@@ -74,11 +106,26 @@ def cuts_from_bbox_ijk(
         if B.size:
             smin, smax = B.min(), B.max()
 
-        vox_coords[ax, :] = np.linspace(smin, smax, num=cuts + 2)[1:-1]
+        bbox[ax] = smin, smax
+
+    return bbox
 
+
+def _cuts_in_bbox(bbox: npt.NDArray[np.int64], cuts: int) -> npt.NDArray[np.float32]:
+    vox_coords = np.zeros((4, cuts), dtype=np.float32)
+    vox_coords[-1, :] = 1.0
+    for ax, (smin, smax) in enumerate(bbox):
+        vox_coords[ax, :] = np.linspace(smin, smax, num=cuts + 2)[1:-1]
     return vox_coords
 
 
+def cuts_from_bbox_ijk(
+    mask_nii: spatialimages.SpatialImage, cuts: int = 7
+) -> npt.NDArray[np.float32]:
+    """Find equi-spaced cuts for presenting images."""
+    return _cuts_in_bbox(bbox_ijk(mask_nii, cuts=cuts), cuts=cuts)
+
+
 def cuts_from_bbox(
     mask_nii: spatialimages.SpatialImage, cuts: int = 7
 ) -> dict[models.DisplayMode, list[float]]:
@@ -97,143 +144,80 @@ def cuts_from_bbox(
     }
 
 
-def _savefig(p: displays.OrthoSlicer, dst: io.BytesIO) -> None:
-    now = datetime.now()
-    stamp = time.mktime(now.timetuple())
-    p.savefig(
-        dst,
-        metadata={"Creation Time": handlers.format_date_time(stamp)},
-        backend="Agg",
-        pil_kwargs={"compress_level": 9},
+def describe_volume(
+    file_nii: spatialimages.SpatialImage,
+    mask_nii: spatialimages.SpatialImage | None = None,
+    cuts: dict[models.DisplayMode, list[float]] | None = None,
+    data: npt.NDArray | None = None,
+) -> models.Volume:
+    """Geometry and intensity quantiles of a source volume (unsaved).
+
+    Cuts are placed in the bounding box of mask_nii, unless given. Quantiles
+    are taken from data, the volume already loaded, if given; otherwise from
+    get_fdata, which keeps the data cached for the figures that follow.
+    """
+    if file_nii.affine is None:
+        raise ValueError("nifti must have affine")
+    bbox = None
+    if mask_nii is not None and cuts is None:
+        with stage("cuts"):
+            bbox = bbox_ijk(mask_nii, cuts=N_CUTS)
+            ras_coords = mask_nii.affine.dot(_cuts_in_bbox(bbox, cuts=N_CUTS))[:3]
+        cuts = {
+            display: list(coords)
+            for display, coords in zip(models.DisplayMode, np.around(ras_coords, 3))
+        }
+    with stage("quantiles"):
+        if data is None:
+            data = file_nii.get_fdata()
+        quantiles = np.quantile(data, VOLUME_QUANTILES)
+    return models.Volume(
+        affine=file_nii.affine.tolist(),
+        shape=list(file_nii.shape),
+        bbox=None if bbox is None else bbox.tolist(),
+        cuts={
+            display.name: [float(c) for c in coords]
+            for display, coords in (cuts or {}).items()
+        },
+        quantiles={str(q): float(v) for q, v in zip(VOLUME_QUANTILES, quantiles)},
     )
 
 
-def get_mask(
-    cut: int,
-    file_nii: nb.nifti1.Nifti1Image,
-    mask_nii: nb.nifti1.Nifti1Image,
-    display_mode: models.DisplayMode = models.DisplayMode(models.DisplayMode.X),
-    figsize: tuple[float, float] = (6.4, 4.8),
-) -> bytes:
-    cuts = cuts_from_bbox(mask_nii, cuts=N_CUTS).get(display_mode)
-    if cuts is None:
-        raise ValueError("Misaglinged Display Mode")
-    f = plt.figure(figsize=figsize, layout="none")
-    with io.BytesIO() as img:
-        p: displays.OrthoSlicer = plotting.plot_anat(
-            file_nii,
-            cut_coords=[cuts[cut]],
-            display_mode=display_mode.name.lower(),
-            figure=f,
-            vmax=np.quantile(file_nii.get_fdata(), 0.95),
-            colorbar=False,
-        )  # type: ignore
-        if mask_nii:
-            p.add_contours(
-                mask_nii, levels=[0.5], colors="g", filled=True, transparency=0.5
-            )
-        _savefig(p, img)
-        plt.close(f)
-        return img.getvalue()
-
-
-def get_surface_localization(
-    cut: int,
-    brain_nii: nb.nifti1.Nifti1Image,
-    ribbon_nii: nb.nifti1.Nifti1Image,
-    display_mode: models.DisplayMode = models.DisplayMode(models.DisplayMode.X),
-    figsize: tuple[float, float] = (6.4, 4.8),
-    linewidths=0.5,
-    levels: list[float] = [0.5],
-) -> bytes:
-    cuts = cuts_from_bbox(ribbon_nii, cuts=N_CUTS).get(display_mode)
+def get_cuts(
+    display_mode: models.DisplayMode,
+    mask_nii: spatialimages.SpatialImage,
+    volume: models.Volume | None = None,
+) -> list[float]:
+    if volume is not None:
+        return volume.cuts[display_mode.name]
+    with stage("cuts"):
+        cuts = cuts_from_bbox(mask_nii, cuts=N_CUTS).get(display_mode)
     if cuts is None:
         raise ValueError("Misaglinged Display Mode")
-    f = plt.figure(figsize=figsize, layout="none")
-    contour_data = ribbon_nii.get_fdata() % 39
-    white = image.new_img_like(ribbon_nii, contour_data == 2)
-    pial = image.new_img_like(ribbon_nii, contour_data >= 2)
-    with io.BytesIO() as img:
-        p: displays.OrthoSlicer = plotting.plot_anat(
-            brain_nii,
-            cut_coords=[cuts[cut]],
-            display_mode=display_mode.name.lower(),
-            figure=f,
-            colorbar=False,
-        )  # type: ignore
-        try:
-            p.add_contours(white, colors="b", linewidths=linewidths, levels=levels)
-            p.add_contours(pial, colors="r", linewidths=linewidths, levels=levels)
-        except ValueError:
-            pass
-        _savefig(p, img)
-        plt.close(f)
-        return img.getvalue()
-
-
-def get_spatial_normalization(
-    cut: int,
-    file_nii: nb.nifti1.Nifti1Image,
-    display_mode: models.DisplayMode,
-    figsize: tuple[float, float] = (6.4, 4.8),
-) -> bytes:
-    if cut > 2:
-        raise ValueError("Unknown cut")
-
-    f = plt.figure(figsize=figsize, layout="none")
-    with io.BytesIO() as img:
-        p: displays.OrthoSlicer = plotting.plot_roi(
-            roi_img=datasets.get_layout(),
-            bg_img=file_nii,
-            cut_coords=[SPATIAL_NORMALIZATION_CUTS[display_mode.name.lower()][cut]],
-            display_mode=display_mode.name.lower(),
-            figure=f,
-            colorbar=False,
-        )  # type: ignore
-        _savefig(p, img)
-        plt.close(f)
-        return img.getvalue()
+    return cuts
 
 
-def mgz_to_nifti(src) -> nb.nifti1.Nifti1Image:
-    mgh = nb.freesurfer.mghformat.load(src)
-    return nb.nifti1.Nifti1Image.from_image(mgh)
+def get_quantiles(
+    nii: spatialimages.SpatialImage,
+    q: list[float],
+    volume: models.Volume | None = None,
+) -> list[float]:
+    if volume is not None:
+        return [volume.quantiles[str(x)] for x in q]
+    with stage("quantiles"):
+        return list(np.quantile(nii.get_fdata(), q))
 
 
-def merge_or_write_image_db(d: pl.LazyFrame, dst: Path) -> None:
-    if dst.exists():
-        logging.info(f"Using existing database {dst}")
-        joined = (
-            pl.scan_parquet(dst)
-            .join(
-                d,
-                how="full",
-                on=["slice", "file1", "file2", "display", "step"],
-                coalesce=True,
-            )
-            .with_columns(match=pl.col("img") == pl.col("img_right"))
-            .collect()
-        )
-        if joined.select("match").to_series().any():
-            logging.warning("Replacing images")
-            logging.debug(
-                joined.filter(pl.col("match")).drop(
-                    pl.selectors.starts_with("img"), "match"
-                )
-            )
-        joined.drop("img_left").write_parquet(dst)
-    else:
-        d.sink_parquet(dst)
+def in_plane_axes(display_mode: models.DisplayMode) -> tuple[int, int]:
+    """World (and voxel) axes along the columns and rows of a cut."""
+    return typing.cast(
+        tuple[int, int], tuple(ax for ax in range(3) if ax != display_mode)
+    )
 
 
-async def merge_imgs(imgs: typing.Sequence[models.Image]) -> None:
-    if len(imgs):
-        await models.Image.objects.abulk_create(
-            imgs,
-            update_conflicts=True,  # type: ignore
-            update_fields=["img", "created"],
-            unique_fields=["slice", "file1", "display", "step"],
-        )
+def mgz_to_nifti(src) -> nb.nifti1.Nifti1Image:
+    mgh = nb.freesurfer.mghformat.load(src)
+    return nb.nifti1.Nifti1Image.from_image(mgh)
 
 
 def rotation2canonical(img):
@@ -257,112 +241,29 @@ def rotate_affine(img, rot=None):
     return img.__class__(img.dataobj, affine, img.header)
 
 
-def get_fmap_coregistration(
-    cut: int,
-    mask_nii: spatialimages.SpatialImage,
-    file_nii: spatialimages.SpatialImage,
-    file2_nii: spatialimages.SpatialImage,
-    display_mode: models.DisplayMode = models.DisplayMode(models.DisplayMode.X),
-    figsize: tuple[float, float] = (6.4, 4.8),
-) -> bytes:
-    canonical_r = rotation2canonical(file2_nii)
-    file2_nii = rotate_affine(file2_nii)
-    file_nii = rotate_affine(file_nii, rot=canonical_r)
-    mask_nii = rotate_affine(mask_nii, rot=canonical_r)
-
-    cuts = cuts_from_bbox(mask_nii, cuts=N_CUTS).get(display_mode)
-    if cuts is None:
-        raise ValueError("Misaglinged Display Mode")
-    f0 = plt.figure(figsize=figsize, layout="none")
-    f1 = plt.figure(figsize=figsize, layout="none")
-
-    with io.BytesIO() as frame0:
-        with io.BytesIO() as frame1:
-            # https://github.com/nipreps/nireports/blob/e7beccc14670e820c646306eb1d7dd3d56591450/nireports/reportlets/utils.py#L62-L70
-            p: displays.OrthoSlicer = plotting.plot_anat(
-                file_nii,
-                cut_coords=[cuts[cut]],
-                display_mode=display_mode.name.lower(),
-                figure=f0,
-                vmax=np.quantile(file_nii.get_fdata(), 0.998),
-                vmin=np.quantile(file_nii.get_fdata(), 0.15),
-                colorbar=False,
-                title="func/boldref",
-            )  # type: ignore
-            try:
-                p.add_contours(mask_nii, levels=[0.5], colors="g", transparency=0.5)
-            except ValueError:
-                pass
-            _savefig(p, frame0)
-            plt.close(f0)
-
-            # https://github.com/nipreps/nireports/blob/e7beccc14670e820c646306eb1d7dd3d56591450/nireports/reportlets/utils.py#L62-L70
-            p: displays.OrthoSlicer = plotting.plot_anat(
-                file2_nii,
-                cut_coords=[cuts[cut]],
-                display_mode=display_mode.name.lower(),
-                figure=f1,
-                vmax=np.quantile(file2_nii.get_fdata(), 0.998),
-                vmin=np.quantile(file2_nii.get_fdata(), 0.15),
-                colorbar=False,
-                title="fmap/epi",
-            )  # type: ignore
-            try:
-                p.add_contours(mask_nii, levels=[0.5], colors="g", transparency=0.5)
-            except ValueError:
-                pass
-            _savefig(p, frame1)
-            plt.close(f1)
-
-            frames = np.stack(
-                [
-                    iio.imread(x, index=None)
-                    for x in [frame0.getvalue(), frame1.getvalue()]
-                ],
-                axis=0,
+def merge_or_write_image_db(d: "pl.LazyFrame", dst: Path) -> None:
+    import polars as pl
+
+    if dst.exists():
+        logging.info(f"Using existing database {dst}")
+        joined = (
+            pl.scan_parquet(dst)
+            .join(
+                d,
+                how="full",
+                on=["slice", "file1", "file2", "display", "step"],
+                coalesce=True,
             )
-        with tempfile.NamedTemporaryFile(suffix=".gif") as tf:
-            iio.imwrite(tf.name, frames, loop=0, duration=300, optimize=True)
-            pygifsicle.optimize(tf.name)
-            return tf.read()
-
-
-def get_dtifit(
-    nii: nb.nifti1.Nifti1Image,
-    v1: nb.nifti1.Nifti1Image,
-    v2: nb.nifti1.Nifti1Image,
-    v3: nb.nifti1.Nifti1Image,
-    figsize: tuple[float, float] = (6.4, 4.8),
-) -> bytes:
-    evecs = np.stack([v1.get_fdata(), v2.get_fdata(), v3.get_fdata()], axis=-1)
-    rgb = dti.color_fa(nii.get_fdata(), evecs)
-
-    n_cuts = 20
-    mask_nii: nb.nifti1.Nifti1Image = image.binarize_img(
-        nii, 0.0001, two_sided=False, copy_header=True
-    )  # type: ignore
-    cuts = cuts_from_bbox_ijk(mask_nii, cuts=n_cuts).round().astype(np.uint16)
-
-    with tempfile.TemporaryDirectory() as _tmpd:
-        tmpd = Path(_tmpd)
-        images: list[Path] = []
-        for cut in range(n_cuts):
-            plt.figure(figsize=figsize, layout="none")
-            plt.imshow(np.clip(ndimage.rotate(rgb[:, :, cuts[2, cut]], 90), 0, 1))
-            img = tmpd / f"{cut}.png"
-            plt.axis("off")
-            plt.savefig(
-                img,
-                backend="Agg",
-                pil_kwargs={"compress_level": 9},
-                bbox_inches="tight",
+            .with_columns(match=pl.col("img") == pl.col("img_right"))
+            .collect()
+        )
+        if joined.select("match").to_series().any():
+            logging.warning("Replacing images")
+            logging.debug(
+                joined.filter(pl.col("match")).drop(
+                    pl.selectors.starts_with("img"), "match"
+                )
             )
-            plt.close()
-            images.append(img)
-
-        frames = np.stack([iio.imread(img) for img in images + images[-2:1:-1]], axis=0)
-
-    with tempfile.NamedTemporaryFile(suffix=".gif") as tf:
-        iio.imwrite(tf.name, frames, loop=0, duration=200)
-        pygifsicle.optimize(tf.name)
-        return tf.read()
+        joined.drop("img_left").write_parquet(dst)
+    else:
+        d.sink_parquet(dst)
@@ -0,0 +1,112 @@
+import collections
+import json
+import logging
+import resource
+import sys
+import time
+import typing as t
+from pathlib import Path
+
+import typer
+from rich import progress
+
+from django_qcapp_ratings import models
+
+ShowProgress = t.Annotated[bool, typer.Option(help="Show a progress bar")]
+Summary = t.Annotated[
+    Path | None,
+    typer.Option(dir_okay=False, help="Write a JSON summary of the run here"),
+]
+
+
+def peak_rss_mib(who: int = resource.RUSAGE_SELF) -> float:
+    """Peak resident memory of this process, or (RUSAGE_CHILDREN) of the
+    largest of its children that have ended, such as --render-processes'."""
+    maxrss = resource.getrusage(who).ru_maxrss
+    # kibibytes on Linux, bytes on macOS
+    return maxrss / (2**20 if sys.platform == "darwin" else 2**10)
+
+
+class Reporter:
+    """Counts what an ingestion run rendered, skipped and wrote."""
+
+    def __init__(self, show: bool = False, summary: Path | None = None) -> None:
+        self.summary_path = summary
+        self.rendered: collections.Counter[str] = collections.Counter()
+        self.skipped: collections.Counter[str] = collections.Counter()
+        self.enqueued: collections.Counter[str] = collections.Counter()
+        self.bytes_written: collections.Counter[str] = collections.Counter()
+        self.stages: collections.Counter[str] = collections.Counter()
+        self.start = time.perf_counter()
+        self._bar = progress.Progress(
+            progress.SpinnerColumn(),
+            progress.TextColumn("{task.description}"),
+            progress.TimeElapsedColumn(),
+            disable=not show,
+        )
+        self._task = self._bar.add_task("starting", total=None)
+
+    def __enter__(self) -> "Reporter":
+        self._bar.start()
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self._bar.stop()
+        self.finish()
+
+    @property
+    def elapsed_sec(self) -> float:
+        return time.perf_counter() - self.start
+
+    def _refresh(self) -> None:
+        n = self.rendered.total()
+        self._bar.update(
+            self._task,
+            completed=n,
+            description=(
+                f"{n} rendered, {self.skipped.total()} skipped, "
+                f"{self.enqueued.total()} enqueued, "
+                f"{n / self.elapsed_sec:.2f} figures/s"
+            ),
+        )
+
+    def skip(self, step: models.Step, n: int) -> None:
+        self.skipped[step.name] += n
+        self._refresh()
+
+    def enqueue(self, step: models.Step, n: int) -> None:
+        self.enqueued[step.name] += n
+        self._refresh()
+
+    def add(self, image: models.Image, n_bytes: int | None = None) -> None:
+        step = models.Step(image.step).name
+        self.rendered[step] += 1
+        self.bytes_written[step] += len(image.img) if n_bytes is None else n_bytes
+        self._refresh()
+
+    def summary(self) -> dict[str, t.Any]:
+        elapsed = self.elapsed_sec
+        return {
+            "elapsed_sec": elapsed,
+            "figures_per_sec": self.rendered.total() / elapsed,
+            "rendered": dict(self.rendered),
+            "skipped": dict(self.skipped),
+            "enqueued": dict(self.enqueued),
+            "bytes_written": dict(self.bytes_written),
+            "stages_sec": dict(self.stages),
+            "peak_rss_mib": peak_rss_mib(),
+            "peak_child_rss_mib": peak_rss_mib(resource.RUSAGE_CHILDREN),
+        }
+
+    def finish(self) -> None:
+        summary = self.summary()
+        logging.info(
+            f"rendered {self.rendered.total()} figures "
+            f"({summary['figures_per_sec']:.2f}/s, "
+            f"{self.bytes_written.total() / 2**20:.1f} MiB), "
+            f"skipped {self.skipped.total()}, enqueued {self.enqueued.total()}, "
+            f"peak RSS {summary['peak_rss_mib']:.0f} MiB "
+            f"({summary['peak_child_rss_mib']:.0f} MiB in a child process)"
+        )
+        if self.summary_path is not None:
+            self.summary_path.write_text(json.dumps(summary, indent=2))
@@ -0,0 +1,197 @@
+"""Quantized slices with overlay bitmasks, composited in the browser.
+
+A slice is stored as a little-endian header followed by a zlib stream:
+
+    b"QCS1", uint16 width, uint16 height, uint8 scale, uint8 n_overlays,
+    then one RGBA color (4 x uint8) per overlay
+
+The stream holds width * height uint8 intensities, row by row from the top,
+then one np.packbits bitmask per overlay. Once inflated, every array sits at a
+fixed offset, so it can be viewed in place (np.frombuffer, a typed array in
+static/ratings/clicks.js). The browser draws each voxel as a scale x scale
+square, so clicks are in that upscaled pixel space.
+
+That space is not the one of the figures: a slice is width * scale pixels
+wide, with no padding, where a figure is as large as matplotlib drew it. Clicks
+keep the pixels of the image they were made on, with Image.format telling them
+apart. Compare them across formats in RAS only, through the pixel_affine
+of each image (selectors.get_clicked_world_points).
+"""
+
+import struct
+import typing as t
+import zlib
+
+import nibabel as nb
+import numpy as np
+import numpy.typing as npt
+from nilearn import image
+from scipy import ndimage
+
+from django_qcapp_ratings import models
+
+from . import _private
+
+MAGIC = b"QCS1"
+HEADER = struct.Struct("<4sHHBB")
+# about the width of the matplotlib figures
+TARGET_WIDTH = 640
+ZLIB_LEVEL = 6
+
+MASK_COLOR = (0, 128, 0, 128)
+WHITE_COLOR = (0, 0, 255, 255)
+PIAL_COLOR = (255, 0, 0, 255)
+
+Overlay = tuple[npt.NDArray[np.bool_], tuple[int, int, int, int]]
+Figure = tuple[int | None, int]
+Slice = tuple[Figure, bytes, list[list[float]]]
+
+
+def get_scale(width: int) -> int:
+    return max(1, round(TARGET_WIDTH / width))
+
+
+def pack(background: npt.NDArray[np.uint8], overlays: list[Overlay]) -> bytes:
+    height, width = background.shape
+    scale = get_scale(width)
+    header = HEADER.pack(MAGIC, width, height, scale, len(overlays))
+    colors = b"".join(bytes(color) for _, color in overlays)
+    body = [np.ascontiguousarray(background, dtype=np.uint8).tobytes()]
+    body += [np.packbits(mask, axis=None).tobytes() for mask, _ in overlays]
+    return header + colors + zlib.compress(b"".join(body), ZLIB_LEVEL)
+
+
+def unpack(blob: bytes) -> tuple[npt.NDArray[np.uint8], list[Overlay], int]:
+    """Background, overlays and scale of a packed slice."""
+    magic, width, height, scale, n_overlays = HEADER.unpack_from(blob)
+    if magic != MAGIC:
+        raise ValueError("Not a packed slice")
+    offset = HEADER.size
+    colors = [
+        tuple(blob[offset + 4 * i : offset + 4 * (i + 1)]) for i in range(n_overlays)
+    ]
+    body = zlib.decompress(blob[offset + 4 * n_overlays :])
+    n = width * height
+    background = np.frombuffer(body, dtype=np.uint8, count=n).reshape(height, width)
+    mask_bytes = -(-n // 8)
+    overlays = [
+        (
+            np.unpackbits(
+                np.frombuffer(body, np.uint8, mask_bytes, n + i * mask_bytes),
+                count=n,
+            )
+            .astype(bool)
+            .reshape(height, width),
+            color,
+        )
+        for i, color in enumerate(colors)
+    ]
+    return background, overlays, scale  # type: ignore
+
+
+def quantize(data: npt.NDArray, vmax: float) -> npt.NDArray[np.uint8]:
+    if vmax <= 0:
+        return np.zeros(data.shape, dtype=np.uint8)
+    return np.clip(data * (255 / vmax), 0, 255).astype(np.uint8)
+
+
+def take(volume: npt.NDArray, display: int, index: int) -> npt.NDArray:
+    """The plane of a canonical (RAS) volume, oriented with superior (or, for
+    axial planes, anterior) at the top."""
+    return np.take(volume, index, axis=display).T[::-1]
+
+
+def pixel_affine(
+    nii: nb.nifti1.Nifti1Image, display: int, index: int
+) -> list[list[float]]:
+    """Affine from pixels of a drawn slice (x, y from the top left, 0, 1) to RAS.
+
+    nii is the canonical volume that the slice was taken from.
+    """
+    u, v = _private.in_plane_axes(models.DisplayMode(display))
+    scale = get_scale(nii.shape[u])
+    # pixel centers are at voxel centers; rows run against the v axis (see take)
+    to_voxels = np.zeros((4, 4))
+    to_voxels[u, [0, 3]] = 1 / scale, -0.5
+    to_voxels[v, [1, 3]] = -1 / scale, nii.shape[v] - 0.5
+    to_voxels[display, 3] = index
+    to_voxels[3, 3] = 1.0
+    return (nii.affine @ to_voxels).tolist()
+
+
+def outline(mask: npt.NDArray[np.bool_]) -> npt.NDArray[np.bool_]:
+    return mask & ~ndimage.binary_erosion(mask)
+
+
+def _indices(
+    reference: nb.nifti1.Nifti1Image, figures: t.Iterable[Figure]
+) -> dict[Figure, int]:
+    with _private.stage("cuts"):
+        ijk = _private.cuts_from_bbox_ijk(reference, cuts=_private.N_CUTS)
+    shape = reference.shape
+    return {
+        (cut, display): int(np.clip(np.round(ijk[display, cut]), 0, shape[display] - 1))
+        for cut, display in figures
+        if cut is not None
+    }
+
+
+def _canonical(
+    nii: nb.nifti1.Nifti1Image, like: nb.nifti1.Nifti1Image | None = None
+) -> nb.nifti1.Nifti1Image:
+    if like is not None and (
+        nii.shape[:3] != like.shape[:3] or not np.allclose(nii.affine, like.affine)
+    ):
+        nii = image.resample_to_img(nii, like, interpolation="nearest")
+    return nb.funcs.as_closest_canonical(nii)
+
+
+def get_mask_slices(
+    file_nii: nb.nifti1.Nifti1Image,
+    mask_nii: nb.nifti1.Nifti1Image,
+    figures: list[Figure],
+) -> t.Iterator[Slice]:
+    mask_nii = _canonical(mask_nii, like=file_nii)
+    file_nii = _canonical(file_nii)
+    anat = np.asanyarray(file_nii.dataobj, dtype=np.float32)
+    mask = np.asanyarray(mask_nii.dataobj) > 0
+    with _private.stage("quantiles"):
+        vmax = float(np.quantile(anat, 0.95))
+    for figure, index in _indices(mask_nii, figures).items():
+        display = figure[1]
+        with _private.stage("encode"):
+            blob = pack(
+                quantize(take(anat, display, index), vmax),
+                [(take(mask, display, index), MASK_COLOR)],
+            )
+        yield figure, blob, pixel_affine(file_nii, display, index)
+
+
+def get_surface_localization_slices(
+    brain_nii: nb.nifti1.Nifti1Image,
+    ribbon_nii: nb.nifti1.Nifti1Image,
+    figures: list[Figure],
+) -> t.Iterator[Slice]:
+    ribbon_nii = _canonical(ribbon_nii, like=brain_nii)
+    brain_nii = _canonical(brain_nii)
+    brain = np.asanyarray(brain_nii.dataobj, dtype=np.float32)
+    with _private.stage("contours"):
+        ribbon = np.asanyarray(ribbon_nii.dataobj) % 39
+        white, pial = ribbon == 2, ribbon >= 2
+    with _private.stage("quantiles"):
+        vmax = float(np.quantile(brain, 0.99))
+    for figure, index in _indices(ribbon_nii, figures).items():
+        display = figure[1]
+        with _private.stage("encode"):
+            blob = pack(
+                quantize(take(brain, display, index), vmax),
+                [
+                    (outline(take(white, display, index)), WHITE_COLOR),
+                    (outline(take(pial, display, index)), PIAL_COLOR),
+                ],
+            )
+        yield figure, blob, pixel_affine(brain_nii, display, index)
+
+
+def is_supported(step: models.Step) -> bool:
+    return step in (models.Step.MASK, models.Step.SURFACE_LOCALIZATION)
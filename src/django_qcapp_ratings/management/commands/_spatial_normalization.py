@@ -0,0 +1,36 @@
+import io
+
+import nibabel as nb
+from nilearn import plotting
+from nilearn.plotting import displays
+
+from django_qcapp_ratings import datasets, models
+
+from . import _figures, _private
+
+
+def get_spatial_normalization(
+    cut: int,
+    file_nii: nb.nifti1.Nifti1Image,
+    display_mode: models.DisplayMode,
+    figsize: tuple[float, float] = (6.4, 4.8),
+) -> tuple[bytes, list[list[float]]]:
+    if cut > 2:
+        raise ValueError("Unknown cut")
+    cut_coord = _private.SPATIAL_NORMALIZATION_CUTS[display_mode.name.lower()][cut]
+
+    f = _figures.new_figure(figsize)
+    with io.BytesIO() as img:
+        with _private.stage("plot"):
+            p: displays.OrthoSlicer = plotting.plot_roi(
+                roi_img=datasets.get_layout(),
+                bg_img=file_nii,
+                cut_coords=[cut_coord],
+                display_mode=display_mode.name.lower(),
+                figure=f,
+                colorbar=False,
+            )  # type: ignore
+        with _private.stage("encode"):
+            _figures.savefig(p, img)
+        affine = _figures.pixel_affine(p, display_mode, cut_coord)
+        return img.getvalue(), affine
@@ -0,0 +1,45 @@
+import io
+
+import nibabel as nb
+from nilearn import image, plotting
+from nilearn.plotting import displays
+
+from django_qcapp_ratings import models
+
+from . import _figures, _private
+
+
+def get_surface_localization(
+    cut: int,
+    brain_nii: nb.nifti1.Nifti1Image,
+    ribbon_nii: nb.nifti1.Nifti1Image,
+    display_mode: models.DisplayMode = models.DisplayMode(models.DisplayMode.X),
+    figsize: tuple[float, float] = (6.4, 4.8),
+    linewidths=0.5,
+    levels: list[float] = [0.5],
+    volume: models.Volume | None = None,
+) -> tuple[bytes, list[list[float]]]:
+    cuts = _private.get_cuts(display_mode, mask_nii=ribbon_nii, volume=volume)
+    f = _figures.new_figure(figsize)
+    with _private.stage("contours"):
+        contour_data = ribbon_nii.get_fdata() % 39
+        white = image.new_img_like(ribbon_nii, contour_data == 2)
+        pial = image.new_img_like(ribbon_nii, contour_data >= 2)
+    with io.BytesIO() as img:
+        with _private.stage("plot"):
+            p: displays.OrthoSlicer = plotting.plot_anat(
+                brain_nii,
+                cut_coords=[cuts[cut]],
+                display_mode=display_mode.name.lower(),
+                figure=f,
+                colorbar=False,
+            )  # type: ignore
+            try:
+                p.add_contours(white, colors="b", linewidths=linewidths, levels=levels)
+                p.add_contours(pial, colors="r", linewidths=linewidths, levels=levels)
+            except ValueError:
+                pass
+        with _private.stage("encode"):
+            _figures.savefig(p, img)
+        affine = _figures.pixel_affine(p, display_mode, cuts[cut])
+        return img.getvalue(), affine
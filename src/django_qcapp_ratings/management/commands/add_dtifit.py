@@ -1,16 +1,22 @@
-import asyncio
 import logging
 import typing as t
 from pathlib import Path
 
-import nibabel as nb
 import typer
 from django_typer.completers import path
 from django_typer.management import TyperCommand
 
 from django_qcapp_ratings import models
 
-from . import _private
+from . import _discovery, _ingest, _progress
+
+PATTERN = "*dwi_FA.nii.gz"
+
+
+def find(path: Path) -> list[_discovery.Entry]:
+    if path.is_dir():
+        return [{"fa": str(fa)} for fa in path.rglob(PATTERN)]
+    return [{"fa": str(path)}] if path.match(PATTERN) else []
 
 
 class Command(TyperCommand):
@@ -29,54 +35,45 @@ class Command(TyperCommand):
         update: t.Annotated[
             bool, typer.Option(help="Whether to update img in database")
         ] = False,
+        threads: _discovery.Threads = 8,
+        manifest: _discovery.Manifest = None,
+        refresh_manifest: _discovery.RefreshManifest = False,
+        distributed: _ingest.Distributed = False,
+        wait: _ingest.Wait = True,
+        render_processes: _ingest.RenderProcesses = 1,
+        show_progress: _progress.ShowProgress = False,
+        summary: _progress.Summary = None,
     ):
         """
         Add surface localization figures
         """
 
-        for fa in subjects_dir.rglob("*dwi_FA.nii.gz"):
-            logging.info(f"{fa=}")
-            if (
-                image := models.Image.objects.filter(
-                    display=models.DisplayMode.Z, step=models.Step.DTIFIT, file1=fa.name
-                )
-            ).exists():
-                if not update:
-                    logging.info("Found object. Skipping")
-                    continue
-                else:
-                    i = _private.get_dtifit(
-                        nii=nb.nifti1.Nifti1Image.load(fa),
-                        v1=nb.nifti1.Nifti1Image.load(
-                            fa.with_name(fa.name.replace("FA", "V1"))
-                        ),
-                        v2=nb.nifti1.Nifti1Image.load(
-                            fa.with_name(fa.name.replace("FA", "V2"))
-                        ),
-                        v3=nb.nifti1.Nifti1Image.load(
-                            fa.with_name(fa.name.replace("FA", "V3"))
-                        ),
-                    )
-                    asyncio.run(image.aupdate(img=i))
-
-            else:
-                i = _private.get_dtifit(
-                    nii=nb.nifti1.Nifti1Image.load(fa),
-                    v1=nb.nifti1.Nifti1Image.load(
-                        fa.with_name(fa.name.replace("FA", "V1"))
-                    ),
-                    v2=nb.nifti1.Nifti1Image.load(
-                        fa.with_name(fa.name.replace("FA", "V2"))
-                    ),
-                    v3=nb.nifti1.Nifti1Image.load(
-                        fa.with_name(fa.name.replace("FA", "V3"))
+        def jobs() -> t.Iterator[_ingest.RenderJob]:
+            for entry in _discovery.discover(
+                subjects_dir.iterdir(),
+                find=find,
+                threads=threads,
+                manifest=manifest,
+                refresh=refresh_manifest,
+                key={"subjects_dir": str(subjects_dir.resolve()), "pattern": PATTERN},
+            ):
+                fa = Path(entry["fa"])
+                logging.info(f"{fa=}")
+                yield _ingest.RenderJob(
+                    step=models.Step.DTIFIT,
+                    file1=fa.name,
+                    file2=None,
+                    paths={"fa": str(fa)},
+                    figures=_ingest.missing_figures(
+                        models.Step.DTIFIT, fa.name, update=update
                     ),
                 )
-                asyncio.run(
-                    models.Image.objects.acreate(
-                        img=i,
-                        display=models.DisplayMode.Z,
-                        step=models.Step.DTIFIT,
-                        file1=fa.name,
-                    )
-                )
+
+        _ingest.run(
+            jobs(),
+            distributed=distributed,
+            wait=wait,
+            show_progress=show_progress,
+            summary=summary,
+            processes=render_processes,
+        )
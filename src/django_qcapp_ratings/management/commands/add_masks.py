@@ -1,8 +1,6 @@
-import logging
 import typing as t
 from pathlib import Path
 
-import nibabel as nb
 import polars as pl
 import typer
 from django_typer.completers import path
@@ -10,7 +8,7 @@ from django_typer.management import TyperCommand
 
 from django_qcapp_ratings import models
 
-from . import _private
+from . import _ingest, _progress
 
 
 class Command(TyperCommand):
@@ -26,6 +24,14 @@ class Command(TyperCommand):
                 shell_complete=path.paths,
             ),
         ],
+        distributed: _ingest.Distributed = False,
+        per_figure: _ingest.PerFigure = False,
+        wait: _ingest.Wait = True,
+        mosaic: _ingest.Mosaic = False,
+        slices: _ingest.Slices = False,
+        render_processes: _ingest.RenderProcesses = 1,
+        show_progress: _progress.ShowProgress = False,
+        summary: _progress.Summary = None,
     ):
         """
         Add Masks from BIDS Table
@@ -46,35 +52,24 @@ class Command(TyperCommand):
 
         anats = [x.replace("desc-brain_mask", "T1w") for x in masks]
 
-        for mask, anat in zip(masks, anats):
-            logging.info(f"{mask=}")
-            mask_nii = nb.nifti1.Nifti1Image.load(mask)
-            file_nii = nb.nifti1.Nifti1Image.load(anat)
-            file1 = Path(mask).name
-            for display_mode in models.DisplayMode.choices:
-                logging.info(f"{display_mode=}")
-                for cut in range(_private.N_CUTS):
-                    logging.info(f"{cut=}")
-                    if models.Image.objects.filter(
-                        slice=cut,
-                        display=display_mode[0],
-                        step=models.Step.MASK,
-                        file1=file1,
-                    ).exists():
-                        logging.info("Found object. Skipping")
-                        continue
-
-                    i = _private.get_mask(
-                        cut=cut,
-                        display_mode=models.DisplayMode(display_mode[0]),
-                        mask_nii=mask_nii,
-                        file_nii=file_nii,
-                    )
-                    models.Image.objects.create(
-                        img=i,
-                        slice=cut,
-                        display=display_mode[0],
-                        step=models.Step.MASK,
-                        file1=file1,
-                        file2=Path(anat).name,
-                    )
+        jobs = (
+            _ingest.RenderJob(
+                step=models.Step.MASK,
+                file1=Path(mask).name,
+                file2=Path(anat).name,
+                paths={"mask": mask, "anat": anat},
+                figures=_ingest.missing_figures(models.Step.MASK, Path(mask).name),
+            )
+            for mask, anat in zip(masks, anats)
+        )
+        _ingest.run(
+            jobs,
+            distributed=distributed,
+            per_figure=per_figure,
+            wait=wait,
+            show_progress=show_progress,
+            summary=summary,
+            mosaic=mosaic,
+            slices=slices,
+            processes=render_processes,
+        )
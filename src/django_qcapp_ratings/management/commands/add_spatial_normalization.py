@@ -1,9 +1,6 @@
-import asyncio
-import logging
 import typing as t
 from pathlib import Path
 
-import nibabel as nb
 import polars as pl
 import typer
 from django_typer.completers import path
@@ -11,7 +8,7 @@ from django_typer.management import TyperCommand
 
 from django_qcapp_ratings import models
 
-from . import _private
+from . import _ingest, _progress
 
 
 class Command(TyperCommand):
@@ -30,6 +27,13 @@ class Command(TyperCommand):
         update: t.Annotated[
             bool, typer.Option(help="Whether to update img in database")
         ] = False,
+        distributed: _ingest.Distributed = False,
+        per_figure: _ingest.PerFigure = False,
+        wait: _ingest.Wait = True,
+        mosaic: _ingest.Mosaic = False,
+        render_processes: _ingest.RenderProcesses = 1,
+        show_progress: _progress.ShowProgress = False,
+        summary: _progress.Summary = None,
     ):
         """
         Add surface localization figures
@@ -49,38 +53,25 @@ class Command(TyperCommand):
             .to_list()
         )
 
-        for anat in anats:
-            logging.info(f"{anat=}")
-            file_nii = nb.nifti1.Nifti1Image.load(anat)
-            file1 = Path(anat).name
-            for display_mode in models.DisplayMode.choices:
-                logging.info(f"{display_mode=}")
-                for cut in range(3):
-                    logging.info(f"{cut=}")
-                    if (
-                        i := models.Image.objects.filter(
-                            slice=cut,
-                            display=display_mode[0],
-                            step=models.Step.SPATIAL_NORMALIZATION,
-                            file1=file1,
-                        )
-                    ).exists():
-                        if not update:
-                            logging.info("Found object. Skipping")
-                            continue
-                        else:
-                            i.delete()
-                    i = _private.get_spatial_normalization(
-                        cut=cut,
-                        display_mode=models.DisplayMode(display_mode[0]),
-                        file_nii=file_nii,
-                    )
-                    asyncio.run(
-                        models.Image.objects.acreate(
-                            img=i,
-                            slice=cut,
-                            display=display_mode[0],
-                            step=models.Step.SPATIAL_NORMALIZATION,
-                            file1=file1,
-                        )
-                    )
+        jobs = (
+            _ingest.RenderJob(
+                step=models.Step.SPATIAL_NORMALIZATION,
+                file1=Path(anat).name,
+                file2=None,
+                paths={"anat": anat},
+                figures=_ingest.missing_figures(
+                    models.Step.SPATIAL_NORMALIZATION, Path(anat).name, update=update
+                ),
+            )
+            for anat in anats
+        )
+        _ingest.run(
+            jobs,
+            distributed=distributed,
+            per_figure=per_figure,
+            wait=wait,
+            show_progress=show_progress,
+            summary=summary,
+            mosaic=mosaic,
+            processes=render_processes,
+        )
@@ -1,4 +1,3 @@
-import asyncio
 import logging
 import typing as t
 from pathlib import Path
@@ -10,7 +9,7 @@ from neurorm import freesurfer
 
 from django_qcapp_ratings import models
 
-from . import _private
+from . import _discovery, _ingest, _progress
 
 
 class Command(TyperCommand):
@@ -28,53 +27,81 @@ class Command(TyperCommand):
         ],
         include: t.Annotated[list[str] | None, typer.Option()] = None,
         exclude: t.Annotated[list[str] | None, typer.Option()] = None,
+        threads: _discovery.Threads = 8,
+        manifest: _discovery.Manifest = None,
+        refresh_manifest: _discovery.RefreshManifest = False,
+        distributed: _ingest.Distributed = False,
+        per_figure: _ingest.PerFigure = False,
+        wait: _ingest.Wait = True,
+        mosaic: _ingest.Mosaic = False,
+        slices: _ingest.Slices = False,
+        render_processes: _ingest.RenderProcesses = 1,
+        show_progress: _progress.ShowProgress = False,
+        summary: _progress.Summary = None,
     ):
         """
         Add surface localization figures
         """
 
-        for sub in subjects_dir.glob("*"):
-            if include and sub.name not in include:
-                logging.info(
-                    f"--include specified but {sub.name} not in list. Excluding"
-                )
-                continue
-            if exclude and sub.name in exclude:
-                logging.info(f"--exclude specified and {sub.name} in list. Excluding")
-                continue
+        def subjects() -> t.Iterator[Path]:
+            for sub in subjects_dir.glob("*"):
+                if include and sub.name not in include:
+                    logging.info(
+                        f"--include specified but {sub.name} not in list. Excluding"
+                    )
+                    continue
+                if exclude and sub.name in exclude:
+                    logging.info(
+                        f"--exclude specified and {sub.name} in list. Excluding"
+                    )
+                    continue
+                yield sub
+
+        def find(sub: Path) -> list[_discovery.Entry]:
             fs = freesurfer.FreeSurferSubject.from_subjects_dir(
                 subjects_dir=subjects_dir, subject_id=sub.name
             )
-            brain_nii = _private.mgz_to_nifti(fs.mri.brain)
-            ribbon_nii = _private.mgz_to_nifti(fs.mri.ribbon)
-            file1 = str(fs.mri.ribbon.relative_to(subjects_dir))
-            logging.info(f"{file1=}")
-            for display_mode in models.DisplayMode.choices:
-                logging.info(f"{display_mode=}")
-                for cut in range(_private.N_CUTS):
-                    logging.info(f"{cut=}")
-                    if models.Image.objects.filter(
-                        slice=cut,
-                        display=display_mode[0],
-                        step=models.Step.SURFACE_LOCALIZATION,
-                        file1=file1,
-                    ).exists():
-                        logging.info("Found object. Skipping")
-                        continue
+            return [
+                {
+                    "file1": str(fs.mri.ribbon.relative_to(subjects_dir)),
+                    "file2": str(fs.mri.brain.relative_to(subjects_dir)),
+                    "brain": str(fs.mri.brain),
+                    "ribbon": str(fs.mri.ribbon),
+                }
+            ]
 
-                    i = _private.get_surface_localization(
-                        cut=cut,
-                        display_mode=models.DisplayMode(display_mode[0]),
-                        brain_nii=brain_nii,
-                        ribbon_nii=ribbon_nii,
-                    )
-                    asyncio.run(
-                        models.Image.objects.acreate(
-                            img=i,
-                            slice=cut,
-                            display=display_mode[0],
-                            step=models.Step.SURFACE_LOCALIZATION,
-                            file1=file1,
-                            file2=str(fs.mri.brain.relative_to(subjects_dir)),
-                        )
-                    )
+        def jobs() -> t.Iterator[_ingest.RenderJob]:
+            for entry in _discovery.discover(
+                subjects(),
+                find=find,
+                threads=threads,
+                manifest=manifest,
+                refresh=refresh_manifest,
+                key={
+                    "subjects_dir": str(subjects_dir.resolve()),
+                    "include": sorted(include or []),
+                    "exclude": sorted(exclude or []),
+                },
+            ):
+                logging.info(f"file1={entry['file1']}")
+                yield _ingest.RenderJob(
+                    step=models.Step.SURFACE_LOCALIZATION,
+                    file1=entry["file1"],
+                    file2=entry["file2"],
+                    paths={"brain": entry["brain"], "ribbon": entry["ribbon"]},
+                    figures=_ingest.missing_figures(
+                        models.Step.SURFACE_LOCALIZATION, entry["file1"]
+                    ),
+                )
+
+        _ingest.run(
+            jobs(),
+            distributed=distributed,
+            per_figure=per_figure,
+            wait=wait,
+            show_progress=show_progress,
+            summary=summary,
+            mosaic=mosaic,
+            slices=slices,
+            processes=render_processes,
+        )
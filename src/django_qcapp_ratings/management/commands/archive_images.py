@@ -0,0 +1,42 @@
+import logging
+import typing as t
+
+import typer
+from django_typer.management import TyperCommand
+
+from django_qcapp_ratings import archive, services
+
+
+class Command(TyperCommand):
+    def handle(
+        self,
+        restore: t.Annotated[
+            bool, typer.Option(help="Move archived blobs back into the database")
+        ] = False,
+        image_id: t.Annotated[
+            list[int] | None,
+            typer.Option(help="With --restore, the images to restore (default: all)"),
+        ] = None,
+        target: t.Annotated[
+            int | None,
+            typer.Option(help="Ratings needed to archive (default: target ratings)"),
+        ] = None,
+        batch_size: t.Annotated[int, typer.Option()] = archive.DEFAULT_BATCH_SIZE,
+    ):
+        """
+        Move the blobs of fully rated images to compressed pack files
+
+        Packs are written to QCAPP_ARCHIVE_DIR. Archived images are still served.
+        """
+
+        if restore:
+            n = archive.restore(image_ids=image_id, batch_size=batch_size)
+            logging.info(f"Restored {n} images")
+            return
+
+        target = services.get_target_ratings() if target is None else target
+        if target is None:
+            raise typer.BadParameter("Set QCAPP_TARGET_RATINGS or pass --target")
+        services.refresh_rollups()
+        n = archive.archive(target, batch_size=batch_size)
+        logging.info(f"Archived {n} images")
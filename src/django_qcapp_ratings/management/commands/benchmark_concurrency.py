@@ -0,0 +1,70 @@
+import json
+import typing as t
+from pathlib import Path
+
+import typer
+from django.core.management import CommandError
+from django.test import utils
+from django_typer.management import TyperCommand
+
+from django_qcapp_ratings import models
+from django_qcapp_ratings.benchmarks import concurrency, seed
+
+
+class Command(TyperCommand):
+    def handle(
+        self,
+        n_images: t.Annotated[
+            int, typer.Option(help="Synthetic images to create per step")
+        ] = 10_000,
+        raters: t.Annotated[
+            int, typer.Option(help="Concurrent simulated raters per step")
+        ] = 10,
+        cycles: t.Annotated[int, typer.Option(help="Images rated by each rater")] = 20,
+        step: t.Annotated[
+            list[int] | None, typer.Option(help="Steps to benchmark (default: all)")
+        ] = None,
+        image_kib: t.Annotated[
+            int, typer.Option(help="Size of each ingested image")
+        ] = concurrency.IMAGE_BYTES // 2**10,
+        max_p99_ms: t.Annotated[
+            float, typer.Option(help="Fail if a rater endpoint's p99 is slower")
+        ] = 1000.0,
+        output: t.Annotated[
+            Path | None, typer.Option(dir_okay=False, help="Write results as JSON")
+        ] = None,
+        cleanup: t.Annotated[
+            bool, typer.Option(help="Delete the synthetic rows afterwards")
+        ] = True,
+    ):
+        """
+        Simulate raters during an ingestion and check that latency stays bounded
+
+        This writes to the configured database, so point it at a scratch copy.
+        Fails if any rater request errors, if an error is logged (e.g., "database
+        is locked" in a background refresh), or if an endpoint's p99 latency
+        exceeds --max-p99-ms.
+        """
+
+        steps = [models.Step(s) for s in step] if step else list(models.Step)
+        for s in steps:
+            seed.seed_images(s, n_images)
+        seed.prepare_serving(steps)
+
+        utils.setup_test_environment()
+        try:
+            results = concurrency.run(
+                steps, n_raters=raters, cycles=cycles, image_bytes=image_kib * 2**10
+            )
+        finally:
+            utils.teardown_test_environment()
+            if cleanup:
+                seed.delete_synthetic()
+
+        report = json.dumps(results, indent=2)
+        if output is None:
+            self.stdout.write(report)
+        else:
+            output.write_text(report)
+        if found := concurrency.violations(results, max_p99_ms=max_p99_ms):
+            raise CommandError("\n".join(found))
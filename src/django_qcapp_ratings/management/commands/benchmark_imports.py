@@ -0,0 +1,36 @@
+import json
+import typing as t
+from pathlib import Path
+
+import typer
+from django_typer.management import TyperCommand
+
+from django_qcapp_ratings.benchmarks import imports
+
+
+class Command(TyperCommand):
+    def handle(
+        self,
+        module: t.Annotated[
+            list[str] | None,
+            typer.Option(help="Modules to import (default: commands and views)"),
+        ] = None,
+        runs: t.Annotated[int, typer.Option(help="Fresh interpreters per module")] = 5,
+        top: t.Annotated[
+            int, typer.Option(help="Heaviest dependencies to list per module")
+        ] = 10,
+        output: t.Annotated[
+            Path | None, typer.Option(dir_okay=False, help="Write results as JSON")
+        ] = None,
+    ):
+        """
+        Time cold imports of the management commands and web entry points
+
+        Each run starts a new interpreter with -X importtime, after django.setup().
+        """
+
+        report = json.dumps(imports.run(module, runs=runs, top=top), indent=2)
+        if output is None:
+            self.stdout.write(report)
+        else:
+            output.write_text(report)
@@ -0,0 +1,61 @@
+import asyncio
+import json
+import typing as t
+from pathlib import Path
+
+import typer
+from django.test import utils
+from django_typer.management import TyperCommand
+
+from django_qcapp_ratings import models
+from django_qcapp_ratings.benchmarks import load, seed
+
+
+class Command(TyperCommand):
+    def handle(
+        self,
+        n_images: t.Annotated[
+            int, typer.Option(help="Synthetic images to create per step")
+        ] = 10_000,
+        ratings_per_image: t.Annotated[
+            float, typer.Option(help="Average synthetic ratings per image")
+        ] = 1.0,
+        raters: t.Annotated[
+            int, typer.Option(help="Concurrent simulated raters per step")
+        ] = 10,
+        cycles: t.Annotated[int, typer.Option(help="Images rated by each rater")] = 20,
+        step: t.Annotated[
+            list[int] | None, typer.Option(help="Steps to benchmark (default: all)")
+        ] = None,
+        output: t.Annotated[
+            Path | None, typer.Option(dir_okay=False, help="Write results as JSON")
+        ] = None,
+        cleanup: t.Annotated[
+            bool, typer.Option(help="Delete the synthetic rows afterwards")
+        ] = True,
+    ):
+        """
+        Simulate concurrent raters and report latency per endpoint
+
+        This writes to the configured database, so point it at a scratch copy.
+        """
+
+        steps = [models.Step(s) for s in step] if step else list(models.Step)
+        for s in steps:
+            image_ids = seed.seed_images(s, n_images)
+            seed.seed_ratings(s, image_ids, ratings_per_image)
+        seed.prepare_serving(steps)
+
+        utils.setup_test_environment()
+        try:
+            results = asyncio.run(load.run(steps, n_raters=raters, cycles=cycles))
+        finally:
+            utils.teardown_test_environment()
+            if cleanup:
+                seed.delete_synthetic()
+
+        report = json.dumps(results, indent=2)
+        if output is None:
+            self.stdout.write(report)
+        else:
+            output.write_text(report)
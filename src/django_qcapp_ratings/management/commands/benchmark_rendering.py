@@ -0,0 +1,48 @@
+import json
+import typing as t
+from pathlib import Path
+
+import typer
+from django.core.management.base import CommandError
+from django_typer.management import TyperCommand
+
+from django_qcapp_ratings.benchmarks import rendering
+
+
+class Command(TyperCommand):
+    def handle(
+        self,
+        function: t.Annotated[
+            list[str] | None,
+            typer.Option(help="Rendering functions to time (default: all)"),
+        ] = None,
+        repeats: t.Annotated[int, typer.Option(help="Timed calls per function")] = 5,
+        output: t.Annotated[
+            Path | None, typer.Option(dir_okay=False, help="Write results as JSON")
+        ] = None,
+        smoke: t.Annotated[
+            bool,
+            typer.Option(
+                help="Only render one figure per function, failing on any error"
+            ),
+        ] = False,
+    ):
+        """
+        Time each figure renderer on synthetic volumes, by stage
+
+        No data are needed: inputs are generated with realistic sizes.
+        """
+
+        if smoke:
+            results = rendering.smoke(function)
+        else:
+            results = rendering.run(function, repeats=repeats)
+        report = json.dumps(results, indent=2)
+        if output is None:
+            self.stdout.write(report)
+        else:
+            output.write_text(report)
+        if smoke and (
+            found := [f"{name}: {err}" for name, err in results.items() if err]
+        ):
+            raise CommandError("\n".join(found))
@@ -0,0 +1,108 @@
+import functools
+import time
+import typing as t
+
+import typer
+from asgiref import sync
+from django.db import connection, transaction
+from django_typer.management import TyperCommand
+
+from django_qcapp_ratings import models, selectors, services
+from django_qcapp_ratings.benchmarks import seed, stats
+
+
+class Command(TyperCommand):
+    def handle(
+        self,
+        n_images: t.Annotated[
+            int, typer.Option(help="Synthetic images to create per step")
+        ] = 10_000,
+        ratings_per_image: t.Annotated[
+            float, typer.Option(help="Average synthetic ratings per image")
+        ] = 2.0,
+        repeats: t.Annotated[int, typer.Option(help="Selector calls per step")] = 20,
+        step: t.Annotated[
+            list[int] | None, typer.Option(help="Steps to benchmark (default: all)")
+        ] = None,
+        explain: t.Annotated[
+            bool, typer.Option(help="Print the plans of the queue and priority queries")
+        ] = True,
+        keep: t.Annotated[
+            bool, typer.Option(help="Keep the synthetic rows instead of rolling back")
+        ] = False,
+    ):
+        """
+        Seed synthetic images and ratings, then time picking the next image
+        """
+
+        steps = [models.Step(s) for s in step] if step else list(models.Step)
+        self.stdout.write(f"database: {connection.vendor}")
+        with transaction.atomic():
+            for s in steps:
+                self._benchmark_step(s, n_images, ratings_per_image, repeats, explain)
+            if not keep:
+                transaction.set_rollback(True)
+
+    def _benchmark_step(
+        self,
+        step: models.Step,
+        n_images: int,
+        ratings_per_image: float,
+        repeats: int,
+        explain: bool,
+    ) -> None:
+        start = time.perf_counter()
+        image_ids = seed.seed_images(step, n_images)
+        n_ratings = seed.seed_ratings(step, image_ids, ratings_per_image)
+        self.stdout.write(
+            f"{step.name}: seeded {len(image_ids)} images and {n_ratings} ratings "
+            f"in {time.perf_counter() - start:.1f}s"
+        )
+
+        start = time.perf_counter()
+        services.refresh_rollups(gap_seconds=0)
+        n_queued = services.refresh_image_order(step)
+        self.stdout.write(
+            f"{step.name}: counted rollups and queued {n_queued} images "
+            f"in {time.perf_counter() - start:.1f}s"
+        )
+
+        if explain:
+            self.stdout.write(
+                models.QueuedImage.objects.filter(step=step)
+                .exclude(image_id=image_ids[0])
+                .order_by("position")
+                .values_list("id", "image_id")
+                .explain()
+            )
+            self.stdout.write(
+                models.ImageRollup.objects.filter(step=step, priority__isnull=False)
+                .exclude(image_id=image_ids[0])
+                .order_by("-priority")
+                .values_list("image_id", flat=True)
+                .explain()
+            )
+
+        # what the views run to pick the next image, blob fetch included
+        timed = {
+            "anext_image": functools.partial(
+                services.anext_image, step, last_pk=image_ids[0]
+            ),
+            "highest_priority_ids": functools.partial(
+                selectors.highest_priority_ids,
+                step,
+                last_pk=image_ids[0],
+                k=services.PRIORITY_TOP_K,
+            ),
+        }
+        for name, call in timed.items():
+            samples = []
+            for _ in range(repeats):
+                start = time.perf_counter()
+                sync.async_to_sync(call)()
+                samples.append(time.perf_counter() - start)
+            summary = stats.summarize(samples)
+            self.stdout.write(
+                f"{step.name} {name}: "
+                + ", ".join(f"{k}={v:.2f}" for k, v in summary.items() if k != "n")
+            )
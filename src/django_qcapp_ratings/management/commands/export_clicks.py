@@ -0,0 +1,45 @@
+import logging
+import typing as t
+from pathlib import Path
+
+import polars as pl
+import typer
+from django_typer.completers import path
+from django_typer.management import TyperCommand
+
+from django_qcapp_ratings import models, selectors
+
+
+class Command(TyperCommand):
+    def handle(
+        self,
+        step: t.Annotated[int, typer.Argument(help="Step whose clicks to export")],
+        dst: t.Annotated[
+            Path,
+            typer.Argument(
+                file_okay=True,
+                dir_okay=False,
+                writable=True,
+                shell_complete=path.paths,
+                help="Parquet file to write",
+            ),
+        ],
+    ):
+        """
+        Export clicked points in world (RAS, mm) coordinates
+        """
+
+        ids, image_ids, formats, xyz = selectors.get_clicked_world_points(
+            models.Step(step)
+        )
+        pl.DataFrame(
+            {
+                "click_id": ids,
+                "image_id": image_ids,
+                "format": formats,
+                "x": xyz[:, 0],
+                "y": xyz[:, 1],
+                "z": xyz[:, 2],
+            }
+        ).write_parquet(dst)
+        logging.info(f"Wrote {len(ids)} points to {dst}")
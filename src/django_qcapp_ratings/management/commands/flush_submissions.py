@@ -0,0 +1,31 @@
+import logging
+import time
+import typing as t
+
+import typer
+from django_typer.management import TyperCommand
+
+from django_qcapp_ratings import writebehind
+
+
+class Command(TyperCommand):
+    def handle(
+        self,
+        interval: t.Annotated[
+            float | None,
+            typer.Option(help="Keep flushing every INTERVAL seconds"),
+        ] = None,
+    ):
+        """
+        Move buffered rating submissions into the database
+        """
+
+        if not writebehind.enabled():
+            raise typer.BadParameter("QCAPP_WRITE_BEHIND_PATH is not set")
+
+        while True:
+            n = writebehind.flush()
+            logging.info(f"flushed {n} submissions")
+            if interval is None:
+                break
+            time.sleep(interval)
@@ -0,0 +1,50 @@
+import logging
+import typing as t
+
+import typer
+from celery import result
+from django_typer.management import TyperCommand
+
+from django_qcapp_ratings import tasks
+
+from . import _ingest
+
+
+class Command(TyperCommand):
+    def handle(
+        self,
+        group_id: t.Annotated[str, typer.Argument(help="Id logged by --distributed")],
+        retry_failed: t.Annotated[
+            bool,
+            typer.Option(
+                help="Re-enqueue failed tasks (requires result_extended=True)"
+            ),
+        ] = False,
+        wait: _ingest.Wait = True,
+    ):
+        """
+        Report progress of a distributed ingestion, optionally retrying failures
+        """
+
+        group = result.GroupResult.restore(group_id)
+        if group is None:
+            raise typer.BadParameter(f"No saved group {group_id}")
+
+        failed = [res for res in group.results if res.failed()]
+        for res in failed:
+            logging.warning(f"{res.id} failed: {res.result!r}")
+
+        if retry_failed and len(failed):
+            jobs = [res.args[0] for res in failed if res.args]
+            if len(jobs) < len(failed):
+                logging.warning("Some failed tasks did not store their arguments")
+            group = tasks.enqueue_render_jobs(jobs)
+            logging.info(f"Re-enqueued {len(jobs)} tasks as {group.id}")
+
+        if wait:
+            _ingest.track(group)
+        else:
+            logging.info(
+                f"{group.id}: {group.completed_count()}/{len(group.results)} "
+                "tasks succeeded"
+            )
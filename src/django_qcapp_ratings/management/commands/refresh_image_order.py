@@ -0,0 +1,35 @@
+import logging
+import typing as t
+
+import typer
+from django_typer.management import TyperCommand
+
+from django_qcapp_ratings import models, services
+
+
+class Command(TyperCommand):
+    def handle(
+        self,
+        step: t.Annotated[
+            list[int] | None, typer.Option(help="Steps to refresh (default: all)")
+        ] = None,
+        target: t.Annotated[
+            int | None,
+            typer.Option(help="Leave out images with this many ratings or more"),
+        ] = None,
+        stratify: t.Annotated[
+            list[str] | None,
+            typer.Option(help="Interleave images by file1 and/or display"),
+        ] = None,
+        seed: t.Annotated[int | None, typer.Option()] = None,
+    ):
+        """
+        Reshuffle the order in which images are shown to raters
+        """
+
+        steps = [models.Step(s) for s in step] if step else list(models.Step)
+        for s in steps:
+            n = services.refresh_image_order(
+                s, target=target, stratify=stratify, seed=seed
+            )
+            logging.info(f"{s.name}: queued {n} images")
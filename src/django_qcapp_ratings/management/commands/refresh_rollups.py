@@ -0,0 +1,26 @@
+import logging
+import typing as t
+
+import typer
+from django_typer.management import TyperCommand
+
+from django_qcapp_ratings import services
+
+
+class Command(TyperCommand):
+    def handle(
+        self,
+        rebuild: t.Annotated[
+            bool, typer.Option(help="Recount everything instead of new rows only")
+        ] = False,
+        batch_size: t.Annotated[int, typer.Option()] = services.ROLLUP_BATCH_SIZE,
+    ):
+        """
+        Count new ratings and clicks into the summary rollups
+        """
+
+        if rebuild:
+            n = services.rebuild_rollups(batch_size=batch_size)
+        else:
+            n = services.refresh_rollups(batch_size=batch_size)
+        logging.info(f"Counted {n} rows")
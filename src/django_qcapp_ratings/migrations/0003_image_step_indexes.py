@@ -0,0 +1,49 @@
+# Generated by Django 5.2.4 on 2026-10-19 09:12
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ratings', '0002_clickedcoordinate_comments_rating_comments_and_more'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='image',
+            index=models.Index(fields=['step', 'id'], name='image_step_id'),
+        ),
+        migrations.AddIndex(
+            model_name='image',
+            index=models.Index(fields=['step', 'file1'], name='image_step_file1'),
+        ),
+        migrations.AddIndex(
+            model_name='image',
+            index=models.Index(condition=models.Q(('step', 0)), fields=['id'], name='image_mask_id'),
+        ),
+        migrations.AddIndex(
+            model_name='image',
+            index=models.Index(condition=models.Q(('step', 1)), fields=['id'], name='image_spatial_normalization_id'),
+        ),
+        migrations.AddIndex(
+            model_name='image',
+            index=models.Index(condition=models.Q(('step', 2)), fields=['id'], name='image_surface_localization_id'),
+        ),
+        migrations.AddIndex(
+            model_name='image',
+            index=models.Index(condition=models.Q(('step', 3)), fields=['id'], name='image_fmap_coregistration_id'),
+        ),
+        migrations.AddIndex(
+            model_name='image',
+            index=models.Index(condition=models.Q(('step', 4)), fields=['id'], name='image_dtifit_id'),
+        ),
+        migrations.AddIndex(
+            model_name='clickedcoordinate',
+            index=models.Index(fields=['image', 'source_data_issue'], name='clickedcoordinate_image_sdi'),
+        ),
+        migrations.AddIndex(
+            model_name='rating',
+            index=models.Index(fields=['image', 'source_data_issue'], name='rating_image_sdi'),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.2.4 on 2026-10-19 11:40
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ratings', '0003_image_step_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='clickedcoordinate',
+            name='points',
+            field=models.BinaryField(editable=False, null=True),
+        ),
+    ]
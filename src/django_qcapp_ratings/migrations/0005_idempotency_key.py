@@ -0,0 +1,23 @@
+# Generated by Django 5.2.4 on 2026-10-19 13:05
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ratings', '0004_clickedcoordinate_points'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='clickedcoordinate',
+            name='idempotency_key',
+            field=models.CharField(editable=False, max_length=64, null=True, unique=True),
+        ),
+        migrations.AddField(
+            model_name='rating',
+            name='idempotency_key',
+            field=models.CharField(editable=False, max_length=64, null=True, unique=True),
+        ),
+    ]
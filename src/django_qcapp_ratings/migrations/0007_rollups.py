@@ -0,0 +1,71 @@
+# Generated by Django 5.2.4 on 2026-10-19 16:02
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ratings', '0006_queuedimage'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RollupCursor',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('model', models.CharField(max_length=64, unique=True)),
+                ('last_id', models.BigIntegerField(default=0)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='ImageRollup',
+            fields=[
+                ('image', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, serialize=False, to='ratings.image')),
+                ('n_pass', models.IntegerField(default=0)),
+                ('n_unsure', models.IntegerField(default=0)),
+                ('n_fail', models.IntegerField(default=0)),
+                ('n_clicks', models.IntegerField(default=0)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='FileRollup',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('n_ratings', models.IntegerField(default=0)),
+                ('n_pass', models.IntegerField(default=0)),
+                ('n_unsure', models.IntegerField(default=0)),
+                ('n_fail', models.IntegerField(default=0)),
+                ('n_source_data_issue', models.IntegerField(default=0)),
+                ('n_clicks', models.IntegerField(default=0)),
+                ('n_images', models.IntegerField(default=0)),
+                ('n_pairs', models.IntegerField(default=0)),
+                ('n_agreeing_pairs', models.IntegerField(default=0)),
+                ('step', models.IntegerField(choices=[(0, 'Mask'), (1, 'Spatial Normalization'), (2, 'Surface Localization'), (3, 'Fmap Coregistration'), (4, 'Dtifit')])),
+                ('file1', models.TextField(default='', max_length=512)),
+            ],
+            options={
+                'constraints': [models.UniqueConstraint(fields=('step', 'file1'), name='filerollup_key')],
+            },
+        ),
+        migrations.CreateModel(
+            name='SessionRollup',
+            fields=[
+                ('n_ratings', models.IntegerField(default=0)),
+                ('n_pass', models.IntegerField(default=0)),
+                ('n_unsure', models.IntegerField(default=0)),
+                ('n_fail', models.IntegerField(default=0)),
+                ('n_source_data_issue', models.IntegerField(default=0)),
+                ('n_clicks', models.IntegerField(default=0)),
+                ('n_images', models.IntegerField(default=0)),
+                ('n_pairs', models.IntegerField(default=0)),
+                ('n_agreeing_pairs', models.IntegerField(default=0)),
+                ('session', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, serialize=False, to='ratings.session')),
+                ('step', models.IntegerField(choices=[(0, 'Mask'), (1, 'Spatial Normalization'), (2, 'Surface Localization'), (3, 'Fmap Coregistration'), (4, 'Dtifit')])),
+            ],
+            options={
+                'indexes': [models.Index(fields=['step'], name='sessionrollup_step')],
+            },
+        ),
+    ]
@@ -0,0 +1,41 @@
+# Generated by Django 5.2.4 on 2026-10-19 16:40
+
+import django.db.models.expressions
+from django.db import migrations, models
+
+
+def reset_rollups(apps, schema_editor):
+    # existing rows have no step or priority; let the next refresh recount
+    for name in ('RollupCursor', 'ImageRollup', 'FileRollup', 'SessionRollup'):
+        apps.get_model('ratings', name).objects.all().delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ratings', '0007_rollups'),
+    ]
+
+    operations = [
+        migrations.RunPython(reset_rollups, migrations.RunPython.noop),
+        migrations.AddField(
+            model_name='imagerollup',
+            name='step',
+            field=models.IntegerField(choices=[(0, 'Mask'), (1, 'Spatial Normalization'), (2, 'Surface Localization'), (3, 'Fmap Coregistration'), (4, 'Dtifit')], default=0),
+            preserve_default=False,
+        ),
+        migrations.AddField(
+            model_name='imagerollup',
+            name='n_source_data_issue',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='imagerollup',
+            name='priority',
+            field=models.FloatField(null=True),
+        ),
+        migrations.AddIndex(
+            model_name='imagerollup',
+            index=models.Index(models.F('step'), django.db.models.expressions.OrderBy(models.F('priority'), descending=True), name='imagerollup_priority'),
+        ),
+    ]
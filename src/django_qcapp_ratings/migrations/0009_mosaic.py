@@ -0,0 +1,55 @@
+# Generated by Django 5.2.4 on 2026-10-19 17:12
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ratings', '0008_imagerollup_priority'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Mosaic',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('img', models.BinaryField()),
+                ('width', models.IntegerField()),
+                ('height', models.IntegerField()),
+                ('file1', models.TextField(max_length=512)),
+                ('display', models.IntegerField(choices=[(0, 'X'), (1, 'Y'), (2, 'Z')])),
+                ('step', models.IntegerField(choices=[(0, 'Mask'), (1, 'Spatial Normalization'), (2, 'Surface Localization'), (3, 'Fmap Coregistration'), (4, 'Dtifit')])),
+                ('created', models.DateTimeField(auto_now=True)),
+            ],
+            options={
+                'constraints': [models.UniqueConstraint(fields=('file1', 'display', 'step'), name='mosaic_meta')],
+            },
+        ),
+        migrations.AddField(
+            model_name='image',
+            name='mosaic',
+            field=models.ForeignKey(null=True, on_delete=django.db.models.deletion.CASCADE, to='ratings.mosaic'),
+        ),
+        migrations.AddField(
+            model_name='image',
+            name='tile_x',
+            field=models.IntegerField(null=True),
+        ),
+        migrations.AddField(
+            model_name='image',
+            name='tile_y',
+            field=models.IntegerField(null=True),
+        ),
+        migrations.AddField(
+            model_name='image',
+            name='tile_width',
+            field=models.IntegerField(null=True),
+        ),
+        migrations.AddField(
+            model_name='image',
+            name='tile_height',
+            field=models.IntegerField(null=True),
+        ),
+    ]
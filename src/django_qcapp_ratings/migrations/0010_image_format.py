@@ -0,0 +1,18 @@
+# Generated by Django 5.2.4 on 2026-10-19 17:48
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ratings', '0009_mosaic'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='image',
+            name='format',
+            field=models.CharField(choices=[('figure', 'Figure'), ('slice', 'Slice')], default='figure', max_length=8),
+        ),
+    ]
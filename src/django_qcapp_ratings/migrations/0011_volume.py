@@ -0,0 +1,37 @@
+# Generated by Django 5.2.4 on 2026-10-19 18:20
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ratings', '0010_image_format'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Volume',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('file1', models.TextField(max_length=512)),
+                ('file2', models.TextField(max_length=512, null=True)),
+                ('step', models.IntegerField(choices=[(0, 'Mask'), (1, 'Spatial Normalization'), (2, 'Surface Localization'), (3, 'Fmap Coregistration'), (4, 'Dtifit')])),
+                ('affine', models.JSONField()),
+                ('shape', models.JSONField()),
+                ('bbox', models.JSONField(null=True)),
+                ('cuts', models.JSONField(default=dict)),
+                ('quantiles', models.JSONField(default=dict)),
+                ('created', models.DateTimeField(auto_now=True)),
+            ],
+            options={
+                'constraints': [models.UniqueConstraint(fields=('file1', 'step'), name='volume_meta')],
+            },
+        ),
+        migrations.AddField(
+            model_name='image',
+            name='volume',
+            field=models.ForeignKey(null=True, on_delete=django.db.models.deletion.SET_NULL, to='ratings.volume'),
+        ),
+    ]
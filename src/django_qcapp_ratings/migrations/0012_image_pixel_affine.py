@@ -0,0 +1,18 @@
+# Generated by Django 5.2.4 on 2026-10-19 18:55
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ratings', '0011_volume'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='image',
+            name='pixel_affine',
+            field=models.JSONField(null=True),
+        ),
+    ]
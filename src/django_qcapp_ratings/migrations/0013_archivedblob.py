@@ -0,0 +1,25 @@
+# Generated by Django 5.2.4 on 2026-10-19 19:20
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ratings', '0012_image_pixel_affine'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ArchivedBlob',
+            fields=[
+                ('image', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, serialize=False, to='ratings.image')),
+                ('pack', models.CharField(max_length=64)),
+                ('offset', models.BigIntegerField()),
+                ('length', models.IntegerField()),
+                ('codec', models.CharField(choices=[('zstd', 'Zstd'), ('zlib', 'Zlib')], max_length=8)),
+                ('created', models.DateTimeField(auto_now=True)),
+            ],
+        ),
+    ]
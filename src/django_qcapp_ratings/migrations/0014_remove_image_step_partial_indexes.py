@@ -0,0 +1,33 @@
+# Generated by Django 5.2.4 on 2026-10-19 20:05
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ratings', '0013_archivedblob'),
+    ]
+
+    operations = [
+        migrations.RemoveIndex(
+            model_name='image',
+            name='image_mask_id',
+        ),
+        migrations.RemoveIndex(
+            model_name='image',
+            name='image_spatial_normalization_id',
+        ),
+        migrations.RemoveIndex(
+            model_name='image',
+            name='image_surface_localization_id',
+        ),
+        migrations.RemoveIndex(
+            model_name='image',
+            name='image_fmap_coregistration_id',
+        ),
+        migrations.RemoveIndex(
+            model_name='image',
+            name='image_dtifit_id',
+        ),
+    ]
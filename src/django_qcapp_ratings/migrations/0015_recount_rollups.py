@@ -0,0 +1,20 @@
+# Generated by Django 5.2.4 on 2026-10-19 21:10
+
+from django.db import migrations
+
+
+def reset_rollups(apps, schema_editor):
+    # clicks were not counted into the file and session issues and images
+    for name in ('RollupCursor', 'ImageRollup', 'FileRollup', 'SessionRollup'):
+        apps.get_model('ratings', name).objects.all().delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ratings', '0014_remove_image_step_partial_indexes'),
+    ]
+
+    operations = [
+        migrations.RunPython(reset_rollups, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,24 @@
+# Generated by Django 5.2.4 on 2026-10-19 22:05
+
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ratings', '0015_recount_rollups'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='clickedcoordinate',
+            name='created',
+            field=models.DateTimeField(default=django.utils.timezone.now),
+        ),
+        migrations.AlterField(
+            model_name='rating',
+            name='created',
+            field=models.DateTimeField(default=django.utils.timezone.now),
+        ),
+    ]
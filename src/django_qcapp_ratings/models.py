@@ -1,9 +1,14 @@
+import array
 import json
 import random
+import sys
 import typing
 
-from django import http, shortcuts
+from django import http
 from django.db import models
+from django.utils import timezone
+
+from django_qcapp_ratings import instrumentation, state
 
 
 class Step(models.IntegerChoices):
@@ -20,6 +25,13 @@ class Ratings(models.IntegerChoices):
     FAIL = 2
 
 
+class ImageFormat(models.TextChoices):
+    # a PNG or GIF rendered during ingestion
+    FIGURE = "figure"
+    # a quantized slice with overlay bitmasks, composited by the browser
+    SLICE = "slice"
+
+
 class DisplayMode(models.IntegerChoices):
     X = 0
     Y = 1
@@ -36,7 +48,50 @@ class Session(models.Model):
     user = models.TextField(default=None, null=True)
 
 
+class Volume(models.Model):
+    """Geometry and intensities of a source file, as found during ingestion."""
+
+    file1 = models.TextField(max_length=512)
+    file2 = models.TextField(max_length=512, null=True)
+    step = models.IntegerField(choices=Step.choices)
+    # voxel to RAS (mm) affine as 4 rows, and the voxel shape
+    affine = models.JSONField()
+    shape = models.JSONField()
+    # first and last masked voxel along each axis, if cuts were placed in it
+    bbox = models.JSONField(null=True)
+    # RAS coordinate of each cut, by DisplayMode name
+    cuts = models.JSONField(default=dict)
+    # intensity quantiles, by quantile (e.g., "0.95")
+    quantiles = models.JSONField(default=dict)
+    created = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=["file1", "step"], name="volume_meta")
+        ]
+
+
+class Mosaic(models.Model):
+    """All cuts of one volume and display mode, stitched into one image."""
+
+    img = models.BinaryField()
+    width = models.IntegerField()
+    height = models.IntegerField()
+    file1 = models.TextField(max_length=512)
+    display = models.IntegerField(choices=DisplayMode.choices)
+    step = models.IntegerField(choices=Step.choices)
+    created = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=["file1", "display", "step"], name="mosaic_meta"
+            )
+        ]
+
+
 class Image(models.Model):
+    # empty when the image is a tile of a mosaic
     img = models.BinaryField()
     slice = models.IntegerField(null=True)
     file1 = models.TextField(max_length=512)
@@ -44,6 +99,18 @@ class Image(models.Model):
     display = models.IntegerField(choices=DisplayMode.choices)
     step = models.IntegerField(choices=Step.choices)
     created = models.DateTimeField(auto_now_add=True)
+    format = models.CharField(
+        max_length=8, choices=ImageFormat.choices, default=ImageFormat.FIGURE
+    )
+    mosaic = models.ForeignKey(Mosaic, on_delete=models.CASCADE, null=True)
+    volume = models.ForeignKey(Volume, on_delete=models.SET_NULL, null=True)
+    # maps pixels of the image (x, y from the top left, 0, 1) to RAS; see
+    # selectors.get_clicked_world_points
+    pixel_affine = models.JSONField(null=True)
+    tile_x = models.IntegerField(null=True)
+    tile_y = models.IntegerField(null=True)
+    tile_width = models.IntegerField(null=True)
+    tile_height = models.IntegerField(null=True)
 
     class Meta:
         constraints = [
@@ -51,14 +118,76 @@ class Image(models.Model):
                 fields=["slice", "file1", "display", "step"], name="image_meta"
             )
         ]
+        indexes = [
+            # selectors filter on step and group by id; a single composite
+            # index serves every step, where partial indexes per step would
+            # cover the same scans at the cost of one more write per insert
+            models.Index(fields=["step", "id"], name="image_step_id"),
+            # ingestion looks up the existing figures of a source file
+            models.Index(fields=["step", "file1"], name="image_step_file1"),
+        ]
 
     def to_dict(self) -> dict[str, typing.Any]:
-        return {"id": self.pk, "step": self.step, "img": self.img}
+        return {
+            "id": self.pk,
+            "step": self.step,
+            "img": self.img,
+            "format": self.format,
+            "tile": None
+            if self.mosaic_id is None
+            else {
+                "mosaic_id": self.mosaic_id,
+                "x": self.tile_x,
+                "y": self.tile_y,
+                "width": self.tile_width,
+                "height": self.tile_height,
+            },
+        }
+
+
+class ArchiveCodec(models.TextChoices):
+    ZSTD = "zstd"
+    ZLIB = "zlib"
+
+
+class ArchivedBlob(models.Model):
+    """Where the blob of an image sits in the pack files of the archive.
+
+    The image's own blob is emptied once archived; see archive.py.
+    """
+
+    image = models.OneToOneField(Image, on_delete=models.CASCADE, primary_key=True)
+    # file name, relative to settings.QCAPP_ARCHIVE_DIR
+    pack = models.CharField(max_length=64)
+    offset = models.BigIntegerField()
+    # compressed length in the pack
+    length = models.IntegerField()
+    codec = models.CharField(max_length=8, choices=ArchiveCodec.choices)
+    created = models.DateTimeField(auto_now=True)
+
+
+class QueuedImage(models.Model):
+    """One slot in the precomputed order in which a step's images are shown."""
+
+    step = models.IntegerField(choices=Step.choices)
+    position = models.IntegerField()
+    image = models.ForeignKey(Image, on_delete=models.CASCADE)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=["step", "position"], name="queuedimage_step_pos")
+        ]
 
 
 class FromRequest(models.Model):
     class Meta:
         abstract = True
+        indexes = [
+            # lets selectors count ratings per image from the index alone
+            models.Index(
+                fields=["image", "source_data_issue"], name="%(class)s_image_sdi"
+            )
+        ]
 
     image = models.ForeignKey(Image, on_delete=models.CASCADE)
     session = models.ForeignKey(Session, on_delete=models.CASCADE)
@@ -71,48 +200,158 @@ class FromRequest(models.Model):
         help_text="Please only add additional comments if necessary.",
         blank=True,
     )
-    created = models.DateTimeField(auto_now_add=True)
+    # a default, unlike auto_now_add, so that buffered submissions keep the time
+    # they were made (see writebehind.py)
+    created = models.DateTimeField(default=timezone.now)
+    # set once per served image, so that resubmissions are only stored once
+    idempotency_key = models.CharField(
+        max_length=64, null=True, unique=True, editable=False
+    )
 
     def add_request_args(self, request: http.HttpRequest) -> None:
-        self.image = shortcuts.get_object_or_404(
-            Image, pk=request.session.get("image_id")
-        )
-        self.session = shortcuts.get_object_or_404(
-            Session, pk=request.session.get("session_id")
-        )
-
-    def update_instance_and_save(self, request: http.HttpRequest) -> None:
+        # the ids were signed by the views, so the rows are not fetched again;
+        # the foreign keys still reject ids that do not exist
+        rating = state.load(request)
+        if rating.image_id is None or rating.session_id is None:
+            raise http.Http404("No image or session in progress")
+        self.image_id = rating.image_id
+        self.session_id = rating.session_id
+        self.idempotency_key = rating.submission_key
+
+    def update_instance(self, request: http.HttpRequest) -> None:
         self.add_request_args(request)
-        self.save()
+
+    @instrumentation.traced()
+    async def aupdate_instance_and_save(self, request: http.HttpRequest) -> None:
+        self.update_instance(request)
+        # a resubmission conflicts on idempotency_key and is dropped
+        await type(self).objects.abulk_create([self], ignore_conflicts=True)
+
+
+def pack_points(points: list[dict[str, float]]) -> bytes:
+    """Pack points as little-endian float32 (x, y) pairs."""
+    packed = array.array("f", [v for point in points for v in (point["x"], point["y"])])
+    if sys.byteorder == "big":
+        packed.byteswap()
+    return packed.tobytes()
+
+
+def unpack_points(packed: bytes) -> list[tuple[float, float]]:
+    unpacked = array.array("f")
+    unpacked.frombytes(packed)
+    if sys.byteorder == "big":
+        unpacked.byteswap()
+    return list(zip(unpacked[::2], unpacked[1::2]))
 
 
 class ClickedCoordinate(FromRequest):
+    """All points clicked in one submission.
+
+    Rows saved before points existed hold a single point in x and y.
+    """
+
     x = models.FloatField(null=True)
     y = models.FloatField(null=True)
+    points = models.BinaryField(null=True, editable=False)
 
-    def update_instance_and_save(self, request: http.HttpRequest) -> None:
-        self.add_request_args(request)
-        points_raw = request.POST.get("points")
+    @property
+    def point_list(self) -> list[tuple[float, float]]:
+        if self.points is None:
+            return [] if self.x is None else [(self.x, self.y)]  # type: ignore
+        return unpack_points(self.points)
+
+    def as_array(self):
+        """Points as an (n, 2) float32 array, without copying."""
+        import numpy as np
 
-        points = [] if points_raw is None else json.loads(points_raw)
-
-        if len(points) == 0:
-            self.save()
-        else:
-            common_fields = {}
-            for field in self._meta.get_fields():
-                if (
-                    field.concrete
-                    and not field.auto_created
-                    and field.name != "id"
-                    and field.name != "pk"
-                ):
-                    common_fields.update({field.name: getattr(self, field.name)})
-            objs = []
-            for point in points:
-                objs.append(self.__class__(**{**common_fields, **point}))
-            self.__class__.objects.bulk_create(objs)
+        if self.points is None:
+            return np.array(self.point_list, dtype=np.float32).reshape(-1, 2)
+        return np.frombuffer(self.points, dtype="<f4").reshape(-1, 2)
+
+    def update_instance(self, request: http.HttpRequest) -> None:
+        super().update_instance(request)
+        points_raw = request.POST.get("points")
+        self.points = pack_points([] if points_raw is None else json.loads(points_raw))
 
 
 class Rating(FromRequest):
     rating = models.IntegerField(choices=Ratings.choices, default=None, verbose_name="")
+
+
+class RollupCursor(models.Model):
+    """The last row of a FromRequest table that the rollups have counted."""
+
+    model = models.CharField(max_length=64, unique=True)
+    last_id = models.BigIntegerField(default=0)
+
+
+class RollupCounts(models.Model):
+    class Meta:
+        abstract = True
+
+    n_ratings = models.IntegerField(default=0)
+    n_pass = models.IntegerField(default=0)
+    n_unsure = models.IntegerField(default=0)
+    n_fail = models.IntegerField(default=0)
+    n_source_data_issue = models.IntegerField(default=0)
+    n_clicks = models.IntegerField(default=0)
+    # images with at least one rating
+    n_images = models.IntegerField(default=0)
+    # pairs of ratings of the same image, and those pairs that agree
+    n_pairs = models.IntegerField(default=0)
+    n_agreeing_pairs = models.IntegerField(default=0)
+
+    @property
+    def agreement(self) -> float | None:
+        return self.n_agreeing_pairs / self.n_pairs if self.n_pairs else None
+
+
+class ImageRollup(models.Model):
+    """Running counts of the ratings of one image, and its scheduling priority."""
+
+    image = models.OneToOneField(Image, on_delete=models.CASCADE, primary_key=True)
+    step = models.IntegerField(choices=Step.choices)
+    n_pass = models.IntegerField(default=0)
+    n_unsure = models.IntegerField(default=0)
+    n_fail = models.IntegerField(default=0)
+    n_clicks = models.IntegerField(default=0)
+    n_source_data_issue = models.IntegerField(default=0)
+    # score of the step's scheduling policy; NULL once the image has enough
+    # ratings
+    priority = models.FloatField(null=True)
+
+    class Meta:
+        indexes = [
+            models.Index(
+                "step", models.F("priority").desc(), name="imagerollup_priority"
+            )
+        ]
+
+    @property
+    def n_ratings(self) -> int:
+        return self.n_pass + self.n_unsure + self.n_fail + self.n_clicks
+
+
+class FileRollup(RollupCounts):
+    """Running counts of the ratings of a file1, or of a whole step (file1="")."""
+
+    step = models.IntegerField(choices=Step.choices)
+    file1 = models.TextField(max_length=512, default="")
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=["step", "file1"], name="filerollup_key")
+        ]
+
+
+class SessionRollup(RollupCounts):
+    """Running counts of the ratings made in one session.
+
+    A pair of ratings counts towards the session that made the later one.
+    """
+
+    session = models.OneToOneField(Session, on_delete=models.CASCADE, primary_key=True)
+    step = models.IntegerField(choices=Step.choices)
+
+    class Meta:
+        indexes = [models.Index(fields=["step"], name="sessionrollup_step")]
@@ -1,22 +1,23 @@
 import base64
 import dataclasses
-import logging
+import functools
+import math
 import typing
 
-from celery import result
-from django import http
+from django.conf import settings
 from django.db import models as dm
 
 from django_qcapp_ratings import models
 
-TASK_TIMEOUT_SEC = 30
-
 
 @dataclasses.dataclass
 class ImageResult:
     id: int
     step: models.Step
     img: bytes
+    format: str = models.ImageFormat.FIGURE
+    # where the image sits in its mosaic, if it is a tile of one
+    tile: dict[str, int] | None = None
 
     @property
     def img_type(self) -> str:
@@ -37,6 +38,21 @@ class ImageResult:
     def img_decoded(self) -> str:
         return base64.b64encode(self.img).decode()
 
+    def tile_style(self, mosaic: models.Mosaic) -> str:
+        """CSS that crops the tile out of a mosaic used as a background."""
+        if self.tile is None:
+            raise ValueError("Image is not a tile")
+        x, y = self.tile["x"], self.tile["y"]
+        width, height = self.tile["width"], self.tile["height"]
+        # background-position percentages are relative to the leftover space
+        left = 100 * x / (mosaic.width - width) if mosaic.width > width else 0
+        top = 100 * y / (mosaic.height - height) if mosaic.height > height else 0
+        return (
+            f"aspect-ratio: {width} / {height}; "
+            f"background-size: {100 * mosaic.width / width}% auto; "
+            f"background-position: {left}% {top}%"
+        )
+
 
 def get_related_from_step(step: models.Step) -> str:
     match step:
@@ -51,52 +67,182 @@ def get_related_from_step(step: models.Step) -> str:
     return related
 
 
-async def get_img_id(request: http.HttpRequest) -> ImageResult:
-    logging.info("looking for img task")
-    img_task = await request.session.aget("img_task")
-    if img_task is None:
-        raise http.Http404("no img_task found")
-    res = result.AsyncResult(img_task)
-
-    logging.info(f"getting results of {res=}")
-    img: dict[str, typing.Any] = res.get(timeout=TASK_TIMEOUT_SEC)
-
-    return ImageResult(**img)
-
-
-async def get_image_with_fewest_ratings(
-    step: models.Step, key: str = "source_data_issue"
-) -> models.Image:
+def fewest_ratings_queryset(
+    step: models.Step, last_pk: int | None = None, key: str = "source_data_issue"
+) -> dm.QuerySet:
+    """Ids of the images of a step, ordered from fewest to most ratings."""
     related = get_related_from_step(step)
-    image = await (
-        models.Image.objects.filter(step=step.value)
-        .select_related(related)
+    images = models.Image.objects.filter(step=step.value)
+    if last_pk is not None:
+        images = images.exclude(id__in=[last_pk])
+    return (
+        images.select_related(related)
         .values("id")
         .annotate(n_ratings=dm.Count(f"{related}__{key}"))
         .order_by("n_ratings")
-        .afirst()
     )
-    if image is None:
-        raise ValueError("No image found")
 
-    return await models.Image.objects.aget(pk=image.get("id"))
 
+Policy = typing.Callable[[models.ImageRollup], float]
+
+POLICIES: dict[str, Policy] = {}
+DEFAULT_POLICY = "fewest_ratings"
+UNSURE_WEIGHT = 0.5
+ISSUE_WEIGHT = 0.5
+
+
+def register_policy(name: str) -> typing.Callable[[Policy], Policy]:
+    """Make a scoring function available as a scheduling policy.
+
+    A policy scores an image from its rollup; higher scores are shown first.
+    """
+
+    def decorator(policy: Policy) -> Policy:
+        POLICIES[name] = policy
+        return policy
+
+    return decorator
+
+
+@register_policy("fewest_ratings")
+def fewest_ratings(rollup: models.ImageRollup) -> float:
+    return -rollup.n_ratings
+
+
+@functools.cache
+def _harmonic(n: int) -> float:
+    return math.fsum(1 / k for k in range(1, n + 1))
 
-async def get_image_pk_with_fewest_ratings(
-    step: models.Step, last_pk: int, key: str = "source_data_issue"
-) -> models.Image:
-    related = get_related_from_step(step)
-    image = await (
-        models.Image.objects.filter(step=step.value)
-        .exclude(id__in=[last_pk])
-        .select_related(related)
-        .values("id")
-        .annotate(n_ratings=dm.Count(f"{related}__{key}"))
-        .order_by("n_ratings")
-        .afirst()
-    )
-    if image is None:
-        raise ValueError("No image found")
 
-    logging.info("starting to load the image from db")
-    return await models.Image.objects.aget(pk=image.get("id"))
+def _expected_information_gain(counts: typing.Sequence[int]) -> float:
+    """Information the next vote gives about the label, under a flat Dirichlet.
+
+    This is the entropy of the predictive distribution minus the expected
+    entropy of a vote; with integer pseudo-counts the digammas of the latter
+    reduce to harmonic numbers.
+    """
+    alpha = [c + 1 for c in counts]
+    total = sum(alpha)
+    predictive = -sum(a / total * math.log(a / total) for a in alpha)
+    expected = _harmonic(total) - sum(a / total * _harmonic(a) for a in alpha)
+    return predictive - expected
+
+
+@register_policy("information_gain")
+def information_gain(rollup: models.ImageRollup) -> float:
+    """Favor images whose raters disagree, are unsure, or flag the source data."""
+    n = rollup.n_ratings
+    score = _expected_information_gain([rollup.n_pass, rollup.n_fail])
+    score += UNSURE_WEIGHT * rollup.n_unsure / (n + 1)
+    score += ISSUE_WEIGHT * rollup.n_source_data_issue / (n + 1)
+    # clicks carry no vote, so only their number lowers the score
+    return score / (rollup.n_clicks + 1)
+
+
+def get_policy_name(step: models.Step) -> str:
+    """The policy of a step, from settings.QCAPP_SCHEDULING_POLICIES.
+
+    That setting maps step names (e.g., "DTIFIT") to policy names. After changing
+    it, run refresh_rollups --rebuild so stored priorities follow.
+    """
+    policies = getattr(settings, "QCAPP_SCHEDULING_POLICIES", {})
+    return policies.get(step.name, DEFAULT_POLICY)
+
+
+def get_policy(step: models.Step) -> Policy:
+    return POLICIES[get_policy_name(step)]
+
+
+def queue_queryset(step: models.Step, last_pk: int | None = None) -> dm.QuerySet:
+    """(slot id, image id) of the queued images of a step, in queue order."""
+    queued = models.QueuedImage.objects.filter(step=step)
+    if last_pk is not None:
+        queued = queued.exclude(image_id=last_pk)
+    return queued.order_by("position").values_list("id", "image_id")
+
+
+def priority_queryset(step: models.Step, last_pk: int | None = None) -> dm.QuerySet:
+    """Ids of the images of a step, from the highest stored priority down."""
+    rollups = models.ImageRollup.objects.filter(step=step, priority__isnull=False)
+    if last_pk is not None:
+        rollups = rollups.exclude(image_id=last_pk)
+    return rollups.order_by("-priority").values_list("image_id", flat=True)
+
+
+async def highest_priority_ids(
+    step: models.Step, last_pk: int | None = None, k: int = 1
+) -> list[int]:
+    """Ids of the k images of a step with the highest stored priority."""
+    return [image_id async for image_id in priority_queryset(step, last_pk)[:k]]
+
+
+def get_clicked_points(
+    step: models.Step, image_format: str = models.ImageFormat.FIGURE
+):
+    """All points clicked for a step on images of a format, as (ids, xy) arrays.
+
+    ids has the ClickedCoordinate id of each of the n points, and xy is (n, 2).
+    Pixels of figures and of slices are not the same space (see
+    management/commands/_slices.py), so one format is returned at a time; use
+    get_clicked_world_points to compare them.
+    """
+    import numpy as np
+
+    clicks = models.ClickedCoordinate.objects.filter(
+        image__step=step.value, image__format=image_format
+    ).only("id", "x", "y", "points")
+    ids, xy = [], []
+    for click in clicks.iterator():
+        points = click.as_array()
+        ids.append(np.full(len(points), click.pk, dtype=np.int64))
+        xy.append(points)
+    if not len(xy):
+        return np.empty(0, dtype=np.int64), np.empty((0, 2), dtype=np.float32)
+    return np.concatenate(ids), np.concatenate(xy)
+
+
+def get_clicked_world_points(step: models.Step):
+    """All points clicked for a step in RAS (mm), as (ids, image_ids, formats,
+    xyz).
+
+    Points are mapped with the pixel_affine of their image in one batched
+    product, which takes figure and slice pixels alike to RAS; formats tells
+    which one each point was clicked on. Clicks on images without an affine are
+    left out.
+    """
+    import numpy as np
+
+    clicks = (
+        models.ClickedCoordinate.objects.filter(
+            image__step=step.value, image__pixel_affine__isnull=False
+        )
+        .select_related("image")
+        .only("id", "x", "y", "points", "image__pixel_affine", "image__format")
+    )
+    ids, image_ids, xy = [], [], []
+    affines: dict[int, list[list[float]]] = {}
+    image_formats: dict[int, str] = {}
+    for click in clicks.iterator():
+        points = click.as_array()
+        affines[click.image_id] = click.image.pixel_affine
+        image_formats[click.image_id] = click.image.format
+        ids.append(np.full(len(points), click.pk, dtype=np.int64))
+        image_ids.append(np.full(len(points), click.image_id, dtype=np.int64))
+        xy.append(points)
+    if not len(xy):
+        return (
+            np.empty(0, dtype=np.int64),
+            np.empty(0, dtype=np.int64),
+            np.empty(0, dtype=str),
+            np.empty((0, 3), dtype=np.float64),
+        )
+
+    image_ids_ = np.concatenate(image_ids)
+    unique, rows = np.unique(image_ids_, return_inverse=True)
+    stacked = np.asarray([affines[pk] for pk in unique.tolist()], dtype=np.float64)
+    formats = np.asarray([image_formats[pk] for pk in unique.tolist()])[rows]
+    xy_ = np.concatenate(xy).astype(np.float64)
+    # (x, y) -> (x, y, 0, 1)
+    homogeneous = np.column_stack([xy_, np.zeros(len(xy_)), np.ones(len(xy_))])
+    xyz = np.einsum("nij,nj->ni", stacked[rows], homogeneous)[:, :3]
+    return np.concatenate(ids), image_ids_, formats, xyz
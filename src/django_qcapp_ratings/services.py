@@ -0,0 +1,526 @@
+import datetime
+import itertools
+import logging
+import random
+import threading
+import time
+import typing
+
+from django import db
+from django.conf import settings
+from django.db import transaction
+from django.db.models import F
+from django.utils import timezone
+
+from django_qcapp_ratings import archive, instrumentation, models, selectors
+
+IMAGE_UNIQUE_FIELDS = ["slice", "file1", "display", "step"]
+DEFAULT_STRATIFY = ("file1",)
+POP_ATTEMPTS = 5
+# concurrent raters claim one of this many slots at the head of the queue, so
+# that they rarely race for the same one
+QUEUE_CLAIM_WIDTH = 8
+# prioritized picks are spread over this many of the top images, so that
+# concurrent raters rarely rate the same one
+PRIORITY_TOP_K = 8
+ROLLUP_BATCH_SIZE = 5_000
+# a gap in the ids below rows younger than this may be a transaction that has
+# not committed yet; older gaps are rollbacks or ids skipped by upserts
+ROLLUP_GAP_SECONDS = 60
+RATING_FIELDS = {
+    models.Ratings.PASS: "n_pass",
+    models.Ratings.UNSURE: "n_unsure",
+    models.Ratings.FAIL: "n_fail",
+}
+
+
+async def amerge_images(imgs: typing.Sequence[models.Image]) -> None:
+    """Insert images, replacing the blob of any that already exist, and set
+    their primary keys.
+
+    Unsaved volumes of the images are inserted (or replaced) first.
+    """
+    volumes = {
+        id(img.volume): img.volume
+        for img in imgs
+        if img.volume_id is None and img.volume is not None
+    }
+    for volume in volumes.values():
+        await amerge_volume(volume)
+
+    with_slice = [img for img in imgs if img.slice is not None]
+    if len(with_slice):
+        await models.Image.objects.abulk_create(
+            with_slice,
+            update_conflicts=True,  # type: ignore
+            update_fields=[
+                "img",
+                "file2",
+                "created",
+                "format",
+                "mosaic",
+                "volume",
+                "pixel_affine",
+                "tile_x",
+                "tile_y",
+                "tile_width",
+                "tile_height",
+            ],
+            unique_fields=IMAGE_UNIQUE_FIELDS,
+        )
+
+    # NULL never conflicts in the image_meta constraint, so whole-volume
+    # figures (e.g., DTIFIT) need an explicit lookup
+    for img in imgs:
+        if img.slice is None:
+            saved, _ = await models.Image.objects.aupdate_or_create(
+                slice=None,
+                file1=img.file1,
+                display=img.display,
+                step=img.step,
+                defaults={
+                    "img": img.img,
+                    "file2": img.file2,
+                    "format": img.format,
+                    "volume": img.volume,
+                },
+            )
+            img.pk = saved.pk
+
+
+async def amerge_volume(volume: models.Volume) -> None:
+    """Insert or replace a volume, setting its primary key."""
+    saved, _ = await models.Volume.objects.aupdate_or_create(
+        file1=volume.file1,
+        step=volume.step,
+        defaults={
+            field: getattr(volume, field)
+            for field in ["file2", "affine", "shape", "bbox", "cuts", "quantiles"]
+        },
+    )
+    volume.pk = saved.pk
+
+
+async def amerge_mosaic(
+    mosaic: models.Mosaic, imgs: typing.Sequence[models.Image]
+) -> None:
+    """Insert or replace a mosaic together with the images tiled from it."""
+    mosaic, _ = await models.Mosaic.objects.aupdate_or_create(
+        file1=mosaic.file1,
+        display=mosaic.display,
+        step=mosaic.step,
+        defaults={"img": mosaic.img, "width": mosaic.width, "height": mosaic.height},
+    )
+    for img in imgs:
+        img.mosaic = mosaic
+        img.img = b""
+    await amerge_images(imgs)
+
+
+def get_target_ratings() -> int | None:
+    """Ratings after which an image leaves the rotation (None: never)."""
+    return getattr(settings, "QCAPP_TARGET_RATINGS", None)
+
+
+def _stratified_shuffle(
+    rows: list[dict[str, typing.Any]],
+    stratify: typing.Sequence[str],
+    rng: random.Random,
+) -> list[dict[str, typing.Any]]:
+    """Shuffle rows so that consecutive rows come from different strata."""
+    if not stratify:
+        rng.shuffle(rows)
+        return rows
+    strata: dict[tuple, list[dict[str, typing.Any]]] = {}
+    for row in rows:
+        strata.setdefault(tuple(row[k] for k in stratify), []).append(row)
+    groups = list(strata.values())
+    for group in groups:
+        rng.shuffle(group)
+    rng.shuffle(groups)
+    return [
+        row
+        for round_ in itertools.zip_longest(*groups)
+        for row in round_
+        if row is not None
+    ]
+
+
+def refresh_image_order(
+    step: models.Step,
+    target: int | None = None,
+    stratify: typing.Sequence[str] | None = None,
+    seed: int | None = None,
+) -> int:
+    """Replace the queued order of a step's images, returning its length.
+
+    Images are queued from fewest to most ratings, shuffled within each rating
+    count (optionally interleaving file1 and/or display strata). Images with at
+    least target ratings are left out.
+    """
+    target = get_target_ratings() if target is None else target
+    if stratify is None:
+        stratify = getattr(settings, "QCAPP_ORDER_STRATIFY", DEFAULT_STRATIFY)
+    rng = random.Random(seed)
+
+    rows = selectors.fewest_ratings_queryset(step).values(
+        "id", "n_ratings", "file1", "display"
+    )
+    if target is not None:
+        rows = rows.filter(n_ratings__lt=target)
+    tiers: dict[int, list[dict[str, typing.Any]]] = {}
+    for row in rows:
+        tiers.setdefault(row["n_ratings"], []).append(row)
+    ordered = [
+        row
+        for n_ratings in sorted(tiers)
+        for row in _stratified_shuffle(tiers[n_ratings], stratify, rng)
+    ]
+
+    with transaction.atomic():
+        models.QueuedImage.objects.filter(step=step).delete()
+        models.QueuedImage.objects.bulk_create(
+            [
+                models.QueuedImage(step=step, position=position, image_id=row["id"])
+                for position, row in enumerate(ordered)
+            ],
+            batch_size=5_000,
+        )
+    return len(ordered)
+
+
+async def apop_queued_image(
+    step: models.Step, last_pk: int | None = None
+) -> int | None:
+    """Claim the next queued image of a step (other than last_pk).
+
+    Returns None only when the queue is empty.
+    """
+    slots = selectors.queue_queryset(step, last_pk=last_pk)
+    head = None
+    for _ in range(POP_ATTEMPTS):
+        heads = [row async for row in slots[:QUEUE_CLAIM_WIDTH]]
+        if not len(heads):
+            break
+        head = random.choice(heads)
+        # another rater may have claimed the same slot; only one delete wins
+        claimed = models.QueuedImage.objects.filter(pk=head[0])
+        n_deleted, _ = await claimed.adelete()
+        if n_deleted:
+            return head[1]
+    # losing every race is not an empty queue: show the last image seen, which
+    # at worst gets one more rating than planned
+    return None if head is None else head[1]
+
+
+_background: dict[str, threading.Thread] = {}
+_rerun: set[str] = set()
+_background_lock = threading.Lock()
+
+
+def run_in_background(
+    key: str, fn: typing.Callable[[], typing.Any], coalesce: bool = False
+) -> bool:
+    """Run fn in a thread, unless this process is already running key.
+
+    Keeps rebuilds that a request notices are due out of that request, and
+    stops concurrent requests from each starting one. With coalesce, calls
+    made while fn runs have it run once more when it ends, so that it sees
+    what those callers wrote. Failures are logged.
+    """
+
+    def run() -> None:
+        while True:
+            try:
+                fn()
+            except Exception:
+                logging.exception(f"{key} failed")
+            finally:
+                db.connections.close_all()
+            with _background_lock:
+                if key not in _rerun:
+                    del _background[key]
+                    return
+                _rerun.discard(key)
+
+    with _background_lock:
+        if key in _background:
+            if coalesce:
+                _rerun.add(key)
+            return False
+        thread = _background[key] = threading.Thread(target=run, name=key, daemon=True)
+    thread.start()
+    return True
+
+
+def join_background(timeout: float | None = None) -> bool:
+    """Wait for the background runs of this process; False if some still run."""
+    deadline = None if timeout is None else time.monotonic() + timeout
+    while True:
+        with _background_lock:
+            threads = list(_background.values())
+        if not len(threads):
+            return True
+        for thread in threads:
+            remaining = None if deadline is None else deadline - time.monotonic()
+            thread.join(remaining)
+            if thread.is_alive():
+                return False
+
+
+@instrumentation.traced()
+async def anext_image(
+    step: models.Step, last_pk: int | None = None
+) -> selectors.ImageResult:
+    """The image to show next, other than the one just rated (last_pk).
+
+    Steps with the default policy are served from the shuffled queue, others
+    by the priority that their policy stored in the rollups. When the queue or
+    the priorities run dry, they are rebuilt in the background and the image
+    is picked from the rating counts meanwhile, so requests never write more
+    than their claim.
+    """
+    if selectors.get_policy_name(step) == selectors.DEFAULT_POLICY:
+        image_id = await apop_queued_image(step, last_pk=last_pk)
+        if image_id is None:
+            run_in_background(
+                f"refresh_image_order:{step.name}",
+                lambda: refresh_image_order(step),
+            )
+    else:
+        with instrumentation.span("selectors.priority_query"):
+            top = await selectors.highest_priority_ids(
+                step, last_pk=last_pk, k=PRIORITY_TOP_K
+            )
+        if not len(top):
+            # new images only get a priority once the rollups are refreshed
+            run_in_background("refresh_rollups", refresh_rollups)
+        image_id = random.choice(top) if len(top) else None
+    if image_id is None:
+        with instrumentation.span("selectors.count_query"):
+            row = await selectors.fewest_ratings_queryset(
+                step, last_pk=last_pk
+            ).afirst()
+        if row is None:
+            raise ValueError("No image found")
+        image_id = row["id"]
+
+    with instrumentation.span("selectors.blob_fetch"):
+        image = await archive.afill(await models.Image.objects.aget(pk=image_id))
+    return selectors.ImageResult(**image.to_dict())
+
+
+def _count_rows(
+    rows: list[dict[str, typing.Any]],
+    images: dict[int, models.ImageRollup],
+    is_click: bool,
+) -> tuple[dict[tuple[int, str], dict[str, int]], dict[int, dict[str, int]]]:
+    """Update image rollups in place and return the file and session deltas."""
+    by_file: dict[tuple[int, str], dict[str, int]] = {}
+    by_session: dict[int, dict[str, int]] = {}
+    for row in rows:
+        step = row["image__step"]
+        image = images.setdefault(
+            row["image_id"], models.ImageRollup(image_id=row["image_id"], step=step)
+        )
+        image.n_source_data_issue += int(row["source_data_issue"])
+        n_before = image.n_pass + image.n_unsure + image.n_fail + image.n_clicks
+        delta: dict[str, int] = {
+            "n_source_data_issue": int(row["source_data_issue"]),
+            "n_images": int(n_before == 0),
+        }
+        if is_click:
+            delta["n_clicks"] = 1
+            image.n_clicks += 1
+        else:
+            field = RATING_FIELDS[row["rating"]]
+            delta |= {
+                "n_ratings": 1,
+                field: 1,
+                "n_pairs": n_before,
+                "n_agreeing_pairs": getattr(image, field),
+            }
+            setattr(image, field, getattr(image, field) + 1)
+
+        for key in ((step, row["image__file1"]), (step, "")):
+            totals = by_file.setdefault(key, {})
+            for k, v in delta.items():
+                totals[k] = totals.get(k, 0) + v
+        totals = by_session.setdefault(row["session_id"], {"step": step})
+        for k, v in delta.items():
+            totals[k] = totals.get(k, 0) + v
+    return by_file, by_session
+
+
+def _prioritize(rollups: list[models.ImageRollup]) -> None:
+    target = get_target_ratings()
+    policies = {step: selectors.get_policy(step) for step in models.Step}
+    for rollup in rollups:
+        if target is not None and rollup.n_ratings >= target:
+            rollup.priority = None
+        else:
+            rollup.priority = policies[models.Step(rollup.step)](rollup)
+
+
+def _save_image_rollups(rollups: list[models.ImageRollup]) -> None:
+    _prioritize(rollups)
+    models.ImageRollup.objects.bulk_create(
+        rollups,
+        update_conflicts=True,
+        update_fields=[
+            "n_pass",
+            "n_unsure",
+            "n_fail",
+            "n_clicks",
+            "n_source_data_issue",
+            "priority",
+        ],
+        unique_fields=["image"],
+    )
+
+
+def _committed_prefix(
+    rows: list[dict[str, typing.Any]], last_id: int, gap_seconds: float
+) -> list[dict[str, typing.Any]]:
+    """The rows before the first gap in their ids that may still be filled.
+
+    Ids are taken when a row is inserted but only visible once its transaction
+    commits, so on PostgreSQL a row can turn up below ids already counted. The
+    cursor stays below a recent gap until the rows commit or, after
+    gap_seconds, are taken to have been rolled back. SQLite has one writer at a
+    time, which commits its ids before the next one takes any.
+    """
+    if db.connection.vendor == "sqlite" or gap_seconds <= 0:
+        return rows
+    horizon = timezone.now() - datetime.timedelta(seconds=gap_seconds)
+    expected = last_id + 1
+    for i, row in enumerate(rows):
+        if row["id"] != expected and row["created"] > horizon:
+            return rows[:i]
+        expected = row["id"] + 1
+    return rows
+
+
+def _add_new_images(batch_size: int, gap_seconds: float) -> int | None:
+    """Give images added since the last refresh an (empty) rollup."""
+    with transaction.atomic():
+        cursor, _ = models.RollupCursor.objects.get_or_create(
+            model=models.Image._meta.label
+        )
+        rows = _committed_prefix(
+            list(
+                models.Image.objects.filter(id__gt=cursor.last_id)
+                .order_by("id")
+                .values("id", "step", "created")[:batch_size]
+            ),
+            cursor.last_id,
+            gap_seconds,
+        )
+        if not len(rows):
+            return None
+        claimed = models.RollupCursor.objects.filter(
+            pk=cursor.pk, last_id=cursor.last_id
+        ).update(last_id=rows[-1]["id"])
+        if not claimed:
+            return None
+        rollups = [
+            models.ImageRollup(image_id=row["id"], step=row["step"]) for row in rows
+        ]
+        _prioritize(rollups)
+        # ratings may have been counted into the rollup already
+        models.ImageRollup.objects.bulk_create(rollups, ignore_conflicts=True)
+    return len(rows)
+
+
+def _refresh_rollups_batch(
+    model: type[models.FromRequest], batch_size: int, gap_seconds: float
+) -> int | None:
+    """Count the next batch of new rows, or return None if none were claimed."""
+    is_click = model is models.ClickedCoordinate
+    fields = [
+        "id",
+        "image_id",
+        "session_id",
+        "image__step",
+        "image__file1",
+        "source_data_issue",
+        "created",
+    ]
+    if not is_click:
+        fields += ["rating"]
+
+    with transaction.atomic():
+        cursor, _ = models.RollupCursor.objects.get_or_create(model=model._meta.label)
+        rows = _committed_prefix(
+            list(
+                model.objects.filter(id__gt=cursor.last_id)
+                .order_by("id")
+                .values(*fields)[:batch_size]
+            ),
+            cursor.last_id,
+            gap_seconds,
+        )
+        if not len(rows):
+            return None
+        # like popping the image queue: if another refresh moved the cursor
+        # first, it is counting these rows
+        claimed = models.RollupCursor.objects.filter(
+            pk=cursor.pk, last_id=cursor.last_id
+        ).update(last_id=rows[-1]["id"])
+        if not claimed:
+            return None
+
+        images = models.ImageRollup.objects.in_bulk({row["image_id"] for row in rows})
+        by_file, by_session = _count_rows(rows, images, is_click=is_click)
+        _save_image_rollups(list(images.values()))
+        for (step, file1), delta in by_file.items():
+            models.FileRollup.objects.get_or_create(step=step, file1=file1)
+            models.FileRollup.objects.filter(step=step, file1=file1).update(
+                **{k: F(k) + v for k, v in delta.items()}
+            )
+        for session_id, delta in by_session.items():
+            step = delta.pop("step")
+            models.SessionRollup.objects.get_or_create(
+                session_id=session_id, defaults={"step": step}
+            )
+            models.SessionRollup.objects.filter(session_id=session_id).update(
+                **{k: F(k) + v for k, v in delta.items()}
+            )
+    return len(rows)
+
+
+def refresh_rollups(
+    batch_size: int = ROLLUP_BATCH_SIZE, gap_seconds: float = ROLLUP_GAP_SECONDS
+) -> int:
+    """Add ratings and clicks stored since the last refresh to the rollups.
+
+    Also gives new images a rollup, so that their scheduling priority is known.
+    Returns the number of rows counted. Rows are only ever added, so run
+    rebuild_rollups after deleting images, sessions or ratings. Rows past a gap
+    in the ids that is younger than gap_seconds wait for a later refresh (see
+    _committed_prefix); 0 counts them at once, when nothing else is writing.
+    """
+    n = 0
+    while (n_rows := _add_new_images(batch_size, gap_seconds)) is not None:
+        n += n_rows
+    for model in (models.Rating, models.ClickedCoordinate):
+        while (
+            n_rows := _refresh_rollups_batch(model, batch_size, gap_seconds)
+        ) is not None:
+            n += n_rows
+    return n
+
+
+def rebuild_rollups(
+    batch_size: int = ROLLUP_BATCH_SIZE, gap_seconds: float = ROLLUP_GAP_SECONDS
+) -> int:
+    """Recount the rollups from scratch."""
+    with transaction.atomic():
+        for model in (
+            models.RollupCursor,
+            models.ImageRollup,
+            models.FileRollup,
+            models.SessionRollup,
+        ):
+            model.objects.all().delete()
+    return refresh_rollups(batch_size=batch_size, gap_seconds=gap_seconds)
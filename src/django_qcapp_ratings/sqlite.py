@@ -0,0 +1,50 @@
+"""SQLite profile for single-node deployments.
+
+Set QCAPP_SQLITE_CONCURRENCY = True to tune each new SQLite connection for
+raters and ingestion writing at the same time:
+
+- journal_mode=WAL, so that readers never wait for the writer.
+- synchronous=NORMAL, which is durable up to a power loss in WAL mode.
+- busy_timeout, so that writers queue on the lock instead of failing with
+  "database is locked".
+- mmap_size, so that reads come from the page cache without copies.
+
+Write transactions also begin IMMEDIATE, taking the write lock up front.
+A deferred transaction that later needs the lock fails at once, because
+waiting would deadlock. An IMMEDIATE one waits out the busy timeout instead.
+
+QCAPP_SQLITE_PRAGMAS overrides or adds PRAGMAs by name.
+"""
+
+import typing
+
+from django.conf import settings
+from django.db.backends import signals
+
+DEFAULT_PRAGMAS: dict[str, typing.Any] = {
+    "journal_mode": "WAL",
+    "synchronous": "NORMAL",
+    "busy_timeout": 30_000,
+    "mmap_size": 256 * 2**20,
+    "temp_store": "MEMORY",
+}
+
+
+def enabled() -> bool:
+    return getattr(settings, "QCAPP_SQLITE_CONCURRENCY", False)
+
+
+def get_pragmas() -> dict[str, typing.Any]:
+    return DEFAULT_PRAGMAS | getattr(settings, "QCAPP_SQLITE_PRAGMAS", {})
+
+
+@signals.connection_created.connect
+def configure_connection(sender, connection, **kwargs) -> None:
+    if connection.vendor != "sqlite" or not enabled():
+        return
+    with connection.cursor() as cursor:
+        for name, value in get_pragmas().items():
+            cursor.execute(f"PRAGMA {name}={value}")
+    # unless the OPTIONS of the database already set a mode
+    if connection.transaction_mode is None:
+        connection.transaction_mode = "IMMEDIATE"
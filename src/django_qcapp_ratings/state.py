@@ -0,0 +1,45 @@
+"""Rating progress, carried in a signed cookie instead of the session.
+
+The cookie holds the rater's Session id, step, the image being rated and its
+idempotency key. It is signed with SECRET_KEY, so it cannot be altered by the
+client, and reading or writing it costs no database I/O.
+"""
+
+import dataclasses
+import json
+
+from django import http
+
+COOKIE = "qcapp_rating"
+SALT = "django_qcapp_ratings.state"
+MAX_AGE_SEC = 24 * 60 * 60
+
+
+@dataclasses.dataclass
+class RatingState:
+    session_id: int | None = None
+    step: int | None = None
+    image_id: int | None = None
+    submission_key: str | None = None
+
+
+def load(request: http.HttpRequest) -> RatingState:
+    """The state sent with the request, or an empty one if missing or invalid."""
+    raw = request.get_signed_cookie(
+        COOKIE, default=None, salt=SALT, max_age=MAX_AGE_SEC
+    )
+    if raw is None:
+        return RatingState()
+    return RatingState(**json.loads(raw))
+
+
+def store(response: http.HttpResponse, state: RatingState) -> http.HttpResponse:
+    response.set_signed_cookie(
+        COOKIE,
+        json.dumps(dataclasses.asdict(state)),
+        salt=SALT,
+        max_age=MAX_AGE_SEC,
+        httponly=True,
+        samesite="Lax",
+    )
+    return response
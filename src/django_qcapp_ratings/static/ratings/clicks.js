@@ -1,3 +1,52 @@
+// Decode a slice stored by ingestion with --slices (see
+// management/commands/_slices.py) into a canvas, upscaled by its scale
+const decodeSlice = async base64 => {
+    const blob = Uint8Array.from(atob(base64), c => c.charCodeAt(0));
+    const header = new DataView(blob.buffer);
+    const width = header.getUint16(4, true);
+    const height = header.getUint16(6, true);
+    const scale = header.getUint8(8);
+    const nOverlays = header.getUint8(9);
+    const colors = [];
+    for (let i = 0; i < nOverlays; i++) {
+        colors.push(blob.subarray(10 + 4 * i, 14 + 4 * i));
+    }
+
+    const stream = new Blob([blob.subarray(10 + 4 * nOverlays)])
+        .stream()
+        .pipeThrough(new DecompressionStream('deflate'));
+    const body = new Uint8Array(await new Response(stream).arrayBuffer());
+
+    // Composite the overlays onto the grey background, one voxel at a time
+    const n = width * height;
+    const maskBytes = Math.ceil(n / 8);
+    const pixels = new ImageData(width, height);
+    for (let p = 0; p < n; p++) {
+        let r = body[p], g = body[p], b = body[p];
+        colors.forEach((color, i) => {
+            const bit = body[n + i * maskBytes + (p >> 3)] >> (7 - (p & 7));
+            if (bit & 1) {
+                const alpha = color[3] / 255;
+                r = r * (1 - alpha) + color[0] * alpha;
+                g = g * (1 - alpha) + color[1] * alpha;
+                b = b * (1 - alpha) + color[2] * alpha;
+            }
+        });
+        pixels.data[4 * p] = r;
+        pixels.data[4 * p + 1] = g;
+        pixels.data[4 * p + 2] = b;
+        pixels.data[4 * p + 3] = 255;
+    }
+
+    const slice = document.createElement('canvas');
+    slice.width = width * scale;
+    slice.height = height * scale;
+    const sliceCtx = slice.getContext('2d');
+    sliceCtx.imageSmoothingEnabled = false;
+    sliceCtx.drawImage(await createImageBitmap(pixels), 0, 0, slice.width, slice.height);
+    return slice;
+};
+
 // Define the controller function outside DOMContentLoaded to allow re-initialization
 const initializeCanvasController = () => {
     const canvas = document.getElementById('canvas');
@@ -12,15 +61,24 @@ const initializeCanvasController = () => {
     const ctx = canvas.getContext('2d');
     const img = new Image();
 
+    // What is drawn: the image, or a canvas with a decoded slice
+    let picture = img;
+    let ready = false;
+
+    // Region of the picture to show; all of it unless the image is a mosaic tile
+    let tile = null;
+    const source = () => tile || { x: 0, y: 0, width: picture.width, height: picture.height };
+
     // Array to store click coordinates
     const clickPoints = [];
 
     // Function to resize canvas while maintaining aspect ratio
     const resizeCanvas = () => {
-        if (!img.complete || !canvasWrapper) return;
+        if (!ready || !canvasWrapper) return;
 
         const wrapperWidth = canvasWrapper.clientWidth;
-        const imgAspectRatio = img.width / img.height;
+        const { width, height } = source();
+        const imgAspectRatio = width / height;
 
         // Calculate new dimensions maintaining aspect ratio
         let newWidth = wrapperWidth;
@@ -30,9 +88,10 @@ const initializeCanvasController = () => {
         canvas.style.width = newWidth + 'px';
         canvas.style.height = newHeight + 'px';
 
-        // Set canvas internal size (for drawing)
-        canvas.width = img.width;
-        canvas.height = img.height;
+        // Set canvas internal size (for drawing), so that clicks are in
+        // the pixel space of the (tile) image
+        canvas.width = width;
+        canvas.height = height;
 
         // Redraw after resize
         drawImageAndPoints();
@@ -40,12 +99,24 @@ const initializeCanvasController = () => {
 
     // Function to load the image from the current base64 data
     const loadImage = () => {
-        img.src = document.getElementById('image-data')?.value;
+        const imageData = document.getElementById('image-data');
+        const bounds = imageData?.dataset.tile?.split(',').map(Number);
+        tile = bounds ? { x: bounds[0], y: bounds[1], width: bounds[2], height: bounds[3] } : null;
+        if (imageData?.dataset.format === 'slice') {
+            decodeSlice(imageData.value).then(slice => {
+                picture = slice;
+                ready = true;
+                resizeCanvas();
+            });
+        } else {
+            img.src = imageData?.value;
+        }
     };
 
     // Set up the image load handler
     img.onload = () => {
         // Initial resize and draw
+        ready = true;
         resizeCanvas();
     };
 
@@ -55,7 +126,8 @@ const initializeCanvasController = () => {
 
         // Clear canvas and redraw image
         ctx.clearRect(0, 0, canvas.width, canvas.height);
-        ctx.drawImage(img, 0, 0);
+        const { x, y, width, height } = source();
+        ctx.drawImage(picture, x, y, width, height, 0, 0, width, height);
 
         // Draw gold circles at all clicked points
         ctx.strokeStyle = 'gold';
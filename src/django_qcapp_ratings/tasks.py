@@ -1,20 +1,87 @@
 import typing
 
 import celery
-from asgiref import sync
+from celery import result, signals
+from django import db
+from django.conf import settings
 
-from django_qcapp_ratings import models, selectors
+from django_qcapp_ratings import models, services, writebehind
+
+RENDER_MAX_RETRIES = 3
+
+
+def _configure_worker_connections() -> None:
+    """Keep database connections open across tasks, or pool them.
+
+    settings.QCAPP_WORKER_DB_POOL, if set, is passed as the "pool" option of
+    PostgreSQL connections (True, or a dict of psycopg_pool arguments). The web
+    processes keep their own connection settings.
+    """
+    pool = getattr(settings, "QCAPP_WORKER_DB_POOL", None)
+    for alias in db.connections:
+        settings_dict = db.connections[alias].settings_dict
+        if pool is not None and db.connections[alias].vendor == "postgresql":
+            # a pool hands out connections per task; Django forbids combining it
+            # with persistent connections
+            settings_dict["OPTIONS"] = {**settings_dict["OPTIONS"], "pool": pool}
+            settings_dict["CONN_MAX_AGE"] = 0
+        else:
+            settings_dict["CONN_MAX_AGE"] = getattr(
+                settings, "QCAPP_WORKER_CONN_MAX_AGE", None
+            )
+        settings_dict["CONN_HEALTH_CHECKS"] = True
+
+
+@signals.worker_process_init.connect
+def configure_worker(**kwargs) -> None:
+    # connections inherited from the parent process must not be shared
+    db.connections.close_all()
+    _configure_worker_connections()
+
+
+@signals.worker_process_shutdown.connect
+def close_worker_connections(**kwargs) -> None:
+    db.connections.close_all()
+
+
+@celery.shared_task(
+    autoretry_for=(OSError,),
+    retry_backoff=True,
+    max_retries=RENDER_MAX_RETRIES,
+)
+def render_figures(job: dict[str, typing.Any]) -> int:
+    """Render and upsert the figures described by a serialized RenderJob.
+
+    Rendering needs the packages of the `manage` dependency group, so they are
+    only imported on the workers that run this task.
+    """
+    from django_qcapp_ratings.management.commands import _ingest
+
+    return _ingest.render_and_save(_ingest.RenderJob.from_dict(job))
+
+
+@celery.shared_task
+def flush_write_behind() -> int:
+    """Move buffered submissions to the database; schedule this with beat."""
+    return writebehind.flush()
+
+
+def enqueue_render_jobs(jobs: list[dict[str, typing.Any]]) -> result.GroupResult:
+    group: result.GroupResult = celery.group(
+        render_figures.s(job) for job in jobs
+    ).apply_async()  # type: ignore
+    group.save()
+    return group
+
+
+@celery.shared_task
+def refresh_image_order(step: int | None = None) -> dict[str, int]:
+    """Reshuffle the rating order of one or all steps; schedule this with beat."""
+    steps = list(models.Step) if step is None else [models.Step(step)]
+    return {s.name: services.refresh_image_order(s) for s in steps}
 
 
 @celery.shared_task
-def run_db_query_async(step: int, last_pk: int | None = None) -> dict[str, typing.Any]:
-    if last_pk is None:
-        image = sync.async_to_sync(selectors.get_image_with_fewest_ratings)(
-            step=models.Step(step)
-        )
-    else:
-        image = sync.async_to_sync(selectors.get_image_pk_with_fewest_ratings)(
-            step=models.Step(step), last_pk=last_pk
-        )
-
-    return image.to_dict()
+def refresh_rollups() -> int:
+    """Count new ratings and clicks into the rollups; schedule this with beat."""
+    return services.refresh_rollups()
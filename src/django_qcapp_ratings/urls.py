@@ -30,6 +30,8 @@ urlpatterns = [
         views.ClickPartial.as_view(),
         name=views.CLICK_PARTIAL,
     ),
+    path("mosaic/<int:mosaic_id>/", views.mosaic, name="mosaic"),
+    path("metrics/", views.metrics, name="metrics"),
     # API endpoints
     path("api/", api.urls),
 ]
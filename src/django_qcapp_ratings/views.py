@@ -1,11 +1,20 @@
 import abc
+import hmac
 import logging
+import uuid
 
-from celery.exceptions import TimeoutError
+from asgiref import sync
 from django import http, shortcuts, urls, views
-from django.views.generic import edit
+from django.conf import settings
 
-from django_qcapp_ratings import forms, models, selectors, tasks
+from django_qcapp_ratings import (
+    forms,
+    instrumentation,
+    models,
+    services,
+    state,
+    writebehind,
+)
 
 MASK_VIEW = "mask"
 SPATIAL_NORMALIZATION_VIEW = "spatial_normalization"
@@ -14,67 +23,94 @@ FMAP_COREGISTRATION_VIEW = "fmap_coregistration"
 DTIFIT_VIEW = "dtifit"
 RATE_PARTIAL = "rate_partial"
 CLICK_PARTIAL = "click_partial"
-
-
-IMG_TASK = "img_task"
+MOSAIC_MAX_AGE_SEC = 60 * 60
+# served by the partials when there is no image to show
+ISSUE_MESSAGE = "There has been an issue. Please return to the homepage."
 
 
 class RatePartial(views.View):
     template_name = f"{RATE_PARTIAL}.html"
 
+    @instrumentation.traced("views.RatePartial.get")
     async def get(self, request: http.HttpRequest) -> http.HttpResponse:
+        rating = state.load(request)
+        if rating.step is None:
+            raise http.Http404("No step in progress")
         try:
-            img = await selectors.get_img_id(request)
-        except TimeoutError:
-            return http.HttpResponse(
-                "There has been an issue. Please return to the homepage."
+            img = await services.anext_image(
+                step=models.Step(rating.step), last_pk=rating.image_id
             )
+        except ValueError:
+            return http.HttpResponse(ISSUE_MESSAGE)
 
-        logging.info("starting img_next task")
-        img_task = tasks.run_db_query_async.delay(step=img.step, last_pk=img.id)
-        await request.session.aset(IMG_TASK, img_task.id)
-        await request.session.aset("image_id", img.id)
+        rating.image_id = img.id
+        rating.submission_key = uuid.uuid4().hex
         logging.info(f"rendering {img.id}")
-        return shortcuts.render(
-            request,
-            self.template_name,
-            {"img_type": img.img_type, "image": img.img_decoded},
-        )
+        context = {
+            "img_type": img.img_type,
+            "image": img.img_decoded,
+            "format": img.format,
+        }
+        if img.tile is not None:
+            mosaic = await models.Mosaic.objects.only("width", "height").aget(
+                pk=img.tile["mosaic_id"]
+            )
+            context |= {
+                "tile": img.tile,
+                "tile_style": img.tile_style(mosaic),
+                "mosaic_url": urls.reverse("mosaic", args=[mosaic.pk]),
+            }
+        with instrumentation.span("views.render"):
+            response = shortcuts.render(request, self.template_name, context)
+        return state.store(response, rating)
 
 
 class ClickPartial(RatePartial):
     template_name = f"{CLICK_PARTIAL}.html"
 
 
-class RateView(abc.ABC, edit.CreateView):
+class RateView(abc.ABC, views.View):
     template_name = "rate.html"
-    form_class = forms.RatingForm
-    success_url: str = f"/{RATE_PARTIAL}/"  # type: ignore
+    form_class: type[forms.RatingForm | forms.ClickForm] = forms.RatingForm
+    success_url: str = f"/{RATE_PARTIAL}/"
 
     @property
     @abc.abstractmethod
     def step(self) -> models.Step:
         raise NotImplementedError
 
-    def get(self, request: http.HttpRequest, *args, **kwargs):
-        logging.info("getting first img")
-        img_task = tasks.run_db_query_async.delay(step=self.step)
-
-        logging.info(f"updating session with {img_task=}")
-        request.session[IMG_TASK] = img_task.id
-
-        return super().get(request, *args, **kwargs)
+    async def get(self, request: http.HttpRequest) -> http.HttpResponse:
+        # the first partial may show any image
+        rating = state.load(request)
+        rating.step = self.step
+        rating.image_id = None
+        rating.submission_key = None
+        response = shortcuts.render(
+            request, self.template_name, {"form": self.form_class()}
+        )
+        return state.store(response, rating)
 
-    def post(self, request: http.HttpRequest, *args, **kwargs) -> http.HttpResponse:
-        form = self.get_form()
+    async def post(self, request: http.HttpRequest) -> http.HttpResponse:
+        form = self.form_class(request.POST)
         if form.is_valid():
             logging.info("saving rating")
             saved: models.FromRequest = form.save(commit=False)
             if not isinstance(saved, models.FromRequest):
                 raise http.Http404("Form field not expected type")
-            saved.update_instance_and_save(request=request)
+            if writebehind.enabled():
+                saved.update_instance(request=request)
+                # the append commits to the buffer's file, which must not
+                # block the event loop; any thread has its own connection
+                append = writebehind.get_buffer().append
+                await sync.sync_to_async(append, thread_sensitive=False)(saved)
+            else:
+                await saved.aupdate_instance_and_save(request=request)
+                # counted out of the request; a burst of ratings costs at most
+                # one more pass than the one already running
+                services.run_in_background(
+                    "refresh_rollups", services.refresh_rollups, coalesce=True
+                )
 
-            # call this instead of form_valid because the model has already been saved
             return http.HttpResponseRedirect(self.success_url)
 
         raise http.Http404("Submitted invalid rating")
@@ -116,12 +152,12 @@ class RateDTIFIT(RateView):
         return models.Step.DTIFIT
 
 
-class LayoutView(edit.FormView):
+class LayoutView(views.View):
     template_name = "index.html"
     form_class = forms.IndexForm
 
-    def get_success_url(self):
-        match self.request.session.get("step"):
+    def get_success_url(self, step: int) -> str:
+        match step:
             case models.Step.MASK:
                 return urls.reverse(f"{MASK_VIEW}")
             case models.Step.SPATIAL_NORMALIZATION:
@@ -135,9 +171,54 @@ class LayoutView(edit.FormView):
             case _:
                 raise http.Http404("Unknown step")
 
-    def form_valid(self, form: forms.IndexForm):
-        form.instance.user = self.request.headers.get("X-Tapis-Username")
-        session = form.save()
-        self.request.session["session_id"] = session.pk
-        self.request.session["step"] = session.step
-        return super().form_valid(form)
+    async def get(self, request: http.HttpRequest) -> http.HttpResponse:
+        return shortcuts.render(
+            request, self.template_name, {"form": self.form_class()}
+        )
+
+    async def post(self, request: http.HttpRequest) -> http.HttpResponse:
+        form = self.form_class(request.POST)
+        if not form.is_valid():
+            return shortcuts.render(request, self.template_name, {"form": form})
+
+        session: models.Session = form.save(commit=False)
+        session.user = request.headers.get("X-Tapis-Username")
+        await session.asave()
+        return state.store(
+            http.HttpResponseRedirect(self.get_success_url(session.step)),
+            state.RatingState(session_id=session.pk, step=session.step),
+        )
+
+
+async def mosaic(request: http.HttpRequest, mosaic_id: int) -> http.HttpResponse:
+    # the tiles of a mosaic are shown one at a time, so let the browser reuse it
+    img = await shortcuts.aget_object_or_404(
+        models.Mosaic.objects.only("img"), pk=mosaic_id
+    )
+    response = http.HttpResponse(bytes(img.img), content_type="image/png")
+    response["Cache-Control"] = f"private, max-age={MOSAIC_MAX_AGE_SEC}"
+    return response
+
+
+def _may_read_metrics(request: http.HttpRequest) -> bool:
+    user = getattr(request, "user", None)
+    if user is not None and user.is_active and user.is_staff:
+        return True
+    token = getattr(settings, "QCAPP_METRICS_TOKEN", None)
+    scheme, _, given = request.headers.get("Authorization", "").partition(" ")
+    return (
+        token is not None
+        and scheme.lower() == "bearer"
+        and hmac.compare_digest(given.strip().encode(), token.encode())
+    )
+
+
+def metrics(request: http.HttpRequest) -> http.HttpResponse:
+    """Serve the Prometheus metrics to staff users, or to scrapers that send
+    "Authorization: Bearer <settings.QCAPP_METRICS_TOKEN>"."""
+    if not _may_read_metrics(request):
+        return http.HttpResponseForbidden()
+    return http.HttpResponse(
+        instrumentation.render_prometheus(),
+        content_type="text/plain; version=0.0.4; charset=utf-8",
+    )
@@ -0,0 +1,128 @@
+"""Durable write-behind buffer for rating submissions.
+
+When settings.QCAPP_WRITE_BEHIND_PATH names an SQLite file, validated
+submissions are appended there (in WAL mode) instead of being inserted into
+the main database, and flush() moves them over in batches. Run flush from the
+flush_submissions command or the flush_write_behind Celery task.
+
+Each submission carries the idempotency key of the image it rates, so a
+submission that is appended or flushed twice is only stored once. Rows keep
+the created timestamp of their submission, and are added to the rollups after
+each flush.
+"""
+
+import functools
+import json
+import sqlite3
+import threading
+import typing
+
+from django.apps import apps
+from django.conf import settings
+
+from django_qcapp_ratings import models, services
+
+DEFAULT_BATCH_SIZE = 500
+BUSY_TIMEOUT_SEC = 30
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS submissions (
+    seq INTEGER PRIMARY KEY AUTOINCREMENT,
+    model TEXT NOT NULL,
+    idempotency_key TEXT UNIQUE,
+    payload TEXT NOT NULL
+)
+"""
+
+
+def enabled() -> bool:
+    return getattr(settings, "QCAPP_WRITE_BEHIND_PATH", None) is not None
+
+
+def _fields(model: type[models.FromRequest]) -> list:
+    return [field for field in model._meta.concrete_fields if not field.primary_key]
+
+
+def _dump(obj: models.FromRequest) -> str:
+    payload = {}
+    for field in _fields(type(obj)):
+        value = field.value_from_object(obj)
+        payload[field.attname] = None if value is None else field.value_to_string(obj)
+    return json.dumps(payload)
+
+
+def _load(model: type[models.FromRequest], payload: str) -> models.FromRequest:
+    values = json.loads(payload)
+    return model(
+        **{
+            field.attname: None
+            if values[field.attname] is None
+            else field.to_python(values[field.attname])
+            for field in _fields(model)
+            # submissions buffered before created was kept take the flush time
+            if field.attname in values
+        }
+    )
+
+
+class Buffer:
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self._local = threading.local()
+
+    @property
+    def connection(self) -> sqlite3.Connection:
+        # sqlite3 connections must stay on the thread that made them
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            connection = sqlite3.connect(
+                self.path, timeout=BUSY_TIMEOUT_SEC, isolation_level=None
+            )
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            connection.execute(_SCHEMA)
+            self._local.connection = connection
+        return connection
+
+    def append(self, obj: models.FromRequest) -> None:
+        self.connection.execute(
+            "INSERT OR IGNORE INTO submissions (model, idempotency_key, payload) "
+            "VALUES (?, ?, ?)",
+            (obj._meta.label, obj.idempotency_key, _dump(obj)),
+        )
+
+    def __len__(self) -> int:
+        return self.connection.execute("SELECT count(*) FROM submissions").fetchone()[0]
+
+    def flush(self, batch_size: int = DEFAULT_BATCH_SIZE) -> int:
+        """Move buffered submissions to the database, returning how many."""
+        n = 0
+        while rows := self.connection.execute(
+            "SELECT seq, model, payload FROM submissions ORDER BY seq LIMIT ?",
+            (batch_size,),
+        ).fetchall():
+            by_model: dict[str, list[models.FromRequest]] = {}
+            for _, label, payload in rows:
+                model = typing.cast(type[models.FromRequest], apps.get_model(label))
+                by_model.setdefault(label, []).append(_load(model, payload))
+            for objs in by_model.values():
+                type(objs[0]).objects.bulk_create(objs, ignore_conflicts=True)
+            # only forget rows once they are in the database
+            self.connection.execute(
+                "DELETE FROM submissions WHERE seq <= ?", (rows[-1][0],)
+            )
+            n += len(rows)
+        return n
+
+
+@functools.cache
+def get_buffer() -> Buffer:
+    return Buffer(settings.QCAPP_WRITE_BEHIND_PATH)
+
+
+def flush() -> int:
+    n = get_buffer().flush(
+        getattr(settings, "QCAPP_WRITE_BEHIND_BATCH_SIZE", DEFAULT_BATCH_SIZE)
+    )
+    services.refresh_rollups()
+    return n